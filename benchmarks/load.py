@@ -0,0 +1,297 @@
+"""Latency and throughput benchmark for the main endpoints.
+
+Run against a database filled by ``benchmarks.synthetic``, either in-process
+through the Flask test client::
+
+    python -m benchmarks.load --mode client \\
+        --database sqlite:////tmp/bench/photos.db --upload-dir /tmp/bench/uploads
+
+or over HTTP against a server that the script starts and stops, by default
+gunicorn with ``gunicorn.conf.py`` (``--server dev`` for Flask's development
+server, ``--server gevent`` for gevent workers)::
+
+    python -m benchmarks.load --mode server --server gunicorn --concurrency 16 \\
+        --database sqlite:////tmp/bench/photos.db --upload-dir /tmp/bench/uploads
+
+Results are printed (or written with ``--output``) as JSON with p50/p95/p99
+latency and throughput per endpoint. ``--baseline old.json`` compares against
+an earlier run and exits with status 1 if any p95 got worse than
+``--max-regression`` times the baseline.
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import shlex
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+SERVER_CMDS = {
+    # Flask's threaded development server, as started by run.py
+    'dev': 'flask --app wsgi:app run --host {host} --port {port} --with-threads',
+    'gunicorn': 'gunicorn -c gunicorn.conf.py --workers {workers} --bind {host}:{port} wsgi:app',
+    # Set through the environment, so gunicorn.conf.py monkey-patches before preloading
+    'gevent': ('env GUNICORN_WORKER_CLASS=gevent gunicorn -c gunicorn.conf.py '
+               '--workers {workers} --bind {host}:{port} wsgi:app'),
+}
+ENDPOINTS = ('home', 'search', 'suggest', 'toggle_like', 'upload', 'display_file')
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarise(latencies, errors, wall_time):
+    latencies_ms = [latency * 1000 for latency in latencies]
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': round(percentile(latencies_ms, 0.50), 3),
+        'p95_ms': round(percentile(latencies_ms, 0.95), 3),
+        'p99_ms': round(percentile(latencies_ms, 0.99), 3),
+        'mean_ms': round(statistics.fmean(latencies_ms), 3),
+        'throughput_rps': round(len(latencies) / wall_time, 1),
+    }
+
+
+def _multipart(fields, file_field, filename, data):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'
+                     f'{value}\r\n'.encode())
+    parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; '
+                 f'filename="{filename}"\r\nContent-Type: image/jpeg\r\n\r\n'.encode()
+                 + data + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+class Workload:
+    """Builds the requests for each endpoint from the benchmark database."""
+
+    def __init__(self, app):
+        from flask import session
+        from flask_wtf.csrf import generate_csrf
+
+        from project import db
+        from project.models import Photo, User
+
+        with app.app_context():
+            self.user_id = db.session.query(User.id).order_by(User.id).first()[0]
+            self.photo_ids = [row[0] for row in db.session.query(Photo.id).limit(1000)]
+            self.file = db.session.query(Photo.file).first()[0]
+            self.words = [row[0].split()[0] for row in db.session.query(Photo.caption).limit(200)]
+        # A logged-in session cookie and matching CSRF token, signed with the app's secret key
+        with app.test_request_context():
+            session['current_user_id'] = self.user_id
+            self.csrf_token = generate_csrf()
+            self.session_cookie = app.session_interface.get_signing_serializer(app).dumps(dict(session))
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def _next(self):
+        with self._lock:
+            self._counter += 1
+            return self._counter
+
+    def request(self, endpoint):
+        """Return ``(method, path, body, headers)`` for one request."""
+        n = self._next()
+        auth = {'Cookie': 'session=' + self.session_cookie, 'X-CSRFToken': self.csrf_token}
+        if endpoint == 'home':
+            return 'GET', '/', None, {}
+        if endpoint == 'search':
+            return 'GET', '/filterSearch?search=' + self.words[n % len(self.words)], None, {}
+        if endpoint == 'suggest':
+            word = self.words[n % len(self.words)]
+            return 'GET', '/suggest?q=' + word[:1 + n % 3], None, {}
+        if endpoint == 'toggle_like':
+            return 'POST', '/toggle_like/%d' % self.photo_ids[n % len(self.photo_ids)], b'', auth
+        if endpoint == 'upload':
+            # Unique bytes each time, so every upload is really stored
+            body, content_type = _multipart(
+                {'user': 'bench', 'caption': 'Benchmark upload', 'description': 'Upload %d' % n,
+                 'csrf_token': self.csrf_token},
+                'fileToUpload', 'bench.jpg', os.urandom(64 * 1024))
+            return 'POST', '/upload/', body, dict(auth, **{'Content-Type': content_type})
+        if endpoint == 'display_file':
+            return 'GET', '/uploads/' + self.file, None, {}
+        raise ValueError(endpoint)
+
+
+def run_client(app, workload, endpoint, requests):
+    client = app.test_client()
+    latencies, errors = [], 0
+    started = time.perf_counter()
+    for _ in range(requests):
+        method, path, body, headers = workload.request(endpoint)
+        headers = dict(headers)
+        cookie = headers.pop('Cookie', None)
+        if cookie:
+            client.set_cookie('session', cookie.split('=', 1)[1])
+        begin = time.perf_counter()
+        response = client.open(path, method=method, data=body, headers=headers)
+        response.get_data()
+        latencies.append(time.perf_counter() - begin)
+        errors += response.status_code >= 400
+    return summarise(latencies, errors, time.perf_counter() - started)
+
+
+def run_server(base_url, workload, endpoint, requests, concurrency):
+    parts = urlsplit(base_url)
+    local = threading.local()
+
+    def one(_):
+        if not hasattr(local, 'conn'):
+            local.conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=60)
+        method, path, body, headers = workload.request(endpoint)
+        begin = time.perf_counter()
+        try:
+            local.conn.request(method, path, body=body, headers=headers)
+            response = local.conn.getresponse()
+            response.read()
+            failed = response.status >= 400
+        except (OSError, http.client.HTTPException):
+            local.conn.close()
+            del local.conn
+            failed = True
+        return time.perf_counter() - begin, failed
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(requests)))
+    return summarise([latency for latency, _ in results],
+                     sum(failed for _, failed in results),
+                     time.perf_counter() - started)
+
+
+def start_server(command, env, base_url, timeout=30):
+    process = subprocess.Popen(shlex.split(command), env=env)
+    parts = urlsplit(base_url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=2)
+            conn.request('GET', '/readyz')
+            conn.getresponse().read()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError('Server exited with status %d' % process.returncode)
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('Server did not start within %ds' % timeout)
+
+
+def compare(results, baseline, max_regression):
+    """Return a list of regressions of ``results`` against ``baseline``."""
+    regressions = []
+    for endpoint, current in results['results'].items():
+        previous = baseline['results'].get(endpoint)
+        if previous and current['p95_ms'] > previous['p95_ms'] * max_regression:
+            regressions.append(f"{endpoint}: p95 {previous['p95_ms']}ms -> {current['p95_ms']}ms")
+    return regressions
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--mode', choices=('client', 'server'), default='client')
+    parser.add_argument('--database', required=True)
+    parser.add_argument('--upload-dir', required=True)
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS),
+                        help='comma-separated subset of ' + ', '.join(ENDPOINTS))
+    parser.add_argument('--requests', type=int, default=500, help='per endpoint')
+    parser.add_argument('--concurrency', type=int, default=8, help='server mode only')
+    parser.add_argument('--workers', type=int, default=4, help='server processes')
+    parser.add_argument('--url', default='http://127.0.0.1:8765',
+                        help='server mode: where the server listens')
+    parser.add_argument('--server', choices=SERVER_CMDS, default='gunicorn',
+                        help='server mode: which server to start (default gunicorn)')
+    parser.add_argument('--server-cmd',
+                        help='custom command starting the server; {workers}, {host} and {port} '
+                             'are filled in. Pass an empty string to use an already running '
+                             'server.')
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    parser.add_argument('--baseline', help='earlier JSON output to compare against')
+    parser.add_argument('--max-regression', type=float, default=1.25)
+    args = parser.parse_args()
+
+    env = dict(os.environ, DATABASE_URL=args.database, UPLOAD_DIR=args.upload_dir,
+               SECRET_KEY=os.getenv('SECRET_KEY', 'benchmark-secret'))
+    os.environ.update(env)
+    from project import create_app
+    app = create_app()
+    workload = Workload(app)
+    endpoints = [endpoint for endpoint in args.endpoints.split(',') if endpoint]
+
+    server = None
+    server_cmd = SERVER_CMDS[args.server] if args.server_cmd is None else args.server_cmd
+    if args.mode == 'server' and server_cmd:
+        parts = urlsplit(args.url)
+        server = start_server(server_cmd.format(workers=args.workers, host=parts.hostname,
+                                                     port=parts.port), env, args.url)
+    try:
+        results = {}
+        for endpoint in endpoints:
+            if args.mode == 'client':
+                results[endpoint] = run_client(app, workload, endpoint, args.requests)
+            else:
+                results[endpoint] = run_server(args.url, workload, endpoint, args.requests,
+                                               args.concurrency)
+            print(f'{endpoint}: {results[endpoint]}', file=sys.stderr)
+    finally:
+        if server:
+            server.terminate()
+            server.wait(timeout=30)
+
+    report = {
+        'meta': {
+            'revision': _git_revision(),
+            'mode': args.mode,
+            'server': (args.server if args.server_cmd is None else args.server_cmd)
+                      if args.mode == 'server' else None,
+            'database': args.database,
+            'requests_per_endpoint': args.requests,
+            'concurrency': args.concurrency if args.mode == 'server' else 1,
+            'workers': args.workers if args.mode == 'server' else 1,
+            'python': platform.python_version(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        },
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as previous:
+            regressions = compare(report, json.load(previous), args.max_regression)
+        for regression in regressions:
+            print('REGRESSION ' + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Render cost and size of the homepage grid.
+
+    python -m benchmarks.render --photos 100 --runs 50
+
+Fills a scratch database with ``--photos`` photos, then renders the
+homepage with all of them on one page and the grid cache off, so every
+request renders the tiles again. Reports as JSON:
+
+``tiles_ms``   median time to render the tiles alone (``render_tiles``)
+``page_ms``    median time of the whole request, per response encoding
+``bytes``      response size per encoding (identity, gzip, br)
+
+Compare two revisions by running it in each checkout.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import insert
+
+from benchmarks.synthetic import WORDS
+from project import create_app, db
+from project.models import Photo
+
+ENCODINGS = ('identity', 'gzip', 'br')
+
+
+def _sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def fill(count, seed=0):
+    rng = random.Random(seed)
+    db.session.execute(insert(Photo), [{
+        'name': _sentence(rng, 2).title(),
+        'caption': _sentence(rng, 4).capitalize(),
+        'description': _sentence(rng, 20).capitalize(),
+        'file': '%064x.jpg' % rng.getrandbits(256),
+        'width': 1600,
+        'height': 1200,
+        'user_id': 1,
+    } for _ in range(count)])
+    db.session.commit()
+
+
+def timed(function, runs):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = function()
+        samples.append((time.perf_counter() - started) * 1000)
+    return round(statistics.median(samples), 3), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--photos', type=int, default=100)
+    parser.add_argument('--runs', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        app = create_app({
+            'SECRET_KEY': os.getenv('SECRET_KEY', 'benchmark-secret'),
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(scratch, 'render.db'),
+            'UPLOAD_DIR': scratch,
+            'GRID_CACHE_BACKEND': 'none',
+            'PHOTOS_PER_PAGE': args.photos,
+        })
+        with app.app_context():
+            db.create_all()
+            fill(args.photos)
+            photos = Photo.query.all()
+            from project.main import render_tiles
+            with app.test_request_context('/'):
+                render_tiles(photos)
+                tiles_ms, _ = timed(lambda: render_tiles(photos), args.runs)
+
+        client = app.test_client()
+        page_ms, sizes = {}, {}
+        for encoding in ENCODINGS:
+            fetch = lambda: client.get('/', headers={'Accept-Encoding': encoding})
+            fetch()
+            page_ms[encoding], response = timed(fetch, args.runs)
+            sizes[encoding] = len(response.data)
+
+    print(json.dumps({'photos': args.photos, 'runs': args.runs, 'tiles_ms': tiles_ms,
+                      'page_ms': page_ms, 'bytes': sizes}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Cold-start time of the WSGI entry point.
+
+    python -m benchmarks.startup --runs 10 --budget-ms 800
+
+Each run imports ``wsgi`` (which creates the app) in a fresh interpreter,
+the same work a server does before it can accept requests, and the median
+is compared against the budget. Exits with status 1 if the median is over
+budget or if any module in ``LAZY_MODULES`` got imported at startup.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Only needed by some requests, so they must not be imported at startup
+LAZY_MODULES = ('authlib', 'requests', 'joserfc', 'redis', 'boto3', 'numpy', 'brotli')
+
+PROBE = '''
+import json, sys, time
+started = time.perf_counter()
+import wsgi
+elapsed = time.perf_counter() - started
+print(json.dumps({'ms': elapsed * 1000, 'modules': sorted(sys.modules)}))
+'''
+
+
+def measure(runs, env):
+    samples, modules = [], set()
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', PROBE], env=env, capture_output=True,
+                                text=True, check=True).stdout
+        result = json.loads(output.splitlines()[-1])
+        samples.append(result['ms'])
+        modules.update(result['modules'])
+    loaded = sorted(name for name in LAZY_MODULES if name in modules)
+    return samples, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--budget-ms', type=float, default=800)
+    args = parser.parse_args()
+
+    env = dict(os.environ, SECRET_KEY=os.getenv('SECRET_KEY', 'benchmark-secret'),
+               DATABASE_URL=os.getenv('DATABASE_URL', 'sqlite://'))
+    samples, loaded = measure(args.runs, env)
+    median = statistics.median(samples)
+    print(json.dumps({'runs': args.runs, 'median_ms': round(median, 1),
+                      'min_ms': round(min(samples), 1), 'max_ms': round(max(samples), 1),
+                      'budget_ms': args.budget_ms, 'eagerly_imported': loaded}, indent=2))
+    if median > args.budget_ms or loaded:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
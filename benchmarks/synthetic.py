@@ -0,0 +1,132 @@
+"""Fill a database with a synthetic catalogue for benchmarking.
+
+    python -m benchmarks.synthetic --scale 100k \\
+        --database sqlite:////tmp/bench/photos.db --upload-dir /tmp/bench/uploads
+
+Creates users, photos and likes in the given proportions, plus a pool of
+placeholder JPEGs that the photos share (like real duplicate uploads, they
+are stored once under their content hash). The schema is dropped and
+recreated first.
+"""
+import argparse
+import hashlib
+import io
+import os
+import random
+import time
+
+from PIL import Image
+from sqlalchemy import insert, text
+from sqlalchemy.engine import make_url
+
+from project import create_app, db
+from project.migrations import stamp
+from project.models import Like, Photo, User
+from project.storage import content_name, get_storage
+
+SCALES = {'1k': 1_000, '10k': 10_000, '100k': 100_000, '1m': 1_000_000}
+BATCH = 10_000
+
+WORDS = ('penguin lizard vulture jaguar macaque berlin nakano bologna nazare alcatraz '
+         'oporto beach mountain river forest city street night sunset harbour bridge '
+         'market train station garden desert snow island lake temple castle').split()
+
+
+def placeholder_files(storage, count, rng):
+    """Store ``count`` distinct placeholder JPEGs; return their storage names."""
+    files = []
+    for _ in range(count):
+        colour = tuple(rng.randrange(256) for _ in range(3))
+        buffer = io.BytesIO()
+        Image.new('RGB', (1280, 960), colour).save(buffer, 'JPEG', quality=85)
+        data = buffer.getvalue()
+        name = content_name(hashlib.sha256(data).hexdigest(), 'JPEG')
+        tmp = storage.temp_path()
+        with open(tmp, 'wb') as out:
+            out.write(data)
+        storage.save(name, tmp)
+        files.append(name)
+    return files
+
+
+def _sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def _insert_batches(model, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH:
+            db.session.execute(insert(model), batch)
+            batch = []
+    if batch:
+        db.session.execute(insert(model), batch)
+    db.session.commit()
+
+
+def generate(photos, users, likes_per_photo, files, seed=0, report=print):
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    db.drop_all()
+    with db.engine.begin() as conn:
+        conn.execute(text('DROP TABLE IF EXISTS schema_migrations'))
+    db.create_all()
+    stamp()
+
+    names = placeholder_files(get_storage(), files, rng)
+    report(f'{len(names)} placeholder files')
+
+    _insert_batches(User, ({'google_id': 'synthetic-%d' % i,
+                            'email': 'user%d@example.com' % i,
+                            'name': 'User %d' % i} for i in range(1, users + 1)))
+    report(f'{users} users')
+
+    _insert_batches(Photo, ({'name': 'User %d' % (i % users + 1),
+                             'caption': _sentence(rng, 3),
+                             'description': _sentence(rng, 12),
+                             'file': names[i % len(names)],
+                             'width': 1280, 'height': 960,
+                             'user_id': i % users + 1} for i in range(photos)))
+    report(f'{photos} photos')
+
+    # Each user likes a different run of photos, so (user_id, photo_id) never repeats
+    total_likes = min(int(photos * likes_per_photo), photos * users)
+    per_user = -(-total_likes // users)
+    stride = 7919  # prime, so consecutive likes of one user land on distinct photos
+    _insert_batches(Like, ({'user_id': i % users + 1,
+                            'photo_id': ((i // users) * stride + (i % users) * 31) % photos + 1}
+                           for i in range(min(total_likes, per_user * users))))
+    db.session.execute(text('UPDATE photo SET like_count = '
+                            '(SELECT COUNT(*) FROM "like" WHERE "like".photo_id = photo.id)'))
+    db.session.commit()
+    report(f'{total_likes} likes')
+    report(f'Generated in {time.perf_counter() - started:.1f}s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scale', choices=SCALES, default='1k',
+                        help='number of photos (default 1k)')
+    parser.add_argument('--users', type=int, help='default: photos / 20')
+    parser.add_argument('--likes-per-photo', type=float, default=3.0)
+    parser.add_argument('--files', type=int, default=200,
+                        help='distinct placeholder images shared by the photos')
+    parser.add_argument('--database', required=True, help='SQLAlchemy URI to (re)create')
+    parser.add_argument('--upload-dir', required=True)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    photos = SCALES[args.scale]
+    url = make_url(args.database)
+    if url.get_backend_name() == 'sqlite' and url.database:
+        os.makedirs(os.path.dirname(os.path.abspath(url.database)), exist_ok=True)
+    app = create_app({'SQLALCHEMY_DATABASE_URI': args.database,
+                      'UPLOAD_DIR': args.upload_dir})
+    with app.app_context():
+        generate(photos, args.users or max(1, photos // 20), args.likes_per_photo,
+                 min(args.files, photos), seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
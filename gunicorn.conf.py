@@ -0,0 +1,61 @@
+"""Gunicorn settings for the production server.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Every setting can be overridden from the environment:
+
+``GUNICORN_BIND``          address to listen on (default ``0.0.0.0:8000``)
+``WEB_CONCURRENCY``        worker processes (default 2 x CPUs + 1)
+``GUNICORN_WORKER_CLASS``  ``gthread`` (default) or ``gevent``
+``GUNICORN_THREADS``       threads per ``gthread`` worker (default 4)
+``GUNICORN_CONNECTIONS``   concurrent clients per ``gevent`` worker (default 1000)
+``GUNICORN_KEEPALIVE``     seconds an idle keep-alive connection stays open (default 5)
+``GUNICORN_TIMEOUT``       seconds before a stuck worker is killed (default 30)
+``GUNICORN_GRACEFUL_TIMEOUT``  seconds a stopping worker gets to finish its requests (default 30)
+``GUNICORN_MAX_REQUESTS``  recycle a worker after this many requests (default 0, never)
+
+With ``gthread`` a client downloading a large upload holds one thread for
+the whole download. ``gevent`` workers (``pip install gevent``) serve each
+connection on a greenlet instead, so slow clients only cost memory; use
+them when uploads are served by the app rather than by a front proxy with
+``UPLOAD_ACCEL_PREFIX``.
+
+Graceful reload: ``kill -HUP <master pid>`` starts new workers with the
+current config and stops the old ones once their requests finish. The app
+is preloaded in the master, so to deploy new code send ``USR2`` (start a new
+master alongside) and then ``TERM`` to the old master.
+"""
+import multiprocessing
+import os
+
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+if worker_class == 'gevent':
+    # Patch before the app is preloaded, so its locks and sockets are cooperative too
+    from gevent import monkey
+    monkey.patch_all()
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+worker_connections = int(os.getenv('GUNICORN_CONNECTIONS', 1000))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+
+# Import the app once in the master so workers fork from a warm copy (see wsgi.py)
+preload_app = True
+# Let the OS copy file responses straight to the socket
+sendfile = True
+# e.g. '-' for stdout; off by default
+accesslog = os.getenv('GUNICORN_ACCESS_LOG')
+
+
+def post_worker_init(worker):
+    # Build the search suggestions while the worker waits for its first requests
+    from project.suggest import build_in_background
+    build_in_background(worker.wsgi)
+    # Threads are not inherited from the master, so each worker starts its own job workers
+    from project.jobs import start_workers
+    start_workers(worker.wsgi)
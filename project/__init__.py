@@ -2,21 +2,32 @@ from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_wtf.csrf import CSRFProtect
 import os
-from dotenv import load_dotenv
-load_dotenv()
+from functools import cache
 from pathlib import Path
+from .database import configure_engine, database_uri, engine_options
 
 # init SQLAlchemy so we can use it later in our models
 db = SQLAlchemy()
 
-def create_app():
+@cache
+def load_environment():
+    # Read the .env file into os.environ, once per process
+    from dotenv import load_dotenv
+    load_dotenv()
+
+def create_app(test_config=None):
+    load_environment()
     # Task 8 & 9: 
     # Prevent CSRF attacks 
     csrf = CSRFProtect()
     app = Flask(__name__)
+    # Stream uploaded files to disk, hashing them on the way
+    from .storage import UploadRequest
+    app.request_class = UploadRequest
     csrf.init_app(app)
     app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///photos.db'
+    # Database URI and pool settings come from the environment, see database.py
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_uri()
     app.config['SESSION_COOKIE_HTTPONLY'] = True  # Prevent JS access to cookies.
     # Task 8 & 9: 
     # Prevents cookies from being sent with cross-site POST requests
@@ -26,9 +37,113 @@ def create_app():
     app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'  
 
     CWD = Path(os.path.dirname(__file__))
-    app.config['UPLOAD_DIR'] = CWD / "uploads"
+    app.config['UPLOAD_DIR'] = Path(os.getenv('UPLOAD_DIR', CWD / "uploads"))
+    # Where uploads are kept: 'local' (UPLOAD_DIR, in hash-sharded subdirectories) or 's3'.
+    # With 's3', UPLOAD_DIR is only used as scratch space for files on their way in.
+    app.config['STORAGE_BACKEND'] = os.getenv('STORAGE_BACKEND', 'local')
+    app.config['S3_BUCKET'] = os.getenv('S3_BUCKET')
+    app.config['S3_PREFIX'] = os.getenv('S3_PREFIX', '')
+    # e.g. http://localhost:9000 for MinIO
+    app.config['S3_ENDPOINT_URL'] = os.getenv('S3_ENDPOINT_URL')
+    app.config['S3_REGION'] = os.getenv('S3_REGION')
+    # Public base URL of the bucket or its CDN; without it uploads are served with presigned URLs
+    app.config['S3_PUBLIC_URL'] = os.getenv('S3_PUBLIC_URL')
+    app.config['S3_URL_EXPIRY'] = int(os.getenv('S3_URL_EXPIRY', 3600))
+    # Largest accepted request body, which bounds the size of an upload (16 MB by default)
+    app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_UPLOAD_BYTES', 16 * 1024 * 1024))
+    # Browser cache lifetime for uploads stored under their original (non content-addressed) names
+    app.config['UPLOAD_MAX_AGE'] = int(os.getenv('UPLOAD_MAX_AGE', 3600))
+    # Let a front proxy serve upload bytes: e.g. '/protected-uploads/' for nginx X-Accel-Redirect,
+    # or USE_X_SENDFILE=1 for Apache/lighttpd X-Sendfile
+    app.config['UPLOAD_ACCEL_PREFIX'] = os.getenv('UPLOAD_ACCEL_PREFIX')
+    app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
+    # Background jobs, see jobs.py: worker threads per web process (0 to run jobs only in
+    # `flask --app project jobs-worker`), seconds between looks for jobs queued by other processes,
+    # seconds a job may run before it is taken to be lost and run again, and the wait before
+    # the first retry of a failed job (doubled for each further attempt)
+    app.config['JOB_WORKERS'] = int(os.getenv('JOB_WORKERS', 2))
+    app.config['JOB_POLL_SECONDS'] = float(os.getenv('JOB_POLL_SECONDS', 1))
+    app.config['JOB_LEASE_SECONDS'] = int(os.getenv('JOB_LEASE_SECONDS', 600))
+    app.config['JOB_RETRY_SECONDS'] = int(os.getenv('JOB_RETRY_SECONDS', 30))
+    # Orphaned uploads, see cleanup.py: seconds between checks (0 to turn them off),
+    # and how old an unused file must be before it is removed
+    app.config['RECONCILE_SECONDS'] = int(os.getenv('RECONCILE_SECONDS', 6 * 3600))
+    app.config['RECONCILE_GRACE_SECONDS'] = int(os.getenv('RECONCILE_GRACE_SECONDS', 3600))
+    # Seconds the file of a deleted photo is kept after an identical upload last re-used it
+    app.config['CLEANUP_GRACE_SECONDS'] = int(os.getenv('CLEANUP_GRACE_SECONDS', 60))
+    # Number of photos per page of the homepage feed
+    app.config['PHOTOS_PER_PAGE'] = int(os.getenv('PHOTOS_PER_PAGE', 24))
+    # Hours after which a like counts half as much towards the trending feed (see trending.py).
+    # Run `flask --app project trending-rebuild` after changing it.
+    app.config['TRENDING_HALF_LIFE_HOURS'] = float(os.getenv('TRENDING_HALF_LIFE_HOURS', 24))
+    # Largest page the JSON API returns (see api.py)
+    app.config['API_MAX_PAGE_SIZE'] = int(os.getenv('API_MAX_PAGE_SIZE', 100))
+    # Number of results shown per page of search results
+    app.config['SEARCH_PAGE_SIZE'] = int(os.getenv('SEARCH_PAGE_SIZE', 24))
+    # Search-as-you-type, see suggest.py: entries kept in memory per process, and the least
+    # number of seconds between rebuilds after photos were changed by another process
+    app.config['SUGGEST_MAX_ENTRIES'] = int(os.getenv('SUGGEST_MAX_ENTRIES', 100_000))
+    app.config['SUGGEST_REFRESH_SECONDS'] = int(os.getenv('SUGGEST_REFRESH_SECONDS', 30))
+    # Near-duplicates, see similar.py: how many of the 64 perceptual hash bits may differ
+    # for an upload to be flagged as a duplicate, or for a photo to be listed as similar
+    app.config['DUPLICATE_MAX_DISTANCE'] = int(os.getenv('DUPLICATE_MAX_DISTANCE', 6))
+    app.config['SIMILAR_MAX_DISTANCE'] = int(os.getenv('SIMILAR_MAX_DISTANCE', 12))
+    app.config['SIMILAR_REFRESH_SECONDS'] = int(os.getenv('SIMILAR_REFRESH_SECONDS', 60))
+
+    # Cache for rendered pages of the homepage grid: 'lru' (in-process), 'redis' (shared) or 'none'
+    app.config['GRID_CACHE_BACKEND'] = os.getenv('GRID_CACHE_BACKEND', 'lru')
+    app.config['GRID_CACHE_URL'] = os.getenv('GRID_CACHE_URL', 'redis://localhost:6379/0')
+    app.config['GRID_CACHE_MAX_ENTRIES'] = int(os.getenv('GRID_CACHE_MAX_ENTRIES', 256))
+    app.config['GRID_CACHE_MAX_BYTES'] = int(os.getenv('GRID_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+    app.config['GRID_CACHE_VERSION_FILE'] = os.path.join(app.instance_path, 'grid.version')
+    # Seconds a cached page of the popular or trending feed keeps its order as likes come in (0: not cached)
+    app.config['GRID_CACHE_RANKED_SECONDS'] = int(os.getenv('GRID_CACHE_RANKED_SECONDS', 60))
+
+    # Compression of HTML and JSON responses, see compression.py
+    app.config['COMPRESSION'] = os.getenv('COMPRESSION', '1').lower() in ('1', 'true', 'yes')
+    app.config['COMPRESS_MIN_BYTES'] = int(os.getenv('COMPRESS_MIN_BYTES', 500))
+    app.config['GZIP_LEVEL'] = int(os.getenv('GZIP_LEVEL', 6))
+    # Brotli is used when the brotli package is installed; 11 is smallest but far too slow per request
+    app.config['BROTLI_QUALITY'] = int(os.getenv('BROTLI_QUALITY', 5))
+
+    # Instrumentation, see metrics.py
+    app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN')
+    app.config['N_PLUS_ONE_THRESHOLD'] = int(os.getenv('N_PLUS_ONE_THRESHOLD', 5))
+    app.config['PROFILING_ENABLED'] = os.getenv('PROFILING_ENABLED', '').lower() in ('1', 'true', 'yes')
 
+    # Google sign-in. The discovery document and signing keys are cached for OIDC_CACHE_TTL seconds
+    app.config['GOOGLE_CLIENT_ID'] = os.getenv('GOOGLE_CLIENT_ID')
+    app.config['GOOGLE_CLIENT_SECRET'] = os.getenv('GOOGLE_CLIENT_SECRET')
+    app.config['OIDC_METADATA_URL'] = os.getenv(
+        'OIDC_METADATA_URL', 'https://accounts.google.com/.well-known/openid-configuration')
+    app.config['OIDC_CACHE_TTL'] = int(os.getenv('OIDC_CACHE_TTL', 3600))
+
+    if test_config is not None:
+        app.config.update(test_config)
+
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS',
+                          engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
     db.init_app(app)
+    configure_engine(app, db)
+
+    from .cache import init_grid_cache
+    init_grid_cache(app)
+
+    from .metrics import init_metrics
+    init_metrics(app, db)
+
+    # Registered after init_metrics, so it runs first and the timings include it
+    from .compression import init_compression
+    init_compression(app)
+
+    from .suggest import init_suggest
+    init_suggest(app)
+
+    from .similar import init_similar
+    init_similar(app)
+
+    from .jobs import init_jobs
+    init_jobs(app)
 
     # blueprint for non-auth parts of app
     from .main import main as main_blueprint
@@ -39,4 +154,15 @@ def create_app():
     app.register_blueprint(auth_blueprint)
     app.register_blueprint(search_blueprint)
 
+    # Read-only JSON API under /api
+    from .api import api as api_blueprint
+    app.register_blueprint(api_blueprint)
+
+    # /healthz and /readyz for the load balancer
+    from .health import health as health_blueprint
+    app.register_blueprint(health_blueprint)
+
+    from .commands import register_commands
+    register_commands(app)
+
     return app
@@ -0,0 +1,134 @@
+"""Read-only JSON API.
+
+``GET /api/photos``
+    The photos of a feed (``?feed=files|popular|trending``), a page at a
+    time. ``?limit=`` sets the page size (at most ``API_MAX_PAGE_SIZE``) and
+    ``next`` in the answer is the cursor to pass as ``?after=`` for the
+    next page, or null on the last one.
+``GET /api/photos/<id>``
+    One photo.
+``GET /api/users/<id>/photos``
+    A user's photos, newest first, paged the same way.
+``GET /api/search?q=<keywords>&page=<n>``
+    Search results, ranked as on the website.
+``GET /api/export.ndjson``
+    Every photo, one JSON object per line, streamed in id order.
+
+Photos are ``Photo.serialize`` plus the URL of the image, the owner's public
+profile and, for a logged-in user, whether they liked it. Owners are loaded
+with one ``selectinload`` query per page and the liked state with one more,
+so a page costs the same few queries whatever its size.
+
+Every answer but the export carries an ``ETag``; a request whose
+``If-None-Match`` still matches gets an empty 304. The answers depend on
+who is logged in, so they carry ``Vary: Cookie``, and a logged-in user's
+are ``private``: a shared cache never hands them, or a 304 for them, to
+anyone else.
+"""
+import json
+
+from flask import (
+  Blueprint, Response, abort, current_app, jsonify, request, session, stream_with_context,
+  url_for
+)
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+
+from . import db
+from .main import FEEDS, liked_photo_ids_for
+from .models import Photo, User
+from .pagination import keyset_page
+from .searchindex import search_photos
+
+api = Blueprint('api', __name__, url_prefix='/api')
+
+# Photos read from the database at a time by the export
+EXPORT_BATCH = 1000
+
+
+def photo_json(photo, liked_ids=None):
+    data = photo.serialize
+    data['url'] = url_for('main.display_file', name=photo.file)
+    data['owner'] = photo.user.serialize_public if photo.user else None
+    if liked_ids is not None:
+        data['liked'] = photo.id in liked_ids
+    return data
+
+
+def photos_json(photos):
+    liked_ids = None
+    if 'current_user_id' in session:
+        liked_ids = set(liked_photo_ids_for([photo.id for photo in photos]))
+    return [photo_json(photo, liked_ids) for photo in photos]
+
+
+def conditional(payload):
+    # The ETag is a hash of the body, so clients revalidate (no-cache) and get a 304 while it is unchanged
+    response = jsonify(payload)
+    response.cache_control.no_cache = True
+    # The body says which photos the logged-in user liked
+    response.vary.add('Cookie')
+    if 'current_user_id' in session:
+        response.cache_control.private = True
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+def _page_size():
+    limit = request.args.get('limit', current_app.config['PHOTOS_PER_PAGE'], type=int)
+    return min(max(limit, 1), current_app.config['API_MAX_PAGE_SIZE'])
+
+
+@api.route('/photos')
+def list_photos():
+    feed = request.args.get('feed', 'files')
+    if feed not in FEEDS:
+        abort(404)
+    _, order, sort_key = FEEDS[feed]
+    photos, next_cursor = keyset_page(db.session.query(Photo).options(selectinload(Photo.user)),
+                                      order, key=sort_key, after=request.args.get('after'),
+                                      per_page=_page_size())
+    return conditional({'photos': photos_json(photos), 'next': next_cursor})
+
+
+@api.route('/photos/<int:photo_id>')
+def get_photo(photo_id):
+    photo = db.session.get(Photo, photo_id, options=[selectinload(Photo.user)])
+    if photo is None:
+        abort(404)
+    return conditional(photos_json([photo])[0])
+
+
+@api.route('/users/<int:user_id>/photos')
+def user_photos(user_id):
+    user = db.get_or_404(User, user_id)
+    photos, next_cursor = keyset_page(db.session.query(Photo).filter(Photo.user_id == user.id)
+                                      .options(selectinload(Photo.user)),
+                                      [(Photo.id, True)], key=lambda photo: (photo.id,),
+                                      after=request.args.get('after'), per_page=_page_size())
+    return conditional({'user': user.serialize_public, 'photos': photos_json(photos),
+                        'next': next_cursor})
+
+
+@api.route('/search')
+def search():
+    keyword = request.args.get('q', '')
+    page = max(request.args.get('page', 1, type=int), 1)
+    photos, has_next = search_photos(keyword, page=page, per_page=_page_size(),
+                                     options=[selectinload(Photo.user)])
+    return conditional({'query': keyword, 'page': page, 'photos': photos_json(photos),
+                        'next_page': page + 1 if has_next else None})
+
+
+@api.route('/export.ndjson')
+def export():
+    # yield_per reads EXPORT_BATCH rows at a time (with one owner query per batch) and the rows are
+    # written out as they are read, so memory use does not grow with the size of the catalogue
+    def lines():
+        photos = db.session.scalars(select(Photo).options(selectinload(Photo.user))
+                                    .order_by(Photo.id)
+                                    .execution_options(yield_per=EXPORT_BATCH))
+        for photo in photos:
+            yield json.dumps(photo_json(photo), separators=(',', ':')) + '\n'
+    return Response(stream_with_context(lines()), mimetype='application/x-ndjson',
+                    headers={'Content-Disposition': 'attachment; filename=photos.ndjson'})
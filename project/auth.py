@@ -3,33 +3,23 @@ from flask import (
   flash, redirect, url_for,  session, 
   current_app
 )
-from authlib.integrations.flask_client import OAuth
+from werkzeug.local import LocalProxy
 from .models import Like, Photo
 from sqlalchemy import asc, text
 import secrets
 from . import db
 from .models import User
-import os
-from dotenv import load_dotenv
-load_dotenv()
 
 auth = Blueprint('auth', __name__)
 
-#loads the sensitive information from .env file, hence they do not need to be hard coded into the source code and risk possible leak if source code is exposed.
-GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID') 
-GOOGLE_CLIENT_SECRET = os.getenv('GOOGLE_CLIENT_SECRET')
+# The client id and secret are loaded from the .env file into the app config (see __init__.py),
+# hence they do not need to be hard coded into the source code and risk possible leak if source code is exposed.
+# The OAuth client (and authlib with it) is only loaded on the first login, see oidc.py
+def _google_client():
+    from .oidc import oauth_client
+    return oauth_client(current_app)
 
-oauth = OAuth(current_app)
-google = oauth.register(
-    name='google',
-    client_id=GOOGLE_CLIENT_ID,
-    client_secret=GOOGLE_CLIENT_SECRET,
-    authorize_params=None,
-    access_token_params=None,
-    client_kwargs={'scope': 'openid profile email'},
-    redirect_uri='http://localhost:8000/login/authorized',
-    server_metadata_url= 'https://accounts.google.com/.well-known/openid-configuration',
-)
+google = LocalProxy(_google_client)
 
 @auth.route('/login')
 def login():
@@ -40,7 +30,10 @@ def login():
     session['oauth_state'] = state
     # Creates the mew authorization URL using the state parameter
     redirect_uri = url_for('auth.authorized', _external=True)
-    return google.authorize_redirect(redirect_uri, state=state)
+    response = google.authorize_redirect(redirect_uri, state=state)
+    # Fetch the signing keys while the user is at the provider
+    google.provider.prefetch_jwks()
+    return response
 
 @auth.route('/login/authorized')
 def authorized():
@@ -51,41 +44,44 @@ def authorized():
         return redirect(url_for('main.homepage'))
     
     #using authorisation flow to prevent leakage of access token
-    token = google.authorize_access_token()
-    if not token:
-        flash('Login failed.', 'error')
+    # The ID token in the response is verified locally against the provider's cached keys,
+    # and its claims are returned as token['userinfo'], so no userinfo request is needed
+    from .oidc import LOGIN_ERRORS
+    try:
+        token = google.authorize_access_token()
+    except LOGIN_ERRORS as error:
+        # Raised when the user refuses permission, or the token exchange or ID token is invalid
+        current_app.logger.warning('Login failed: %s', error)
+        token = None
+    user_info = token.pop('userinfo', None) if token else None
+    if not user_info:
+        flash('Login unsuccessful', 'error')
         return redirect(url_for('main.homepage'))
 
     session['google_token'] = token
-    userinfo_url = 'https://openidconnect.googleapis.com/v1/userinfo'
-    me = google.get(userinfo_url, token=token)
-    if me.ok:
-        user_info = me.json()
-        
-        # Save user info to the database
-        google_id = user_info.get('sub')
-        email = user_info.get('email')
-        name = user_info.get('name')
-        profile_pic = user_info.get('picture')
 
-        user = User.query.filter_by(google_id=google_id).first()
-        if user is None:
-            flash("New user time")
-            user = User(
-                google_id=google_id,
-                email=email,
-                name=name,
-                profile_pic=profile_pic
-            )
-            db.session.add(user)
-            db.session.commit()
-        session['current_user_id'] = user.id
-        flash('Login successful!', 'success')
-        return redirect(url_for('main.homepage'))  
-    else:
-        #proper error handling needs to be applied although the codes here could not catch the error when the user permission was not given
-        flash('Login unsuccessful', 'error')
-        return redirect(url_for('main.homepage'))
+    # Save user info to the database
+    google_id = user_info.get('sub')
+    profile = {
+        'email': user_info.get('email'),
+        'name': user_info.get('name'),
+        'profile_pic': user_info.get('picture'),
+    }
+
+    user = User.query.filter_by(google_id=google_id).first()
+    if user is None:
+        flash("New user time")
+        user = User(google_id=google_id, **profile)
+        db.session.add(user)
+        db.session.commit()
+    elif any(getattr(user, field) != value for field, value in profile.items()):
+        # Only write on a repeat login when the profile has actually changed
+        for field, value in profile.items():
+            setattr(user, field, value)
+        db.session.commit()
+    session['current_user_id'] = user.id
+    flash('Login successful!', 'success')
+    return redirect(url_for('main.homepage'))  
 
 
 @auth.route('/logout')
@@ -0,0 +1,150 @@
+"""Cache for rendered pages of the homepage photo grid.
+
+The grid HTML is the same for every visitor: per-user state (liked hearts),
+like counts and CSRF tokens are layered on after it comes out of the cache.
+Entries are keyed by page cursor and a catalogue *version*; uploading,
+editing or deleting a photo bumps the version, so stale pages are simply
+never looked up again and age out of the cache. Likes do not: the popular
+and trending feeds, whose order they change, are also keyed by the current
+``GRID_CACHE_RANKED_SECONDS`` interval instead.
+
+Two backends are available, chosen by ``GRID_CACHE_BACKEND``:
+
+``lru``
+    An in-process LRU bounded by entry count and total size. The version is
+    the modification time of a small file, so all workers on one host see a
+    bump immediately.
+``redis``
+    A shared Redis server at ``GRID_CACHE_URL``, for several hosts or when
+    the workers should share one copy of each page.
+
+``none`` disables caching.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+
+class LRUCache:
+    def __init__(self, version_file, max_entries=256, max_bytes=32 * 1024 * 1024):
+        self.version_file = version_file
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def version(self):
+        try:
+            return os.stat(self.version_file).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def bump_version(self):
+        os.makedirs(os.path.dirname(self.version_file), exist_ok=True)
+        with open(self.version_file, 'a'):
+            pass
+        now = time.time_ns()
+        os.utime(self.version_file, ns=(now, max(now, self.version() + 1)))
+        with self._lock:
+            # Entries of older versions can never be hit again
+            self._entries.clear()
+            self._bytes = 0
+
+
+class RedisCache:
+    def __init__(self, url, ttl=3600, prefix='photos:grid:'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("GRID_CACHE_BACKEND=redis needs the 'redis' package "
+                               "(pip install redis)")
+        self._redis = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self._redis.get(self.prefix + key)
+        return None if raw is None else json.loads(raw)
+
+    def set(self, key, value, size):
+        self._redis.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+
+    def version(self):
+        return int(self._redis.get(self.prefix + 'version') or 0)
+
+    def bump_version(self):
+        self._redis.incr(self.prefix + 'version')
+
+
+class NullCache:
+    def get(self, key):
+        return None
+
+    def set(self, key, value, size):
+        pass
+
+    def version(self):
+        return 0
+
+    def bump_version(self):
+        pass
+
+
+def init_grid_cache(app):
+    backend = app.config['GRID_CACHE_BACKEND']
+    if backend == 'lru':
+        cache = LRUCache(app.config['GRID_CACHE_VERSION_FILE'],
+                         max_entries=app.config['GRID_CACHE_MAX_ENTRIES'],
+                         max_bytes=app.config['GRID_CACHE_MAX_BYTES'])
+    elif backend == 'redis':
+        cache = RedisCache(app.config['GRID_CACHE_URL'])
+    elif backend == 'none':
+        cache = NullCache()
+    else:
+        raise ValueError('Unknown GRID_CACHE_BACKEND %r' % backend)
+    app.extensions['grid_cache'] = cache
+
+
+def grid_cache():
+    return current_app.extensions['grid_cache']
+
+
+def mark_liked(html, liked_photo_ids):
+    """Add the ``liked`` class to the tiles of liked photos in cached grid HTML."""
+    for photo_id in liked_photo_ids:
+        html = html.replace('class="image-box" data-id="%d"' % photo_id,
+                            'class="image-box liked" data-id="%d"' % photo_id, 1)
+    return html
+
+
+def fill_like_counts(html, like_counts):
+    """Write ``{photo_id: like_count}`` into the like count markers of cached grid HTML."""
+    for photo_id, like_count in like_counts.items():
+        html = html.replace('<!--likes:%d-->' % photo_id, str(like_count), 1)
+    return html
@@ -0,0 +1,129 @@
+"""Bulk import of a photo catalogue.
+
+A manifest lists one photo per row, as JSON lines or CSV with the columns
+``file``, ``name``, ``caption``, ``description`` and optionally ``user_id``.
+``file`` is a path relative to the images directory.
+
+Files are hashed, validated and copied into content-addressed storage (the
+configured backend, see storage.py) by a pool of worker processes, and rows are inserted in batches with one
+multi-row ``INSERT`` and one commit per batch. The number of manifest rows
+processed is stored in ``import_checkpoint`` in the same transaction as each
+batch, so an interrupted import resumes where it stopped when re-run.
+"""
+import csv
+import hashlib
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from flask import current_app
+from sqlalchemy import insert
+
+from . import db
+from .cache import grid_cache
+from .derivatives import generate_derivatives, image_info
+from .models import ImportCheckpoint, Photo
+from .similar import image_hash
+from .storage import CHUNK_SIZE, content_name, make_storage, storage_settings
+
+
+def read_manifest(path):
+    """Yield manifest rows as dicts, in file order."""
+    with open(path, newline='', encoding='utf-8') as manifest:
+        if path.endswith('.csv'):
+            yield from csv.DictReader(manifest)
+        else:
+            for line in manifest:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def prepare_file(job):
+    """Hash, validate and store one manifest row's file. Runs in a worker process.
+
+    Returns ``(row, error)`` where ``row`` is ready to insert into ``photo``.
+    """
+    row, images_dir, settings, derivatives = job
+    source = os.path.join(images_dir, row.get('file') or '')
+    if not row.get('file') or not os.path.isfile(source):
+        return None, 'missing file %r' % row.get('file')
+    width, height, image_format = image_info(source)
+    if width is None:
+        return None, 'not an image: %r' % row['file']
+
+    sha = hashlib.sha256()
+    with open(source, 'rb') as image:
+        for chunk in iter(lambda: image.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+    # One backend (and S3 client) per worker process
+    storage = make_storage(settings)
+    name = storage.find_content(sha.hexdigest())
+    if name is None:
+        name = content_name(sha.hexdigest(), image_format)
+        tmp = storage.temp_path()
+        shutil.copyfile(source, tmp)
+        storage.save(name, tmp)
+    if derivatives:
+        generate_derivatives(storage, name)
+
+    user_id = row.get('user_id')
+    return {
+        'name': row.get('name') or '',
+        'caption': row.get('caption') or '',
+        'description': row.get('description'),
+        'file': name,
+        'width': width,
+        'height': height,
+        'phash': image_hash(source),
+        'user_id': int(user_id) if user_id not in (None, '') else None,
+    }, None
+
+
+def import_catalogue(manifest, images_dir, batch_size=1000, workers=None,
+                     derivatives=False, report=print):
+    """Import ``manifest``, resuming after the last committed batch.
+
+    ``report`` is called with a progress line after every batch. Returns
+    ``(imported, skipped)`` for this run.
+    """
+    key = os.path.abspath(manifest)
+    checkpoint = db.session.get(ImportCheckpoint, key)
+    done = checkpoint.rows_done if checkpoint else 0
+    if done:
+        report(f'Resuming after row {done}')
+
+    settings = storage_settings(current_app.config)
+    rows = islice(read_manifest(manifest), done, None)
+    imported = skipped = 0
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            jobs = [(row, images_dir, settings, derivatives) for row in batch]
+            results = list(pool.map(prepare_file, jobs, chunksize=max(1, len(jobs) // 32)))
+            values = [row for row, _ in results if row is not None]
+            for _, error in results:
+                if error:
+                    report(f'Skipped: {error}')
+
+            done += len(batch)
+            if values:
+                db.session.execute(insert(Photo), values)
+            # Record progress in the same transaction as the rows themselves
+            db.session.merge(ImportCheckpoint(manifest=key, rows_done=done))
+            db.session.commit()
+
+            imported += len(values)
+            skipped += len(batch) - len(values)
+            elapsed = time.perf_counter() - started
+            report(f'{done} rows processed, {imported} imported '
+                   f'({imported / elapsed:.0f} rows/s)')
+    if imported:
+        # Running servers drop cached grid pages and rebuild their search suggestions
+        grid_cache().bump_version()
+    return imported, skipped
@@ -0,0 +1,128 @@
+"""Removing stored files that no photo needs any more.
+
+Deleting a photo deletes only rows: the photo and its likes, in one
+transaction that also queues a ``delete-upload`` job (see jobs.py). The job
+then removes the file and its resized copies, unless another photo still
+points at the same file (identical uploads share one). An identical upload
+touches the stored file before its photo row is committed, so a file
+modified in the last ``CLEANUP_GRACE_SECONDS`` is not removed yet: the job
+queues itself again for when that time has passed.
+
+The reconciler, :func:`reconcile_uploads`, catches whatever slipped through:
+
+- uploads stored by a request that then failed
+- files of cleanup jobs that gave up
+- resized copies whose original is gone
+- staging files left behind by interrupted uploads
+- likes of deleted photos
+
+The job workers run it every ``RECONCILE_SECONDS``; to run it at once, use
+``flask --app project uploads-reconcile``. A file is removed only once it is
+older than ``RECONCILE_GRACE_SECONDS``, so an upload whose row is not
+committed yet is left alone. Only content-addressed uploads and resized
+copies are ever removed, never other files in ``UPLOAD_DIR``. Photos whose
+file is missing are logged and counted, but not deleted.
+"""
+import logging
+import os
+import re
+import time
+from collections import namedtuple
+
+from flask import current_app
+from sqlalchemy import delete, exists, or_, select
+
+from . import db
+from .derivatives import delete_derivatives
+from .jobs import enqueue, handler
+from .models import Like, Photo
+from .storage import STAGING_DIR, get_storage, is_content_addressed
+
+logger = logging.getLogger(__name__)
+
+# derived/<stem of the original>-<width>w.webp, see derivatives.derivative_key
+_DERIVED = re.compile(r'^derived/(.+)-\d+w\.webp$')
+
+Reconciliation = namedtuple('Reconciliation',
+                            'files_removed staging_removed likes_removed missing_files')
+
+
+def _in_use(file):
+    return db.session.execute(select(Photo.id).where(Photo.file == file).limit(1)).first() is not None
+
+
+@handler('delete-upload')
+def delete_upload(file):
+    """Remove ``file`` and its resized copies unless a photo still uses it."""
+    if _in_use(file):
+        return
+    storage = get_storage()
+    grace = current_app.config['CLEANUP_GRACE_SECONDS']
+    modified = storage.modified(file)
+    if modified is not None and modified >= time.time() - grace:
+        # Possibly just re-used by an upload whose photo is not committed yet
+        enqueue('delete-upload', {'file': file}, key='delete-upload:' + file, delay=grace)
+        return
+    storage.delete(file)
+    delete_derivatives(storage, file)
+
+
+def _remove_stale_staging(scratch_dir, cutoff):
+    removed = 0
+    staging = os.path.join(scratch_dir, STAGING_DIR)
+    for entry in os.scandir(staging) if os.path.isdir(staging) else ():
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.unlink(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def reconcile_uploads(grace_seconds=None):
+    """Remove orphaned files and likes, and find photos whose file is missing."""
+    if grace_seconds is None:
+        grace_seconds = current_app.config['RECONCILE_GRACE_SECONDS']
+    cutoff = time.time() - grace_seconds
+    storage = get_storage()
+    referenced = set(db.session.scalars(select(Photo.file).distinct()))
+    stems = {os.path.splitext(file)[0] for file in referenced}
+    missing = set(referenced)
+    orphans = []
+    for key in storage.keys():
+        if key in referenced:
+            missing.discard(key)
+            continue
+        derived = _DERIVED.match(key)
+        if derived and derived.group(1) not in stems:
+            orphans.append((key, False))
+        elif not derived and is_content_addressed(key):
+            orphans.append((key, True))
+
+    files_removed = 0
+    for key, original in orphans:
+        # Re-checked, as an identical upload may have started using the file since it was listed
+        modified = storage.modified(key)
+        if modified is None or modified >= cutoff or (original and _in_use(key)):
+            continue
+        storage.delete(key)
+        files_removed += 1
+    staging_removed = _remove_stale_staging(storage.scratch_dir, cutoff)
+
+    # Deleting a photo through the ORM used to leave its likes behind, pointing nowhere
+    likes_removed = db.session.execute(
+        delete(Like).where(or_(Like.photo_id.is_(None), ~exists().where(Photo.id == Like.photo_id)))
+        .execution_options(synchronize_session=False)).rowcount
+    db.session.commit()
+    if missing:
+        logger.warning('%d stored files of photos are missing, e.g. %s',
+                       len(missing), ', '.join(sorted(missing)[:5]))
+    return Reconciliation(files_removed, staging_removed, likes_removed, len(missing))
+
+
+@handler('reconcile-uploads', every='RECONCILE_SECONDS')
+def reconcile_job():
+    result = reconcile_uploads()
+    logger.info('Reconciled uploads: %d files, %d staging files and %d likes removed, '
+                '%d files missing', *result)
@@ -0,0 +1,251 @@
+"""Flask CLI commands, run with ``flask --app project <command>``."""
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+
+@click.command('search-reindex')
+@with_appcontext
+def search_reindex_command():
+    """Create and re-populate the full-text search index."""
+    from .searchindex import ensure_search_index
+    ensure_search_index(rebuild=True)
+    click.echo('Search index rebuilt.')
+
+
+@click.command('derivatives-backfill')
+@click.option('--workers', default=4, show_default=True,
+              help='Number of images resized in parallel.')
+@click.option('--overwrite', is_flag=True,
+              help='Re-encode derivatives that already exist.')
+@with_appcontext
+def derivatives_backfill_command(workers, overwrite):
+    """Create resized copies of the file of every photo row that lacks them.
+
+    Works from the photo table, not from storage: files kept only for a
+    pending delete-upload job are left alone, and photos whose file is
+    missing are skipped and listed.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    from . import db
+    from .derivatives import generate_derivatives, image_size
+    from .models import Photo
+    from .storage import get_storage
+
+    storage = get_storage()
+    photos = db.session.query(Photo).all()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        files = sorted({photo.file for photo in photos})
+        missing = {file for file, found in zip(files, pool.map(storage.exists, files)) if not found}
+        for photo in photos:
+            if photo.width is None and photo.file not in missing:
+                with storage.open(photo.file) as image:
+                    photo.width, photo.height = image_size(image)
+        db.session.commit()
+
+        files = sorted({photo.file for photo in photos if photo.width} - missing)
+        results = pool.map(lambda file: generate_derivatives(storage, file, overwrite),
+                           files)
+        written = sum(len(widths) for widths in results)
+    click.echo(f'Wrote {written} derivatives for {len(files)} photos.')
+    if missing:
+        click.echo(f'Skipped {len(missing)} files that are missing from storage: '
+                   + ', '.join(sorted(missing)[:10]) + (', ...' if len(missing) > 10 else ''))
+
+
+@click.command('phash-backfill')
+@click.option('--workers', default=4, show_default=True,
+              help='Number of images hashed in parallel.')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='Files hashed per transaction.')
+@with_appcontext
+def phash_backfill_command(workers, batch_size):
+    """Compute the perceptual hash of every photo that lacks one."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    from sqlalchemy import update
+
+    from . import db
+    from .cache import grid_cache
+    from .models import Photo
+    from .similar import image_hash
+    from .storage import get_storage
+
+    storage = get_storage()
+
+    def hash_file(file):
+        if not storage.exists(file):
+            return None
+        with storage.open(file) as image:
+            return image_hash(image)
+
+    # Photos sharing a stored file share its hash, so each file is read once
+    files = db.session.scalars(db.select(Photo.file).distinct()
+                               .where(Photo.phash.is_(None), Photo.width.is_not(None))
+                               .order_by(Photo.file)).all()
+    hashed = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for start in range(0, len(files), batch_size):
+            batch = files[start:start + batch_size]
+            for file, phash in zip(batch, pool.map(hash_file, batch)):
+                if phash is not None:
+                    db.session.execute(update(Photo).where(Photo.file == file)
+                                       .values(phash=phash))
+                    hashed += 1
+            db.session.commit()
+            click.echo(f'{start + len(batch)} of {len(files)} files processed')
+    if hashed:
+        # Running servers reload their hashes
+        grid_cache().bump_version()
+    click.echo(f'Hashed {hashed} files.')
+
+
+@click.command('trending-rebuild')
+@with_appcontext
+def trending_rebuild_command():
+    """Recompute the trending score of every photo from its likes."""
+    from .cache import grid_cache
+    from .trending import rebuild_scores
+    scored = rebuild_scores()
+    grid_cache().bump_version()
+    click.echo(f'Rebuilt trending scores of {scored} liked photos.')
+
+
+@click.command('db-upgrade')
+@with_appcontext
+def db_upgrade_command():
+    """Apply pending schema migrations to the database."""
+    from .migrations import upgrade
+    applied = upgrade()
+    for migration_id in applied:
+        click.echo(f'Applied {migration_id}')
+    if not applied:
+        click.echo('Database is up to date.')
+
+
+@click.command('db-status')
+@with_appcontext
+def db_status_command():
+    """List schema migrations and whether they have been applied."""
+    from .migrations import status
+    for migration_id, applied in status():
+        click.echo(f"{'applied' if applied else 'pending'}  {migration_id}")
+
+
+@click.command('import-catalogue')
+@click.argument('manifest', type=click.Path(exists=True, dir_okay=False))
+@click.option('--images', 'images_dir', required=True,
+              type=click.Path(exists=True, file_okay=False),
+              help='Directory the manifest file paths are relative to.')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='Rows inserted per transaction.')
+@click.option('--workers', type=int, default=None,
+              help='Processes hashing and copying files [default: CPU count].')
+@click.option('--derivatives', is_flag=True,
+              help='Also create resized copies while importing.')
+@with_appcontext
+def import_catalogue_command(manifest, images_dir, batch_size, workers, derivatives):
+    """Bulk import photos listed in a JSONL or CSV MANIFEST.
+
+    Re-running the command after an interruption resumes from the last
+    committed batch.
+    """
+    from .catalogue import import_catalogue
+    imported, skipped = import_catalogue(manifest, images_dir, batch_size=batch_size, workers=workers,
+                                         derivatives=derivatives, report=click.echo)
+    click.echo(f'Done: {imported} imported, {skipped} skipped.')
+
+
+@click.command('storage-migrate')
+@click.option('--from-dir', type=click.Path(exists=True, file_okay=False),
+              help='Directory holding the flat uploads [default: UPLOAD_DIR].')
+@click.option('--keep', is_flag=True, help='Leave the source files in place.')
+@with_appcontext
+def storage_migrate_command(from_dir, keep):
+    """Move uploads from the old flat directory into the configured storage backend.
+
+    Safe to re-run; files already migrated are skipped. Until it has run,
+    the local backend still serves files from their flat location.
+    """
+    from .storage import get_storage, migrate_uploads
+    copied, skipped = migrate_uploads(from_dir or current_app.config['UPLOAD_DIR'],
+                                      get_storage(), keep=keep, report=click.echo)
+    click.echo(f'Done: {copied} files migrated, {skipped} already in place.')
+
+
+@click.command('jobs-worker')
+@click.option('--threads', default=4, show_default=True,
+              help='Jobs run in parallel.')
+@click.option('--drain', is_flag=True,
+              help='Run the jobs that are due, one at a time, then exit.')
+@with_appcontext
+def jobs_worker_command(threads, drain):
+    """Run background jobs until interrupted.
+
+    Use with JOB_WORKERS=0, so the web processes only queue jobs.
+    """
+    import time
+
+    from .jobs import run_jobs
+
+    if drain:
+        click.echo(f'Ran {run_jobs()} jobs.')
+        return
+    pool = current_app.extensions['jobs']
+    pool.threads = threads
+    pool.start()
+    click.echo(f'Running jobs with {threads} threads; press Ctrl+C to stop.')
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        click.echo('Stopping once the running jobs finish...')
+        pool.stop()
+
+
+@click.command('jobs-status')
+@with_appcontext
+def jobs_status_command():
+    """Count queued, running and failed jobs, and show the latest failures."""
+    from . import db
+    from .jobs import job_counts
+    from .models import Job
+
+    counts = job_counts()
+    for status in ('queued', 'running', 'failed'):
+        click.echo(f'{status:8} {counts.get(status, 0)}')
+    failed = db.session.scalars(db.select(Job).where(Job.status == 'failed')
+                                .order_by(Job.id.desc()).limit(10))
+    for job in failed:
+        error = (job.last_error or '').strip().splitlines()
+        click.echo(f'#{job.id} {job.kind} {job.payload}: {error[-1] if error else ""}')
+
+
+@click.command('uploads-reconcile')
+@click.option('--grace', type=int, default=None,
+              help='Seconds an unused file is kept [default: RECONCILE_GRACE_SECONDS].')
+@with_appcontext
+def uploads_reconcile_command(grace):
+    """Remove stored files and likes that no photo needs, and count missing files."""
+    from .cleanup import reconcile_uploads
+    result = reconcile_uploads(grace)
+    click.echo(f'Removed {result.files_removed} orphaned files, {result.staging_removed} '
+               f'staging files and {result.likes_removed} likes.')
+    if result.missing_files:
+        click.echo(f'{result.missing_files} photos point at missing files; see the log.')
+
+
+def register_commands(app):
+    app.cli.add_command(search_reindex_command)
+    app.cli.add_command(derivatives_backfill_command)
+    app.cli.add_command(phash_backfill_command)
+    app.cli.add_command(trending_rebuild_command)
+    app.cli.add_command(db_upgrade_command)
+    app.cli.add_command(db_status_command)
+    app.cli.add_command(import_catalogue_command)
+    app.cli.add_command(storage_migrate_command)
+    app.cli.add_command(jobs_worker_command)
+    app.cli.add_command(jobs_status_command)
+    app.cli.add_command(uploads_reconcile_command)
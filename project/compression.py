@@ -0,0 +1,72 @@
+"""Compression of HTML, JSON and other text responses.
+
+A page of grid tiles is mostly repeated markup and shrinks about tenfold.
+Responses are compressed with brotli when the client accepts it and the
+optional ``brotli`` package is installed, and with gzip otherwise.
+
+Left alone: bodies under ``COMPRESS_MIN_BYTES``, streamed responses and
+files sent with ``send_file`` (uploads are images, which are compressed
+already), partial and empty responses, and anything that already has a
+``Content-Encoding``. Set ``COMPRESSION=0`` when a front proxy compresses
+responses instead.
+"""
+import gzip
+from functools import cache
+
+from flask import current_app, request
+
+COMPRESSIBLE = {
+    'application/javascript', 'application/json', 'image/svg+xml',
+    'text/css', 'text/html', 'text/javascript', 'text/plain',
+}
+
+
+@cache
+def _brotli():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def choose_encoding(accept_encodings):
+    """The encoding to use for a client sending ``accept_encodings``, or None."""
+    if accept_encodings['br'] and _brotli() is not None:
+        return 'br'
+    if accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress(data, encoding, config):
+    if encoding == 'br':
+        return _brotli().compress(data, quality=config['BROTLI_QUALITY'])
+    return gzip.compress(data, compresslevel=config['GZIP_LEVEL'], mtime=0)
+
+
+def compress_response(response):
+    config = current_app.config
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code in (204, 206, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE
+            or (response.content_length or 0) < config['COMPRESS_MIN_BYTES']):
+        return response
+    # Caches must keep the compressed and plain variants apart
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+    response.set_data(compress(response.get_data(), encoding, config))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        # The bytes differ from the uncompressed variant's
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_compression(app):
+    if app.config['COMPRESSION']:
+        app.after_request(compress_response)
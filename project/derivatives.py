@@ -0,0 +1,115 @@
+"""Resized WebP variants ("derivatives") of uploaded photos.
+
+Grid tiles are only a few hundred pixels wide, so instead of the original
+upload the templates point a ``srcset`` at smaller re-encoded copies. For an
+upload ``photo.jpg`` they are stored under the keys ``derived/photo-320w.webp``
+etc. of the storage backend (see storage.py). Only widths smaller than the
+original are produced.
+
+Encoding is a ``derivatives`` job on the background queue (see jobs.py), so
+uploads return immediately; Pillow releases the GIL while resizing and
+encoding, so the worker threads do not hold up requests either. The same job
+records the upload's perceptual hash first (see similar.py).
+"""
+import logging
+import os
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from .jobs import handler
+from .similar import hash_stored_file
+from .storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+WIDTHS = (320, 640, 1280)
+WEBP_QUALITY = 80
+EXIF_ORIENTATION = 0x0112
+
+
+def derivative_name(file, width):
+    stem = os.path.splitext(file)[0]
+    return f'{stem}-{width}w.webp'
+
+
+def derivative_key(file, width):
+    """Storage key of the ``width`` pixel wide copy of ``file``."""
+    return 'derived/' + derivative_name(file, width)
+
+
+def derivative_widths(photo_width):
+    """Widths that are worth generating for an image ``photo_width`` pixels wide."""
+    if not photo_width:
+        return ()
+    return tuple(width for width in WIDTHS if width < photo_width)
+
+
+def image_info(path):
+    """Return ``(width, height, format)`` of an image, or ``(None, None, None)`` if it isn't one.
+
+    ``path`` may also be a seekable binary file. ``format`` is Pillow's name
+    for it, e.g. ``'JPEG'``.
+
+    Only the image header is read, so this is cheap enough to call inline.
+    """
+    try:
+        with Image.open(path) as image:
+            width, height = image.size
+            # getexif() on a PNG decodes every pixel to look for an eXIf chunk after them,
+            # so only a chunk before the pixels (already read with the header) is looked at
+            exif = image.getexif() if image.format != 'PNG' or 'exif' in image.info else {}
+            # Browsers honour the EXIF orientation, so report the size as displayed
+            if exif.get(EXIF_ORIENTATION) in (5, 6, 7, 8):
+                return height, width, image.format
+            return width, height, image.format
+    # Pillow refuses images claiming more than twice Image.MAX_IMAGE_PIXELS; they are kept as plain files
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        return None, None, None
+
+
+def image_size(path):
+    """Return ``(width, height)`` of an image, or ``(None, None)`` if it isn't one."""
+    return image_info(path)[:2]
+
+
+def generate_derivatives(storage, file, overwrite=False):
+    """Write every missing derivative of ``file``; return the widths written."""
+    try:
+        with storage.open(file) as original, Image.open(original) as source:
+            source = ImageOps.exif_transpose(source)
+            if source.mode not in ('RGB', 'RGBA'):
+                source = source.convert('RGBA' if 'A' in source.getbands() else 'RGB')
+            written = []
+            # Resize from the largest width down, reusing each result as the next source
+            for width in sorted(derivative_widths(source.width), reverse=True):
+                key = derivative_key(file, width)
+                if not overwrite and storage.exists(key):
+                    continue
+                height = round(source.height * width / source.width)
+                resized = source.resize((width, height), Image.LANCZOS)
+                # Encode to a staging file so readers never see a half-written derivative
+                tmp = storage.temp_path('.webp')
+                try:
+                    resized.save(tmp, 'WEBP', quality=WEBP_QUALITY, method=4)
+                except OSError:
+                    os.unlink(tmp)
+                    raise
+                storage.save(key, tmp, overwrite=True)
+                written.append(width)
+                source = resized
+            return written
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        logger.warning('Could not create derivatives for %s', file, exc_info=True)
+        return []
+
+
+def delete_derivatives(storage, file):
+    for width in WIDTHS:
+        storage.delete(derivative_key(file, width))
+
+
+@handler('derivatives')
+def derivatives_job(file):
+    # Hashed first, as the uploader's duplicate warning waits for it
+    hash_stored_file(file)
+    generate_derivatives(get_storage(), file)
@@ -0,0 +1,48 @@
+"""Health checks for load balancers and process supervisors.
+
+``/healthz``
+    Liveness: the worker is running and can answer a request. It touches
+    nothing else, so a slow database never gets a healthy worker restarted.
+``/readyz``
+    Readiness: the worker can serve real traffic, i.e. the database answers
+    and ``UPLOAD_DIR`` is writable. Returns 503 with the failing checks
+    otherwise, so the load balancer routes around the instance.
+
+Both are cheap enough to poll every second.
+"""
+import os
+
+from flask import Blueprint, current_app, jsonify
+from sqlalchemy import text
+
+from . import db
+
+health = Blueprint('health', __name__)
+
+
+@health.route('/healthz')
+def healthz():
+    return jsonify(status='ok')
+
+
+def _check_database():
+    db.session.execute(text('SELECT 1'))
+
+
+def _check_uploads():
+    if not os.access(current_app.config['UPLOAD_DIR'], os.W_OK):
+        raise OSError('UPLOAD_DIR is not writable')
+
+
+@health.route('/readyz')
+def readyz():
+    checks = {}
+    for name, check in (('database', _check_database), ('uploads', _check_uploads)):
+        try:
+            check()
+            checks[name] = 'ok'
+        except Exception as error:
+            current_app.logger.warning('Readiness check %s failed: %s', name, error)
+            checks[name] = 'failed'
+    ready = all(result == 'ok' for result in checks.values())
+    return jsonify(status='ok' if ready else 'unavailable', checks=checks), 200 if ready else 503
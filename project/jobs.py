@@ -0,0 +1,272 @@
+"""A persistent queue of background jobs.
+
+Work that should not hold up a request, such as removing the files of a
+deleted photo or resizing an upload, is written to the ``job`` table and run
+by a pool of worker threads. Because jobs are rows, :func:`enqueue` is part
+of the caller's transaction: a photo's row and the job that cleans up after
+it are committed together or not at all, and queued jobs survive restarts.
+No broker is needed.
+
+Jobs run at least once. A job that raises is retried with exponential
+backoff (``JOB_RETRY_SECONDS``, doubling with each attempt) until it has
+been tried ``max_attempts`` times, and is then kept in the table as
+``failed``. A job whose worker died is run again when its lease
+(``JOB_LEASE_SECONDS``) runs out. Handlers must therefore be safe to run
+twice. An idempotency ``key`` keeps duplicates out of the queue: while a job
+with that key is waiting to run, queueing another one does nothing.
+
+Each web process runs ``JOB_WORKERS`` threads. They are started with the
+gunicorn worker (see ``gunicorn.conf.py``) or when the process first queues
+a job, and are woken as soon as one is committed. Jobs queued by other
+processes are picked up within ``JOB_POLL_SECONDS``. Set ``JOB_WORKERS=0``
+to run jobs only in a separate ``flask --app project jobs-worker`` process.
+
+Handlers are registered with :func:`handler` and receive the payload as
+keyword arguments. A handler registered with ``every`` also keeps one run of
+itself queued, that many seconds (a config setting) after the last started.
+"""
+import logging
+import threading
+import traceback
+from datetime import timedelta
+from functools import cache
+from importlib import import_module
+
+from flask import current_app, has_app_context
+from sqlalchemy import and_, delete, event, func, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from . import db
+from .models import Job, utcnow
+
+logger = logging.getLogger(__name__)
+
+HANDLERS = {}
+# kind: name of the config setting with the seconds between runs
+PERIODIC = {}
+# Modules whose handlers are registered when they are imported
+HANDLER_MODULES = ('.cleanup', '.derivatives')
+# Longest wait before a retry, however many attempts failed
+MAX_RETRY_SECONDS = 3600
+# Characters of a traceback kept in Job.last_error
+MAX_ERROR = 4000
+
+
+def handler(kind, every=None):
+    """Register the decorated function as the handler of jobs of ``kind``."""
+    def register(function):
+        HANDLERS[kind] = function
+        if every:
+            PERIODIC[kind] = every
+        return function
+    return register
+
+
+@cache
+def _load_handlers():
+    for module in HANDLER_MODULES:
+        import_module(module, __package__)
+
+
+def enqueue(kind, payload=None, key=None, delay=0, max_attempts=5):
+    """Queue a job in the current transaction; workers see it once that commits.
+
+    Returns False if a job with the same ``key`` is already waiting.
+    """
+    values = {'kind': kind, 'payload': payload or {}, 'key': key, 'max_attempts': max_attempts,
+              'run_at': utcnow() + timedelta(seconds=delay)}
+    dialect = db.session.get_bind().dialect.name
+    if key is None:
+        db.session.execute(insert(Job).values(values))
+        added = True
+    elif dialect in ('sqlite', 'postgresql'):
+        dialect_insert = import_module('sqlalchemy.dialects.' + dialect).insert
+        added = db.session.execute(dialect_insert(Job).values(values)
+                                   .on_conflict_do_nothing(index_elements=['key'])).rowcount == 1
+    else:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(insert(Job).values(values))
+            added = True
+        except IntegrityError:
+            added = False
+    if added:
+        db.session.info['jobs_queued'] = True
+    return added
+
+
+def schedule_periodic():
+    """Queue the first run of every periodic job that isn't queued already, and commit."""
+    _load_handlers()
+    for kind, setting in PERIODIC.items():
+        if current_app.config[setting] > 0:
+            enqueue(kind, key=kind, delay=current_app.config[setting])
+    db.session.commit()
+
+
+def _claim():
+    """Mark the next due job as running and return it, or None if there is none."""
+    now = utcnow()
+    due = or_(and_(Job.status == 'queued', Job.run_at <= now),
+              and_(Job.status == 'running', Job.locked_until < now))
+    while True:
+        # Idle workers poll with this plain read, so on SQLite they do not take the write lock
+        job_id = db.session.scalar(select(Job.id).where(due).order_by(Job.run_at, Job.id).limit(1)
+                                   # Workers on PostgreSQL skip rows another one is claiming
+                                   .with_for_update(skip_locked=True))
+        if job_id is None:
+            db.session.rollback()
+            return None
+        # Claimed only if still due. The key is released so that the same work can be queued
+        # again while this run is under way
+        job = db.session.execute(
+            update(Job).where(Job.id == job_id, due)
+            .values(status='running', key=None, attempts=Job.attempts + 1,
+                    locked_until=now + timedelta(seconds=current_app.config['JOB_LEASE_SECONDS']))
+            .returning(Job.id, Job.kind, Job.payload, Job.attempts, Job.max_attempts)
+            .execution_options(synchronize_session=False)).first()
+        if job is not None:
+            break
+        # Another worker claimed it between the read and the update
+        db.session.commit()
+    if job.kind in PERIODIC:
+        interval = current_app.config[PERIODIC[job.kind]]
+        if interval > 0:
+            enqueue(job.kind, key=job.kind, delay=interval)
+    db.session.commit()
+    return job
+
+
+def _failed(job, error):
+    if job.attempts >= job.max_attempts:
+        logger.error('Job %d (%s) failed after %d attempts:\n%s', job.id, job.kind, job.attempts, error)
+        values = {'status': 'failed'}
+    else:
+        delay = min(current_app.config['JOB_RETRY_SECONDS'] * 2 ** (job.attempts - 1),
+                    MAX_RETRY_SECONDS)
+        logger.warning('Job %d (%s) failed, retrying in %ds:\n%s', job.id, job.kind, delay, error)
+        values = {'status': 'queued', 'run_at': utcnow() + timedelta(seconds=delay)}
+    db.session.execute(update(Job).where(Job.id == job.id)
+                       .values(locked_until=None, last_error=error[-MAX_ERROR:], **values)
+                       .execution_options(synchronize_session=False))
+    db.session.commit()
+
+
+def run_next():
+    """Run the next due job, if any, in the calling thread; return whether one ran."""
+    _load_handlers()
+    job = _claim()
+    if job is None:
+        return False
+    try:
+        HANDLERS[job.kind](**job.payload)
+        # Whatever the handler left uncommitted is committed with the job's removal
+        db.session.execute(delete(Job).where(Job.id == job.id))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        _failed(job, traceback.format_exc())
+    return True
+
+
+def run_jobs(limit=None):
+    """Run due jobs until there are none left (or ``limit`` ran); return how many ran."""
+    ran = 0
+    while (limit is None or ran < limit) and run_next():
+        ran += 1
+    return ran
+
+
+def job_counts():
+    """``{status: number of jobs}``."""
+    return dict(db.session.execute(select(Job.status, func.count()).group_by(Job.status)).all())
+
+
+class WorkerPool:
+    """Threads running due jobs for one app, in the current process."""
+
+    def __init__(self, app, threads, poll_seconds):
+        self.app = app
+        self.threads = threads
+        self.poll_seconds = poll_seconds
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._workers = []
+
+    @property
+    def running(self):
+        return bool(self._workers)
+
+    def start(self):
+        with self._lock:
+            if self._workers:
+                return
+            self._stop.clear()
+            for number in range(self.threads):
+                worker = threading.Thread(target=self._run, name='jobs-%d' % number, daemon=True)
+                worker.start()
+                self._workers.append(worker)
+        with self.app.app_context():
+            schedule_periodic()
+
+    def notify(self):
+        """Wake idle workers, e.g. because a job was just committed."""
+        self._wake.set()
+
+    def stop(self, timeout=None):
+        """Stop the workers once their current jobs finish."""
+        self._stop.set()
+        self._wake.set()
+        with self._lock:
+            for worker in self._workers:
+                worker.join(timeout)
+            self._workers = []
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    ran = run_next()
+            except Exception:
+                # e.g. the database is unreachable; the job, if one was claimed, is retried later
+                logger.exception('Job worker error')
+                ran = False
+            if not ran:
+                self._wake.wait(self.poll_seconds)
+                self._wake.clear()
+
+
+def start_workers(app):
+    """Start the app's job workers in this process, unless ``JOB_WORKERS`` is 0."""
+    if app.config['JOB_WORKERS'] > 0:
+        app.extensions['jobs'].start()
+
+
+# Wake this process's workers when a transaction that queued jobs commits
+
+def _after_commit(session):
+    if not session.info.pop('jobs_queued', False) or not has_app_context():
+        return
+    app = current_app._get_current_object()
+    pool = app.extensions.get('jobs')
+    if pool is None:
+        return
+    if not pool.running and app.config['JOB_WORKERS'] > 0:
+        # Started from another thread: start() schedules the periodic jobs in a new session
+        threading.Thread(target=pool.start, daemon=True).start()
+    pool.notify()
+
+
+def _after_rollback(session):
+    session.info.pop('jobs_queued', None)
+
+
+event.listen(Session, 'after_commit', _after_commit)
+event.listen(Session, 'after_soft_rollback', lambda session, previous: _after_rollback(session))
+
+
+def init_jobs(app):
+    app.extensions['jobs'] = WorkerPool(app, app.config['JOB_WORKERS'],
+                                        app.config['JOB_POLL_SECONDS'])
@@ -0,0 +1,79 @@
+"""Liking and unliking photos.
+
+A user likes a photo at most once, enforced by a unique index on
+``(user_id, photo_id)``. Toggling is done with one conditional ``DELETE``
+and, if nothing was deleted, one ``INSERT ... ON CONFLICT DO NOTHING``, so two
+concurrent clicks can never create duplicate likes. ``Photo.like_count`` is
+adjusted by the number of rows actually changed, in the same transaction,
+and so is ``Photo.trend_score`` (see trending.py), so the popular and trending
+feeds never have to count likes.
+"""
+from importlib import import_module
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from . import db
+from .models import Like, Photo, utcnow
+from .trending import apply_like
+
+
+def _insert_like(user_id, photo_id, created_at):
+    """Insert a like unless it already exists; return the number of rows added."""
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        # Only the dialect in use is imported (the engine already loaded it)
+        dialect_insert = import_module('sqlalchemy.dialects.' + dialect).insert
+        statement = (dialect_insert(Like)
+                     .values(user_id=user_id, photo_id=photo_id, created_at=created_at)
+                     .on_conflict_do_nothing(index_elements=['user_id', 'photo_id']))
+        return db.session.execute(statement).rowcount
+    # Other databases: let the unique index reject a concurrent duplicate
+    try:
+        with db.session.begin_nested():
+            db.session.execute(insert(Like).values(user_id=user_id, photo_id=photo_id,
+                                                   created_at=created_at))
+        return 1
+    except IntegrityError:
+        return 0
+
+
+def _delete_like(user_id, photo_id):
+    """Delete a like if it exists; return the creation times of the rows removed."""
+    statement = delete(Like).where(Like.user_id == user_id, Like.photo_id == photo_id)
+    if db.session.get_bind().dialect.delete_returning:
+        return db.session.scalars(statement.returning(Like.created_at)
+                                  .execution_options(synchronize_session=False)).all()
+    created = db.session.scalars(select(Like.created_at).where(Like.user_id == user_id,
+                                                               Like.photo_id == photo_id)).all()
+    return created[:db.session.execute(statement).rowcount]
+
+
+def toggle_like(user_id, photo_id):
+    """Like or unlike a photo for a user and commit.
+
+    Returns ``(liked, like_count)`` after the change, or ``None`` if the photo
+    does not exist.
+    """
+    if db.session.execute(select(Photo.id).where(Photo.id == photo_id)).first() is None:
+        return None
+
+    removed = _delete_like(user_id, photo_id)
+    if removed:
+        liked, delta, created_at = False, -len(removed), removed[0]
+    else:
+        created_at = utcnow()
+        liked, delta = True, _insert_like(user_id, photo_id, created_at)
+
+    if delta:
+        db.session.execute(update(Photo)
+                           .where(Photo.id == photo_id)
+                           .values(like_count=Photo.like_count + delta)
+                           .execution_options(synchronize_session=False))
+    like_count = db.session.execute(
+        select(Photo.like_count).where(Photo.id == photo_id)
+    ).scalar_one()
+    if delta:
+        apply_like(photo_id, created_at, liked, like_count)
+    db.session.commit()
+    return liked, like_count
@@ -1,45 +1,229 @@
 from flask import (
   Blueprint, render_template, request, 
-  flash, redirect, url_for, send_from_directory, session, jsonify, 
-  current_app, make_response
+  flash, redirect, url_for, send_file, session, jsonify, 
+  current_app, make_response, abort
 )
+from markupsafe import Markup
 import logging
-from authlib.integrations.flask_client import OAuth
+import mimetypes
 from .models import Like, Photo
-from sqlalchemy import asc, text
+from sqlalchemy import asc, delete, select, text
+from sqlalchemy.exc import SQLAlchemyError
 from . import db
+from .pagination import cursor_values, encode_cursor, keyset_page
+from .cache import fill_like_counts, grid_cache, mark_liked
+from .metrics import record_upload
+from . import likes
+from .storage import content_digest, get_storage, is_content_addressed, ingest_upload
+from .derivatives import derivative_key, derivative_widths, image_info
+from .jobs import enqueue
 from .models import User
+from .similar import hash_index, similar_photos
 import os
-from dotenv import load_dotenv
-load_dotenv()
+import time
 
 main = Blueprint('main', __name__)
+logger = logging.getLogger(__name__)
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+# Uploads per session still waiting for their duplicate check
+MAX_DUPLICATE_CHECKS = 5
+# Templates use this to list the resized copies available for a photo in srcset
+main.add_app_template_global(derivative_widths)
 
-# This is called when the home page is rendered. It fetches all images sorted by filename.
-@main.route('/')
-def homepage():
-  photos = db.session.query(Photo).order_by(asc(Photo.file))
+# Photos are shown one page at a time, sorted by filename.
+# The sort key is (file, id) so every photo has a unique position, and Photo.file is indexed
+# so each page only reads page-size rows no matter how large the catalogue is.
+PHOTO_ORDER = [(Photo.file, False), (Photo.id, False)]
+
+# The feeds: (endpoint, sort key, key of a photo) for each.
+# 'popular' is most liked first and 'trending' most liked recently first (see trending.py).
+# Their sort keys are indexed and updated on every like, so a page costs the same however many likes there are.
+FEEDS = {
+  'files': ('main.homepage', PHOTO_ORDER, lambda photo: (photo.file, photo.id)),
+  'popular': ('main.popular', [(Photo.like_count, True), (Photo.id, True)],
+              lambda photo: (photo.like_count, photo.id)),
+  'trending': ('main.trending', [(Photo.trend_score, True), (Photo.id, True)],
+               lambda photo: (photo.trend_score, photo.id)),
+}
+main.add_app_template_global({feed: endpoint for feed, (endpoint, _, _) in FEEDS.items()},
+                             'feed_endpoints')
+# Feeds whose order changes with every like
+RANKED_FEEDS = ('popular', 'trending')
+
+def liked_photo_ids_for(photo_ids):
   # Task 8 & 9: Feature 2
   # List is empty first, as for an unauthenticated user, none of the posts will be liked 
   liked_photo_ids = []
   # Only if the current user is an authenticated user
-  if 'current_user_id' in session:
-    # Query the Like table to get a Tuple of photo_ids of the photos that the current logged in user has liked
+  if 'current_user_id' in session and photo_ids:
+    # Query the Like table to get the photo_ids on this page that the current logged in user has liked
     # Parameterised Queries: SQLAlchemy ORM being used -> converts Python code to SQL statements through parameterized queries
       # Hence, any input from the client side is treated as data, rather than executable SQL code
       # Preventing SQL injections.
-    liked_photo_ids_query = db.session.query(Like.photo_id).filter_by(user_id=session['current_user_id']).all()
+    liked_photo_ids_query = (db.session.query(Like.photo_id)
+                             .filter(Like.user_id == session['current_user_id'],
+                                     Like.photo_id.in_(photo_ids))
+                             .all())
     # Extract photo IDs from the query result
     liked_photo_ids = [photo_id[0] for photo_id in liked_photo_ids_query]
-  # When all the photos from the database will be rendered
+  return liked_photo_ids
+
+# Marker value for tile_urls(); it never occurs in a real URL
+URL_MARKER = 2147480047
+
+def tile_urls():
+  # The links of a tile, built once per render and split around the marker,
+  # e.g. ['/photo/', '/edit/'] for the edit link. The template joins in each photo's values.
+  marker = str(URL_MARKER)
+  return {
+    'upload': url_for('main.display_file', name=marker).split(marker),
+    # Same prefix as 'upload'
+    'derived': url_for('main.display_derivative', name=marker, width=URL_MARKER).split(marker),
+    'edit': url_for('main.editPhoto', photo_id=URL_MARKER).split(marker),
+    'icons': url_for('static', filename='icons/'),
+  }
+
+def render_tiles(photos):
+  # The tiles hold no per-user state or CSRF tokens, so the same HTML can be served to everyone
+  return render_template('partials/photo_tiles.html', photos=photos, urls=tile_urls())
+
+def like_counts_for(photo_ids):
+  # One primary key lookup per page, so liking a photo never has to invalidate the cached grid
+  if not photo_ids:
+    return {}
+  return dict(db.session.execute(select(Photo.id, Photo.like_count).where(Photo.id.in_(photo_ids))).all())
+
+def user_grid(html, photo_ids):
+  # Layers the current like counts and the current user's liked hearts onto shared grid HTML
   # The photos that the current user has liked will have a red heart icon
   # The photos that the current user has not liked will have a white heart icon
-  return render_template('index.html', photos=photos, liked_photo_ids=liked_photo_ids)
+  html = fill_like_counts(html, like_counts_for(photo_ids))
+  return Markup(mark_liked(html, liked_photo_ids_for(photo_ids)))
+
+def photo_page(after, feed='files'):
+  # Rendered pages of the grid are cached per feed, cursor and catalogue version,
+  # so repeat visits skip both the database and template rendering.
+  # The popular and trending feeds are re-sorted every GRID_CACHE_RANKED_SECONDS as likes come in.
+  cache = grid_cache()
+  _, order, sort_key = FEEDS[feed]
+  # Keyed by the decoded cursor, so junk cursors all share the first page's entry
+  values = cursor_values(after, order)
+  after = encode_cursor(values) if values is not None else None
+  key = '%s:%s:%s' % (cache.version(), feed, after or '')
+  cached = True
+  if feed in RANKED_FEEDS:
+    ranked_seconds = current_app.config['GRID_CACHE_RANKED_SECONDS']
+    cached = ranked_seconds > 0
+    if cached:
+      key += ':%d' % (time.time() // ranked_seconds)
+  page = cache.get(key) if cached else None
+  if page is None:
+    photos, next_cursor = keyset_page(db.session.query(Photo), order,
+                                      key=sort_key,
+                                      after=after,
+                                      per_page=current_app.config['PHOTOS_PER_PAGE'])
+    page = {'html': render_tiles(photos),
+            'photo_ids': [photo.id for photo in photos],
+            'next_cursor': next_cursor}
+    if cached:
+      cache.set(key, page, size=len(page['html']))
+  return user_grid(page['html'], page['photo_ids']), page['next_cursor']
 
+# Called after every commit that adds, edits or deletes photos (likes are layered on per request instead)
+def catalogue_changed():
+  grid_cache().bump_version()
+
+# This is called when the home page is rendered. It fetches the first page of images sorted by filename,
+# or the page after the `after` cursor.
+@main.route('/')
+def homepage():
+  return feed_page('files')
+
+# Most liked photos first
+@main.route('/popular')
+def popular():
+  return feed_page('popular')
+
+# Photos with the most recent likes first; a like's weight halves every TRENDING_HALF_LIFE_HOURS
+@main.route('/trending')
+def trending():
+  return feed_page('trending')
+
+def feed_page(feed):
+  warn_about_hashed_uploads()
+  grid, next_cursor = photo_page(request.args.get('after'), feed)
+  return render_template('index.html', grid=grid, next_cursor=next_cursor, feed=feed)
+
+# Returns just the tiles of the next page, for the "Load more" link and infinite scrolling.
+@main.route('/photos')
+def photo_fragment():
+  feed = request.args.get('feed', 'files')
+  if feed not in FEEDS:
+    abort(404)
+  grid, next_cursor = photo_page(request.args.get('after'), feed)
+  return render_template('partials/photo_page.html', grid=grid, next_cursor=next_cursor, feed=feed)
+
+
+# Sends an upload with caching headers.
+# Content-addressed files never change, so they are cached for a year as immutable, with the hash as a strong ETag.
+# Conditional requests (If-None-Match -> 304) and Range requests are answered by send_file.
+# With UPLOAD_ACCEL_PREFIX set, a front proxy such as nginx serves the bytes via X-Accel-Redirect instead of Python;
+# USE_X_SENDFILE does the same for Apache/lighttpd.
+# Files in a remote bucket (STORAGE_BACKEND=s3) are not proxied: the client is redirected to them.
+def send_upload(key, immutable_etag=None):
+  storage = get_storage()
+  immutable = immutable_etag is not None
+  etag = immutable_etag if immutable else True
+  max_age = IMMUTABLE_MAX_AGE if immutable else current_app.config['UPLOAD_MAX_AGE']
+  url = storage.url(key)
+  if url is not None:
+    response = redirect(url)
+    # Presigned URLs expire, so a redirect to one must not be cached for longer
+    if not storage.public_url:
+      max_age = min(max_age, storage.url_expiry // 2)
+    response.cache_control.max_age = max_age
+    response.cache_control.public = True
+    return response
+
+  path = storage.locate(key)
+  if path is None:
+    abort(404)
+  accel_prefix = current_app.config['UPLOAD_ACCEL_PREFIX']
+  if accel_prefix:
+    relative = os.path.relpath(path, storage.root)
+    response = current_app.response_class(mimetype=mimetypes.guess_type(key)[0] or 'application/octet-stream')
+    response.headers['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + relative.replace(os.sep, '/')
+    if immutable:
+      response.set_etag(etag)
+    else:
+      response.last_modified = os.path.getmtime(path)
+    response.cache_control.max_age = max_age
+    response.make_conditional(request)
+  else:
+    response = send_file(path, etag=etag, max_age=max_age, conditional=True)
+  response.cache_control.public = True
+  if immutable:
+    response.cache_control.immutable = True
+  return response
 
 @main.route('/uploads/<name>')
 def display_file(name):
-  return send_from_directory(current_app.config["UPLOAD_DIR"], name)
+  etag = content_digest(name) if is_content_addressed(name) else None
+  return send_upload(name, etag)
+
+# Serves a resized WebP copy of an upload for srcset.
+# Until the background worker has produced it, the original is served instead.
+@main.route('/uploads/<name>/w<int:width>')
+def display_derivative(name, width):
+  key = derivative_key(name, width)
+  if get_storage().exists(key):
+    etag = '%s-w%d' % (content_digest(name), width) if is_content_addressed(name) else None
+    return send_upload(key, etag)
+  # Not cached for long, so browsers pick up the derivative once it exists
+  response = send_upload(name)
+  response.cache_control.max_age = None
+  response.cache_control.no_cache = True
+  return response
 
 # Upload a new photo
 @main.route('/upload/', methods=['GET','POST'])
@@ -55,21 +239,92 @@ def newPhoto():
       flash("No file selected!", "error")
       return redirect(request.url)
 
-    filepath = os.path.join(current_app.config["UPLOAD_DIR"], file.filename)
-    file.save(filepath)
+    # Only the image header is read here; resizing and hashing happen in the background
+    file.stream.seek(0)
+    width, height, image_format = image_info(file.stream)
+    file.stream.seek(0, os.SEEK_END)
+    record_upload(file.stream.tell())
+    # The upload was streamed to a temporary file and hashed while the request was read.
+    # It is moved into storage under the hash of its contents and the extension of the detected
+    # image format, never the client-supplied filename.
+    # If the same bytes are already stored, the new photo simply points at the existing file.
+    filename, is_new = ingest_upload(file, get_storage(), image_format)
+    # An identical upload already has its perceptual hash
+    phash = None
+    if width and not is_new:
+      phash = db.session.scalar(select(Photo.phash).where(Photo.file == filename,
+                                                          Photo.phash.is_not(None)).limit(1))
 
     newPhoto = Photo(name = request.form['user'], 
                     caption = request.form['caption'],
                     description = request.form['description'],
-                    file = file.filename,
+                    file = filename,
+                    width = width,
+                    height = height,
+                    phash = phash,
                     user_id = session['current_user_id'])
     db.session.add(newPhoto)
+    if width and (is_new or phash is None):
+      # The perceptual hash and the resized copies are made by the background workers
+      # once the photo is committed
+      enqueue('derivatives', {'file': filename}, key='derivatives:' + filename)
     flash('New Photo %s Successfully Created' % newPhoto.name)
     db.session.commit()
+    catalogue_changed()
+    if phash is not None:
+      hash_index().add(newPhoto.id, phash)
+      warn_about_duplicates(newPhoto)
+    elif width:
+      # Checked on a later page load, once the job has hashed the photo
+      pending = session.get('duplicate_checks', []) + [newPhoto.id]
+      session['duplicate_checks'] = pending[-MAX_DUPLICATE_CHECKS:]
     return redirect(url_for('main.homepage'))
   else:
     return render_template('upload.html')
 
+# The upload is kept either way; the uploader is told which photos it looks like.
+def warn_about_duplicates(photo):
+  duplicates = similar_photos(photo.phash, current_app.config['DUPLICATE_MAX_DISTANCE'],
+                              limit=3, exclude=[photo.id])
+  if duplicates:
+    flash('This photo looks like %s, already in the gallery.'
+          % ', '.join('"%s"' % duplicate.caption for duplicate in duplicates), 'warning')
+
+# Warns about this user's recent uploads that the background job has hashed since.
+# Uploads whose hash is still missing are checked again on the next page.
+def warn_about_hashed_uploads():
+  pending = session.get('duplicate_checks')
+  if not pending:
+    return
+  photos = db.session.scalars(select(Photo).where(Photo.id.in_(pending))).all()
+  for photo in photos:
+    if photo.phash is not None:
+      warn_about_duplicates(photo)
+  waiting = [photo.id for photo in photos if photo.phash is None]
+  if waiting:
+    session['duplicate_checks'] = waiting
+  else:
+    session.pop('duplicate_checks')
+
+# Shows the photos that look like this one: re-uploads, resized or re-encoded copies, near-identical shots.
+@main.route('/photo/<int:photo_id>/similar/')
+def similarPhotos(photo_id):
+  photo = db.get_or_404(Photo, photo_id)
+  photos = similar_photos(photo.phash, current_app.config['SIMILAR_MAX_DISTANCE'],
+                          exclude=[photo.id])
+  if not photos:
+    flash('No photos similar to "%s" found' % photo.caption)
+    return redirect(url_for('main.homepage'))
+  grid = user_grid(render_tiles(photos), [similar.id for similar in photos])
+  return render_template('index.html', grid=grid)
+
+# Uploads larger than MAX_CONTENT_LENGTH are rejected while the request is still being read
+@main.app_errorhandler(413)
+def upload_too_large(error):
+  flash('File is too large. The maximum size is %d MB.'
+        % (current_app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)), 'error')
+  return redirect(url_for('main.newPhoto'))
+
 # This is called when clicking on Edit. Goes to the edit page.
 @main.route('/photo/<int:photo_id>/edit/', methods = ['GET', 'POST'])
 def editPhoto(photo_id):
@@ -85,6 +340,7 @@ def editPhoto(photo_id):
         editedPhoto.description = request.form['description']
         db.session.add(editedPhoto)
         db.session.commit()
+        catalogue_changed()
         flash('Photo Successfully Edited %s' % editedPhoto.name)
         return redirect(url_for('main.homepage'))
     else:
@@ -101,19 +357,40 @@ def deletePhoto(photo_id):
   else: 
     # Previously: Used concatenated SQL, exposing the app to SQL injection attacks
     # Now: SQLAlchemy ORM used, which prevents SQL injection by using parameterized queries instead of unsafe string concatenation
+    # Only rows are deleted here. The same transaction queues the removal of the stored file
+    # (unless another photo shares it) for the background workers, see cleanup.py
+    filename = photoToDelete.file
     try:
-      filename = photoToDelete.file
-      filepath = os.path.join(current_app.config["UPLOAD_DIR"], filename)
-      os.unlink(filepath)
+      db.session.execute(delete(Like).where(Like.photo_id == photo_id))
       db.session.delete(photoToDelete)
+      enqueue('delete-upload', {'file': filename}, key='delete-upload:' + filename)
       db.session.commit()
-      
-      flash('Photo id %s Successfully Deleted' % photo_id)
-      return redirect(url_for('main.homepage'))
-    except:
+    except SQLAlchemyError:
+      db.session.rollback()
+      logger.exception('Could not delete photo %s', photo_id)
       flash('Photo id %s Could Not be Deleted' % photo_id)
       return redirect(url_for('main.homepage'))
+    catalogue_changed()
+    flash('Photo id %s Successfully Deleted' % photo_id)
+    return redirect(url_for('main.homepage'))
+
 
+# The grid's delete and like buttons all submit the page's one #photo-actions form.
+# The button pressed names the action, and its value is the photo's id.
+# Likes sent with fetch() (Accept: application/json) get the JSON answer of toggle_like_json.
+@main.route('/photo-actions', methods=['POST'])
+def photo_action():
+  for action in ('like', 'delete'):
+    photo_id = request.form.get(action, type=int)
+    if photo_id is not None:
+      break
+  else:
+    abort(400)
+  if action == 'delete':
+    return deletePhoto(photo_id)
+  if request.accept_mimetypes.best == 'application/json':
+    return toggle_like_json(photo_id)
+  return toggle_like(photo_id)
 
 # Task 8 & 9: Feature 2
 @main.route('/toggle_like/<int:photo_id>', methods=['POST'])
@@ -125,25 +402,28 @@ def toggle_like(photo_id):
         return redirect(url_for('main.homepage'))
     # Retrieve the current user's ID from the session
     user_id = session['current_user_id']
-    # Parameterised Queries: SQLAlchemy ORM being used -> converts Python code to SQL statements through parameterized queries
+    # Parameterised Queries: SQLAlchemy Core statements with bound parameters are used
       # Hence, any input from the client side is treated as data, rather than executable SQL code
       # Preventing SQL injections.
-    # Query to check if the current logged in user has liked the current photo
-    like = Like.query.filter_by(user_id=user_id, photo_id=photo_id).first()
-
-    # If a like exists, it means the user has previously liked the photo and now wants to unlike it
-    if like:
-        # Delete the existing like from the database
-        db.session.delete(like)
-        flash('Photo unliked', 'success')
-    else:
-        # If no like exists, it means the user wants to like the photo
-        # Create a new Like object with the user ID and photo ID
-        new_like = Like(user_id=user_id, photo_id=photo_id)
-        # Add the new like to the database session
-        db.session.add(new_like)
-        flash('Photo liked', 'success')
-    
-    db.session.commit()
+    # The like is removed if it exists, otherwise added, in single statements that cannot race
+    # with another click, and the photo's like count is updated in the same transaction
+    result = likes.toggle_like(user_id, photo_id)
+    if result is None:
+        abort(404)
+    liked, like_count = result
+    flash('Photo liked' if liked else 'Photo unliked', 'success')
     # Redirect the user back to the homepage after the action is complete
-    return redirect(url_for('main.homepage'))
\ No newline at end of file
+    return redirect(url_for('main.homepage'))
+
+# Same as toggle_like, but for fetch() calls: returns the new state and count as JSON
+# instead of redirecting and re-rendering the homepage.
+# The CSRF token is sent in the X-CSRFToken header.
+@main.route('/toggle_like/<int:photo_id>/json', methods=['POST'])
+def toggle_like_json(photo_id):
+    if 'current_user_id' not in session:
+        return jsonify(error='Please login to like this photo'), 401
+    result = likes.toggle_like(session['current_user_id'], photo_id)
+    if result is None:
+        return jsonify(error='Photo not found'), 404
+    liked, like_count = result
+    return jsonify(photo_id=photo_id, liked=liked, like_count=like_count)
@@ -0,0 +1,228 @@
+"""Request, SQL and template instrumentation, exposed at ``/metrics``.
+
+For every request this records:
+
+- latency per endpoint and status
+- the number of SQL statements and the time spent in them, via SQLAlchemy
+  cursor events; the same ``SELECT`` repeated ``N_PLUS_ONE_THRESHOLD`` times
+  or more in one request is logged as a likely N+1 query
+- time spent rendering each template passed to ``render_template``
+- bytes uploaded and bytes of uploads served
+
+``/metrics`` returns everything in the Prometheus text format. Metrics are
+kept per process, so scrape each worker (or run one worker per container).
+Set ``METRICS_TOKEN`` to require ``Authorization: Bearer <token>``.
+
+With ``PROFILING_ENABLED`` set, a request carrying the header
+``X-Profile: 1`` runs under cProfile and the response body is replaced by
+the profile, sorted by cumulative time.
+"""
+import cProfile
+import io
+import logging
+import pstats
+import re
+import threading
+import time
+from collections import Counter
+
+from flask import (
+  Blueprint, abort, current_app, g, has_request_context, request
+)
+from flask import before_render_template, template_rendered
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+metrics = Blueprint('metrics', __name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram:
+    def __init__(self, name, help, buckets, labels):
+        self.name, self.help, self.buckets, self.labels = name, help, buckets, labels
+        # label values -> [per-bucket counts, sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._values.setdefault(label_values, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            for label_values, (counts, total, count) in sorted(self._values.items()):
+                labels = _labels(self.labels, label_values)
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append('%s_bucket{%s} %d'
+                                 % (self.name, _join(labels, 'le="%s"' % bound), bucket_count))
+                lines.append('%s_bucket{%s} %d' % (self.name, _join(labels, 'le="+Inf"'), count))
+                lines.append('%s_sum{%s} %r' % (self.name, labels, total))
+                lines.append('%s_count{%s} %d' % (self.name, labels, count))
+        return lines
+
+
+class CounterMetric:
+    def __init__(self, name, help, labels):
+        self.name, self.help, self.labels = name, help, labels
+        self._values = Counter()
+        self._lock = threading.Lock()
+
+    def inc(self, amount, *label_values):
+        with self._lock:
+            self._values[label_values] += amount
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append('%s{%s} %s' % (self.name, _labels(self.labels, label_values), value))
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values):
+    return ','.join('%s="%s"' % (name, _escape(value)) for name, value in zip(names, values))
+
+
+def _join(*parts):
+    return ','.join(part for part in parts if part)
+
+
+REQUEST_LATENCY = Histogram('photos_request_duration_seconds',
+                            'Time to handle a request.', LATENCY_BUCKETS, ('endpoint', 'status'))
+SQL_STATEMENTS = Histogram('photos_sql_statements_per_request',
+                           'SQL statements executed per request.', COUNT_BUCKETS, ('endpoint',))
+SQL_TIME = Histogram('photos_sql_duration_seconds_per_request',
+                     'Time spent in SQL statements per request.', LATENCY_BUCKETS, ('endpoint',))
+TEMPLATE_TIME = Histogram('photos_template_render_duration_seconds',
+                          'Time to render a template.', LATENCY_BUCKETS, ('template',))
+N_PLUS_ONE = CounterMetric('photos_n_plus_one_total',
+                           'Requests that repeated one SELECT N_PLUS_ONE_THRESHOLD times or more.',
+                           ('endpoint',))
+UPLOAD_BYTES = CounterMetric('photos_upload_bytes_total', 'Bytes of photos uploaded.', ())
+SERVED_BYTES = CounterMetric('photos_served_bytes_total', 'Bytes of uploads served.', ('endpoint',))
+
+REGISTRY = [REQUEST_LATENCY, SQL_STATEMENTS, SQL_TIME, TEMPLATE_TIME, N_PLUS_ONE,
+            UPLOAD_BYTES, SERVED_BYTES]
+
+FILE_ENDPOINTS = ('main.display_file', 'main.display_derivative')
+
+
+def record_upload(size):
+    UPLOAD_BYTES.inc(size)
+
+
+def _endpoint():
+    return request.endpoint or 'unmatched'
+
+
+def _before_request():
+    g.metrics_start = time.perf_counter()
+    g.sql_count = 0
+    g.sql_time = 0.0
+    g.sql_statements = Counter()
+    g.template_starts = []
+    if current_app.config['PROFILING_ENABLED'] and request.headers.get('X-Profile') == '1':
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+def _after_request(response):
+    if 'metrics_start' not in g:
+        return response
+    endpoint = _endpoint()
+    REQUEST_LATENCY.observe(time.perf_counter() - g.metrics_start, endpoint, response.status_code)
+    SQL_STATEMENTS.observe(g.sql_count, endpoint)
+    SQL_TIME.observe(g.sql_time, endpoint)
+    if endpoint in FILE_ENDPOINTS and response.content_length:
+        SERVED_BYTES.inc(response.content_length, endpoint)
+
+    threshold = current_app.config['N_PLUS_ONE_THRESHOLD']
+    repeated = [(statement, count) for statement, count in g.sql_statements.items()
+                if count >= threshold and statement.lstrip().upper().startswith('SELECT')]
+    if repeated:
+        N_PLUS_ONE.inc(1, endpoint)
+        for statement, count in repeated:
+            logger.warning('Possible N+1 query in %s: %d x %s', endpoint, count,
+                           re.sub(r'\s+', ' ', statement)[:200])
+
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(40)
+        response = current_app.response_class(out.getvalue(), mimetype='text/plain')
+    return response
+
+
+def _teardown_request(error):
+    # after_request is skipped when the view raises; the profiler must not stay on in this thread
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+
+
+# The start time is kept on the statement's execution context, which is dropped even if it fails
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.metrics_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, 'metrics_start', None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    if has_request_context() and 'sql_statements' in g:
+        g.sql_count += 1
+        g.sql_time += elapsed
+        g.sql_statements[statement] += 1
+
+
+def _before_render(sender, template, context, **extra):
+    if has_request_context() and 'template_starts' in g:
+        g.template_starts.append(time.perf_counter())
+
+
+def _rendered(sender, template, context, **extra):
+    if has_request_context() and g.get('template_starts'):
+        TEMPLATE_TIME.observe(time.perf_counter() - g.template_starts.pop(),
+                              template.name or 'string')
+
+
+@metrics.route('/metrics')
+def metrics_endpoint():
+    token = current_app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != 'Bearer ' + token:
+        abort(401)
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return current_app.response_class('\n'.join(lines) + '\n',
+                                      mimetype='text/plain; version=0.0.4')
+
+
+def init_metrics(app, db):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_rendered, app)
+    app.register_blueprint(metrics)
@@ -0,0 +1,154 @@
+"""Schema migrations for existing databases.
+
+``db.create_all()`` only creates missing tables, so columns and indexes added
+to the models later never reach a database that already exists. Each
+migration below is applied once, in order, and recorded in the
+``schema_migrations`` table:
+
+- ``flask --app project db-upgrade`` applies pending migrations
+- ``flask --app project db-status`` lists them
+
+A database created from the current models already has everything, so
+``initialise_db.py`` marks all migrations as applied with :func:`stamp`.
+Migrations are written to be safe to re-run and use SQL that SQLite and
+PostgreSQL both accept.
+"""
+import logging
+import math
+from datetime import datetime, timezone
+
+from sqlalchemy import inspect, text
+
+from . import db
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_TABLE = 'schema_migrations'
+
+
+def _add_column(conn, table, name, ddl):
+    if name not in {column['name'] for column in inspect(conn).get_columns(table)}:
+        # Quotes reserved words such as "like"
+        table = conn.dialect.identifier_preparer.quote(table)
+        conn.execute(text('ALTER TABLE %s ADD COLUMN %s %s' % (table, name, ddl)))
+
+
+def photo_dimensions(conn):
+    _add_column(conn, 'photo', 'width', 'INTEGER')
+    _add_column(conn, 'photo', 'height', 'INTEGER')
+
+
+def like_counts(conn):
+    _add_column(conn, 'photo', 'like_count', 'INTEGER NOT NULL DEFAULT 0')
+    # The unique index below needs duplicate likes gone first
+    conn.execute(text('DELETE FROM "like" WHERE id NOT IN '
+                      '(SELECT MIN(id) FROM "like" GROUP BY user_id, photo_id)'))
+    conn.execute(text('UPDATE photo SET like_count = '
+                      '(SELECT COUNT(*) FROM "like" WHERE "like".photo_id = photo.id)'))
+
+
+def missing_indexes(conn):
+    # Like.user_id lookups are served by the leading column of uq_like_user_photo
+    for statement in [
+        'CREATE INDEX IF NOT EXISTS ix_photo_file ON photo (file)',
+        'CREATE INDEX IF NOT EXISTS ix_photo_user_id ON photo (user_id)',
+        'CREATE INDEX IF NOT EXISTS ix_like_photo_id ON "like" (photo_id)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS uq_like_user_photo ON "like" (user_id, photo_id)',
+    ]:
+        conn.execute(text(statement))
+
+
+def search_index(conn):
+    from .searchindex import create_search_index
+    if conn.dialect.name == 'sqlite':
+        create_search_index(conn)
+
+
+def import_checkpoints(conn):
+    from .models import ImportCheckpoint
+    ImportCheckpoint.__table__.create(conn, checkfirst=True)
+
+
+def photo_phash(conn):
+    # Filled in by `flask --app project phash-backfill`
+    _add_column(conn, 'photo', 'phash', 'BIGINT')
+
+
+def feeds(conn):
+    _add_column(conn, 'photo', 'trend_score', 'FLOAT NOT NULL DEFAULT 0')
+    _add_column(conn, 'photo', 'created_at', 'TIMESTAMP')
+    _add_column(conn, 'like', 'created_at', 'TIMESTAMP')
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_photo_like_count_id ON photo (like_count, id)'))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_photo_trend_score_id ON photo (trend_score, id)'))
+    # When existing likes were made is unknown, so each counts as made at trending.EPOCH
+    scores = [{'id': photo_id, 'score': math.log2(like_count)} for photo_id, like_count in
+              conn.execute(text('SELECT id, like_count FROM photo WHERE like_count > 0'))]
+    if scores:
+        conn.execute(text('UPDATE photo SET trend_score = :score WHERE id = :id'), scores)
+
+
+def jobs(conn):
+    from .models import Job
+    Job.__table__.create(conn, checkfirst=True)
+
+
+# (id, function) in the order they must run. Never reorder or rename; append new ones.
+MIGRATIONS = [
+    ('0001_photo_dimensions', photo_dimensions),
+    ('0002_like_counts', like_counts),
+    ('0003_missing_indexes', missing_indexes),
+    ('0004_search_index', search_index),
+    ('0005_import_checkpoints', import_checkpoints),
+    ('0006_photo_phash', photo_phash),
+    ('0007_feeds', feeds),
+    ('0008_jobs', jobs),
+]
+
+
+def _ensure_table(conn):
+    conn.execute(text('CREATE TABLE IF NOT EXISTS %s ('
+                      'id VARCHAR(100) PRIMARY KEY, applied_at VARCHAR(40) NOT NULL)'
+                      % MIGRATIONS_TABLE))
+
+
+def _applied(conn):
+    return {row[0] for row in conn.execute(text('SELECT id FROM %s' % MIGRATIONS_TABLE))}
+
+
+def _record(conn, migration_id):
+    conn.execute(text('INSERT INTO %s (id, applied_at) VALUES (:id, :at)' % MIGRATIONS_TABLE),
+                 {'id': migration_id, 'at': datetime.now(timezone.utc).isoformat()})
+
+
+def status():
+    """Return ``[(id, applied)]`` for every known migration."""
+    with db.engine.begin() as conn:
+        _ensure_table(conn)
+        applied = _applied(conn)
+    return [(migration_id, migration_id in applied) for migration_id, _ in MIGRATIONS]
+
+
+def upgrade():
+    """Apply pending migrations, each in its own transaction; return their ids."""
+    done = []
+    with db.engine.begin() as conn:
+        _ensure_table(conn)
+    for migration_id, migrate in MIGRATIONS:
+        with db.engine.begin() as conn:
+            if migration_id in _applied(conn):
+                continue
+            logger.info('Applying migration %s', migration_id)
+            migrate(conn)
+            _record(conn, migration_id)
+        done.append(migration_id)
+    return done
+
+
+def stamp():
+    """Mark every migration as applied, for a database just built by create_all()."""
+    with db.engine.begin() as conn:
+        _ensure_table(conn)
+        applied = _applied(conn)
+        for migration_id, _ in MIGRATIONS:
+            if migration_id not in applied:
+                _record(conn, migration_id)
@@ -1,12 +1,32 @@
+from datetime import datetime, timezone
+
 from . import db
 
+
+def utcnow():
+    # Naive UTC, as SQLite stores it
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
 class Photo(db.Model):
+    # Sort keys of the popular and trending feeds, so a page reads only its own rows
+    __table_args__ = (db.Index('ix_photo_like_count_id', 'like_count', 'id'),
+                      db.Index('ix_photo_trend_score_id', 'trend_score', 'id'))
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), nullable=False)
     caption = db.Column(db.String(250), nullable=False)
-    file = db.Column(db.String(250), nullable=False)
+    file = db.Column(db.String(250), nullable=False, index=True)
     description = db.Column(db.String(600), nullable=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))  # referencing 'id' attribute of 'User' Table
+    # Pixel size of the original upload, used for <img width/height> and srcset (NULL if not an image)
+    width = db.Column(db.Integer, nullable=True)
+    height = db.Column(db.Integer, nullable=True)
+    # 64-bit perceptual hash of the image, for finding near-duplicates (see similar.py)
+    phash = db.Column(db.BigInteger, nullable=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)  # referencing 'id' attribute of 'User' Table
+    # Number of Like rows for this photo, kept up to date by likes.toggle_like
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Time-decayed popularity, also kept up to date by likes.toggle_like (see trending.py)
+    trend_score = db.Column(db.Float, nullable=False, default=0, server_default='0')
+    created_at = db.Column(db.DateTime, nullable=True, default=utcnow)
     likes = db.relationship('Like', back_populates='photo')
     @property
     def serialize(self):
@@ -17,7 +37,11 @@ class Photo(db.Model):
            'caption'      : self.caption,
            'file'         : self.file,
            'desc'         : self.description,
-           'user'         : self.user_id
+           'user'         : self.user_id,
+           'like_count'   : self.like_count,
+           'width'        : self.width,
+           'height'       : self.height,
+           'created_at'   : self.created_at.isoformat() + 'Z' if self.created_at else None
        }
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)  # Adding a primary key for the User model
@@ -37,10 +61,45 @@ class User(db.Model):
             'name': self.name,
             'profile_pic': self.profile_pic,
         }
+    @property
+    def serialize_public(self):
+        """The fields anyone may see: no email address or Google account id"""
+        return {
+            'id': self.id,
+            'name': self.name,
+            'profile_pic': self.profile_pic,
+        }
 
 class Like(db.Model):
+    # A user can like a photo only once. The index also serves lookups by user_id.
+    __table_args__ = (db.UniqueConstraint('user_id', 'photo_id', name='uq_like_user_photo'),)
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    photo_id = db.Column(db.Integer, db.ForeignKey('photo.id'))
+    photo_id = db.Column(db.Integer, db.ForeignKey('photo.id'), index=True)
+    # NULL for likes made before this was recorded
+    created_at = db.Column(db.DateTime, nullable=True, default=utcnow)
     user = db.relationship('User', back_populates='likes')
-    photo = db.relationship('Photo', back_populates='likes')
\ No newline at end of file
+    photo = db.relationship('Photo', back_populates='likes')
+
+class Job(db.Model):
+    # Work queued for the background workers (see jobs.py)
+    __table_args__ = (db.Index('ix_job_status_run_at', 'status', 'run_at'),)
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.JSON, nullable=False, default=dict)
+    # Idempotency key: at most one waiting job per key. Cleared when the job starts.
+    key = db.Column(db.String(250), nullable=True, unique=True)
+    # 'queued', 'running' or 'failed'; finished jobs are deleted
+    status = db.Column(db.String(10), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+    # A running job not finished by then is assumed lost with its worker and run again
+    locked_until = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+
+class ImportCheckpoint(db.Model):
+    # How many rows of a bulk import manifest have been committed, so the import can resume (see catalogue.py)
+    manifest = db.Column(db.String(500), primary_key=True)
+    rows_done = db.Column(db.Integer, nullable=False, default=0)
@@ -0,0 +1,161 @@
+"""Cached OpenID Connect provider metadata and signing keys.
+
+Logging in needs the provider's discovery document (for the authorization
+and token endpoints) and its JSON Web Key Set (to check the signature of
+the ID token). Both change rarely, so they are fetched once per process and
+kept for ``OIDC_CACHE_TTL`` seconds. After that the cached copy is still
+served while a background thread fetches a fresh one, so only the very
+first login of a process waits for the provider.
+
+The user's claims are read from the ID token returned by the token
+exchange, verified locally against the cached keys, instead of with an
+extra call to the userinfo endpoint. A token signed with a key we have not
+seen yet forces one JWKS refresh (at most every ``JWKS_MIN_REFRESH``
+seconds), which picks up the provider's key rotation.
+"""
+import logging
+import threading
+import time
+
+import requests
+from authlib.integrations.flask_client import FlaskOAuth2App, OAuthError
+from authlib.integrations.flask_client.integration import FlaskIntegration
+from joserfc.errors import JoseError
+
+logger = logging.getLogger(__name__)
+
+FETCH_TIMEOUT = 5
+# Shortest interval between two JWKS fetches forced by an unknown key id
+JWKS_MIN_REFRESH = 60
+LOGIN_ERRORS = (OAuthError, JoseError)
+
+
+def fetch_json(url):
+    response = requests.get(url, timeout=FETCH_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+class CachedDocument:
+    """The result of ``load()``, kept for ``ttl`` seconds.
+
+    A stale value is returned immediately while one background thread
+    reloads it; if that reload fails the stale value stays in use and the
+    next call tries again.
+    """
+
+    def __init__(self, load, ttl, clock=time.monotonic):
+        self._load = load
+        self.ttl = ttl
+        self._clock = clock
+        self._value = None
+        self._loaded_at = None
+        self._load_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def get(self, force=False):
+        if force or self._value is None:
+            self.reload(force)
+        elif self._clock() - self._loaded_at >= self.ttl:
+            self.refresh_in_background()
+        return self._value
+
+    def reload(self, force=True):
+        # One load at a time; a caller that waited for another thread's first load reuses it
+        with self._load_lock:
+            if force or self._value is None:
+                value = self._load()
+                self._value, self._loaded_at = value, self._clock()
+
+    def age(self):
+        return None if self._loaded_at is None else self._clock() - self._loaded_at
+
+    def refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._background_reload, daemon=True).start()
+
+    def _background_reload(self):
+        try:
+            self.reload()
+        except Exception:
+            logger.exception('Background refresh failed, keeping the cached copy')
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+
+class OIDCProvider:
+    """Discovery document and JWKS of one identity provider."""
+
+    def __init__(self, metadata_url, ttl=3600, fetch=fetch_json):
+        self.metadata_url = metadata_url
+        self._metadata = CachedDocument(lambda: fetch(metadata_url), ttl)
+        self._jwks = CachedDocument(lambda: fetch(self.metadata()['jwks_uri']), ttl)
+
+    def metadata(self):
+        return self._metadata.get()
+
+    def jwks(self, force=False):
+        # Don't let tokens carrying made-up key ids hammer the provider
+        age = self._jwks.age()
+        if force and age is not None and age < JWKS_MIN_REFRESH:
+            force = False
+        return self._jwks.get(force=force)
+
+    def prefetch_jwks(self):
+        """Start loading the keys now, so they are ready when the user comes back."""
+        if self._jwks.age() is None:
+            self._jwks.refresh_in_background()
+
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def get_provider(metadata_url, ttl=3600):
+    """The process-wide provider for ``metadata_url``, shared by every app."""
+    with _providers_lock:
+        provider = _providers.get(metadata_url)
+        if provider is None:
+            provider = _providers[metadata_url] = OIDCProvider(metadata_url, ttl)
+        return provider
+
+
+class CachedOIDCApp(FlaskOAuth2App):
+    """Authlib's Flask OAuth client, reading metadata and keys from an ``OIDCProvider``.
+
+    ``authorize_access_token()`` verifies the ID token (signature, issuer,
+    audience, expiry and nonce) and returns its claims as
+    ``token['userinfo']``.
+    """
+
+    def __init__(self, provider, **kwargs):
+        super().__init__(FlaskIntegration(kwargs.get('name')), **kwargs)
+        self.provider = provider
+
+    def load_server_metadata(self):
+        metadata = dict(self.server_metadata)
+        metadata.update(self.provider.metadata())
+        return metadata
+
+    def fetch_jwk_set(self, force=False):
+        return self.provider.jwks(force=force)
+
+
+def oauth_client(app):
+    """The Google OAuth client for ``app``, created on first use."""
+    client = app.extensions.get('google_oauth')
+    if client is None:
+        provider = get_provider(app.config['OIDC_METADATA_URL'], app.config['OIDC_CACHE_TTL'])
+        client = app.extensions['google_oauth'] = CachedOIDCApp(
+            provider,
+            name='google',
+            client_id=app.config['GOOGLE_CLIENT_ID'],
+            client_secret=app.config['GOOGLE_CLIENT_SECRET'],
+            client_kwargs={'scope': 'openid profile email'},
+        )
+    return client
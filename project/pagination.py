@@ -0,0 +1,88 @@
+"""Keyset (cursor) pagination helpers.
+
+Instead of ``OFFSET``, each page remembers the sort key of its last row in
+an opaque cursor. The next page asks for rows strictly after that key, which
+an index on the sort columns can answer by touching only ``per_page`` rows,
+however deep into the catalogue the reader has scrolled.
+"""
+import base64
+import binascii
+import json
+import math
+
+from sqlalchemy import and_, or_
+
+
+def encode_cursor(values):
+    """Pack a row's sort key into an opaque, URL-safe string."""
+    raw = json.dumps(list(values), separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def _typed(value, python_type):
+    """``value`` if it is a JSON value of ``python_type``; raises ValueError otherwise."""
+    if python_type is float and type(value) is int:
+        value = float(value)
+    # type() rather than isinstance(), so that True is not taken for an int
+    if type(value) is not python_type or (python_type is float and not math.isfinite(value)):
+        raise ValueError(value)
+    return value
+
+
+def decode_cursor(cursor, types):
+    """Unpack a cursor made by :func:`encode_cursor` into values of ``types``.
+
+    Returns ``None`` for a missing, tampered or malformed cursor, which
+    callers treat as "start from the first page".
+    """
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+        if not isinstance(values, list) or len(values) != len(types):
+            return None
+        return [_typed(value, python_type) for value, python_type in zip(values, types)]
+    except (binascii.Error, ValueError):
+        return None
+
+
+def cursor_values(cursor, order):
+    """The sort key in ``cursor`` for the ``(column, descending)`` pairs of ``order``, or None."""
+    return decode_cursor(cursor, [column.type.python_type for column, _ in order])
+
+
+def _after(order, values):
+    """Build ``WHERE`` clause selecting rows that sort after ``values``.
+
+    ``order`` is a list of ``(column, descending)`` pairs. For (a, b) this
+    expands to ``a > x OR (a = x AND b > y)``, which SQLite and PostgreSQL
+    can both answer with a range scan on an (a, b) index.
+    """
+    clauses = []
+    for i, (column, descending) in enumerate(order):
+        equal = [col == value for (col, _), value in zip(order[:i], values[:i])]
+        past = column < values[i] if descending else column > values[i]
+        clauses.append(and_(*equal, past))
+    return or_(*clauses)
+
+
+def keyset_page(query, order, key, after=None, per_page=24):
+    """Return ``(items, next_cursor)`` for the page following cursor ``after``.
+
+    ``order`` lists the ``(column, descending)`` sort key, which must end in
+    a unique column so that every row has a distinct position. ``key`` maps
+    a result row to the values of those columns. ``next_cursor`` is ``None``
+    on the last page.
+    """
+    values = cursor_values(after, order)
+    if values is not None:
+        query = query.filter(_after(order, values))
+    query = query.order_by(*[column.desc() if descending else column.asc()
+                             for column, descending in order])
+    # Fetch one extra row to find out whether there is a next page
+    items = query.limit(per_page + 1).all()
+    if len(items) <= per_page:
+        return items, None
+    items = items[:per_page]
+    return items, encode_cursor(key(items[-1]))
@@ -1,15 +1,11 @@
-
 from flask import (
-  Blueprint, request, 
-  flash, redirect, render_template, url_for
+  Blueprint, request, current_app,
+  flash, jsonify, redirect, render_template, url_for
 )
 import logging
-from authlib.integrations.flask_client import OAuth
-from .models import Photo
-from sqlalchemy import asc, text
-from . import db
-from dotenv import load_dotenv
-load_dotenv()
+from .searchindex import search_photos
+from .main import render_tiles, user_grid
+from .suggest import suggest_index
 
 searchfeature = Blueprint('searchfeature', __name__)
 
@@ -22,20 +18,31 @@ def search():
 @searchfeature.route("/filterSearch", methods=['GET'])
 def searchKeyword():
   # Get the keyword submitted by the user as a query parameter
-  keyword = request.args.get('search')
+  keyword = request.args.get('search', '')
+  page = request.args.get('page', 1, type=int)
   # Every keyword is logged, to detect malicious activities
-  logging.info('User search input', keyword)
-  # Prepare the search pattern for SQL LIKE operation, wrapping the keyword with wildcards
-  search_pattern = f'%{keyword}%'
-      # Parameterised Queries: SQLAlchemy ORM being used -> converts Python code to SQL statements through parameterized queries
-      # Hence, any input from the client side is treated as data, rather than executable SQL code
-      # Preventing SQL injections.
-    # Query the Photo database table to find photos where the caption, name, or description matches the search pattern
-  photos = db.session.query(Photo).filter((Photo.caption.like(search_pattern)) 
-                                          |(Photo.name.like(search_pattern)) 
-                                          |(Photo.description.like(search_pattern))).all()
+  logging.info('User search input %r', keyword)
+  # The keyword is looked up in the full-text index and ranked by relevance (BM25).
+    # The keyword is always passed to the database as a bound parameter and every word is quoted,
+    # so user input is treated as data and can never become SQL or FTS query syntax.
+  photos, has_next = search_photos(keyword, page=page,
+                                   per_page=current_app.config['SEARCH_PAGE_SIZE'])
   if not photos:
     flash("No photos found related to \"" + keyword + "\"")
     return redirect(url_for('main.homepage'))
   else :
-    return render_template('index.html', photos=photos)
+    grid = user_grid(render_tiles(photos), [photo.id for photo in photos])
+    return render_template('index.html', grid=grid, keyword=keyword,
+                           page=page, has_next=has_next)
+
+# Suggestions for the search bar, fetched as the user types (see static/js/suggest.js).
+  # Answered from memory without touching the database, so it is cheap enough to call per keystroke.
+@searchfeature.route('/suggest')
+def suggest():
+  prefix = request.args.get('q', '')[:100]
+  limit = min(max(request.args.get('limit', 8, type=int), 1), 20)
+  response = jsonify(query=prefix, suggestions=suggest_index().suggest(prefix, limit))
+  # Lets the browser reuse answers when the user deletes characters and types them again
+  response.cache_control.public = True
+  response.cache_control.max_age = 60
+  return response
@@ -0,0 +1,136 @@
+"""Full-text search over photo captions, names and descriptions.
+
+On SQLite the catalogue is indexed by an FTS5 virtual table (``photo_fts``)
+that mirrors the ``photo`` table. Triggers keep it in sync on every insert,
+update and delete, so uploads, edits and deletes need no extra work in the
+views. Matches are ranked with BM25 and returned one page at a time.
+
+Other database backends fall back to the original ``LIKE`` scan.
+"""
+import logging
+import re
+
+from sqlalchemy import DDL, event, select, text
+
+from . import db
+from .models import Photo
+
+logger = logging.getLogger(__name__)
+
+# Column weights for bm25(): a caption hit counts more than a name hit,
+# which counts more than a hit somewhere in a long description.
+BM25_WEIGHTS = (10.0, 5.0, 1.0)
+
+FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS photo_fts USING fts5(
+        caption, name, description,
+        content='photo', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS photo_fts_ai AFTER INSERT ON photo BEGIN
+        INSERT INTO photo_fts(rowid, caption, name, description)
+        VALUES (new.id, new.caption, new.name, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS photo_fts_ad AFTER DELETE ON photo BEGIN
+        INSERT INTO photo_fts(photo_fts, rowid, caption, name, description)
+        VALUES ('delete', old.id, old.caption, old.name, old.description);
+    END""",
+    # Only re-index when a searchable column changes
+    """CREATE TRIGGER IF NOT EXISTS photo_fts_au
+        AFTER UPDATE OF caption, name, description ON photo BEGIN
+        INSERT INTO photo_fts(photo_fts, rowid, caption, name, description)
+        VALUES ('delete', old.id, old.caption, old.name, old.description);
+        INSERT INTO photo_fts(rowid, caption, name, description)
+        VALUES (new.id, new.caption, new.name, new.description);
+    END""",
+]
+
+# Build the index whenever db.create_all() creates the photo table, and drop it with the table
+for statement in FTS_DDL:
+    event.listen(Photo.__table__, 'after_create',
+                 DDL(statement).execute_if(dialect='sqlite'))
+event.listen(Photo.__table__, 'after_drop',
+             DDL('DROP TABLE IF EXISTS photo_fts').execute_if(dialect='sqlite'))
+
+# Engines we have already checked for the FTS table in this process
+_ready_engines = set()
+
+
+def _is_sqlite():
+    return db.engine.dialect.name == 'sqlite'
+
+
+def create_search_index(conn, rebuild=False):
+    """Create the FTS table and triggers on ``conn`` if missing.
+
+    A newly created index is populated from ``photo``; pass ``rebuild=True``
+    to re-populate an existing one.
+    """
+    exists = conn.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'photo_fts'"
+    )).first() is not None
+    for statement in FTS_DDL:
+        conn.execute(text(statement))
+    if rebuild or not exists:
+        conn.execute(text("INSERT INTO photo_fts(photo_fts) VALUES ('rebuild')"))
+        logger.info('Search index rebuilt')
+
+
+def ensure_search_index(rebuild=False):
+    """Make sure the search index exists, for databases created before it did."""
+    if not _is_sqlite():
+        return
+    with db.engine.begin() as conn:
+        create_search_index(conn, rebuild)
+    _ready_engines.add(db.engine)
+
+
+def build_match_query(keyword):
+    """Turn free text into a safe FTS5 query.
+
+    Every word becomes a quoted prefix term, so user input can never be
+    interpreted as FTS5 operators. All terms must match.
+    """
+    terms = re.findall(r'\w+', keyword or '')
+    return ' '.join('"%s"*' % term for term in terms)
+
+
+def search_photos(keyword, page=1, per_page=24, options=()):
+    """Return ``(photos, has_next)`` for one page of search results.
+
+    ``options`` are ORM loader options for the photos, e.g. ``selectinload(Photo.user)``.
+    """
+    page = max(page, 1)
+    offset = (page - 1) * per_page
+    if not _is_sqlite():
+        return _like_search(keyword, offset, per_page, options)
+
+    if db.engine not in _ready_engines:
+        ensure_search_index()
+
+    match = build_match_query(keyword)
+    if not match:
+        return [], False
+    # Fetch one extra row to find out whether there is a next page
+    statement = text(
+        "SELECT photo.* FROM photo_fts JOIN photo ON photo.id = photo_fts.rowid "
+        "WHERE photo_fts MATCH :match "
+        "ORDER BY bm25(photo_fts, %s, %s, %s), photo.id "
+        "LIMIT :limit OFFSET :offset" % BM25_WEIGHTS
+    )
+    photos = db.session.execute(
+        select(Photo).from_statement(statement).options(*options),
+        {'match': match, 'limit': per_page + 1, 'offset': offset},
+    ).scalars().all()
+    return photos[:per_page], len(photos) > per_page
+
+
+def _like_search(keyword, offset, per_page, options=()):
+    search_pattern = f'%{keyword}%'
+    photos = (db.session.query(Photo).options(*options)
+              .filter((Photo.caption.like(search_pattern))
+                      | (Photo.name.like(search_pattern))
+                      | (Photo.description.like(search_pattern)))
+              .order_by(Photo.id)
+              .offset(offset).limit(per_page + 1).all())
+    return photos[:per_page], len(photos) > per_page
@@ -0,0 +1,226 @@
+"""Near-duplicate detection with perceptual hashes.
+
+Every image photo gets a 64-bit difference hash (dHash) of its pixels,
+stored in ``photo.phash``: by the background ``derivatives`` job after an
+upload (hashing decodes the whole image, too slow and memory-hungry for the
+request), while importing, or, for older photos, from
+``flask --app project phash-backfill``. Re-encoded, resized or
+slightly edited copies of an image have hashes that differ in only a few
+bits, so the number of differing bits (Hamming distance) measures how alike
+two photos look.
+
+Lookups scan every hash at once with NumPy: one XOR and one popcount over a
+``uint64`` array, a few milliseconds for a million photos. The arrays are
+built per process on first use. Uploads in this process are added straight
+away; photos added by other processes are picked up by a background rebuild
+once the catalogue version of the grid cache has changed, at most every
+``SIMILAR_REFRESH_SECONDS``. Deleted photos stay in the arrays until then
+and are dropped when the matching rows are loaded.
+"""
+import logging
+import threading
+import time
+
+from flask import current_app
+from PIL import Image, ImageOps, UnidentifiedImageError
+from sqlalchemy import select, update
+from sqlalchemy.exc import SQLAlchemyError
+
+from . import db
+from .cache import grid_cache
+from .models import Photo
+from .storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+HASH_SIZE = 8
+
+
+def image_hash(path):
+    """Return the dHash of an image as a signed 64-bit int, or None if it isn't one.
+
+    ``path`` may also be a seekable binary file.
+    """
+    try:
+        with Image.open(path) as image:
+            # JPEGs can be decoded at 1/8 scale, which is all a 9x8 thumbnail needs
+            image.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+            image = ImageOps.exif_transpose(image).convert('L')
+            pixels = image.resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS).tobytes()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        return None
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            value = value << 1 | (pixels[row * (HASH_SIZE + 1) + col + 1] > left)
+    # Stored in a signed BIGINT column
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def hash_stored_file(file):
+    """Hash the stored upload ``file`` and record it on the photos using it that lack one."""
+    try:
+        with get_storage().open(file) as image:
+            phash = image_hash(image)
+    except FileNotFoundError:
+        # Deleted since the job was queued
+        return None
+    if phash is None:
+        return None
+    photo_ids = db.session.scalars(select(Photo.id).where(Photo.file == file,
+                                                          Photo.phash.is_(None))).all()
+    if not photo_ids:
+        return phash
+    db.session.execute(update(Photo).where(Photo.id.in_(photo_ids)).values(phash=phash)
+                       .execution_options(synchronize_session=False))
+    db.session.commit()
+    index = hash_index()
+    for photo_id in photo_ids:
+        index.add(photo_id, phash)
+    # Other processes reload their hashes
+    grid_cache().bump_version()
+    return phash
+
+
+def hamming(a, b):
+    """Number of bits that differ between two hashes."""
+    return ((a ^ b) & ((1 << 64) - 1)).bit_count()
+
+
+class HashIndex:
+    def __init__(self):
+        import numpy as np
+        self._np = np
+        self._ids = np.empty(0, dtype=np.int64)
+        self._hashes = np.empty(0, dtype=np.uint64)
+        # Added since the arrays were last concatenated
+        self._pending = []
+        self._lock = threading.Lock()
+        self.version = None
+        self.built_at = None
+
+    def __len__(self):
+        return len(self._ids) + len(self._pending)
+
+    def build(self, rows, version=None):
+        """Replace the contents with ``rows`` of ``(photo id, phash)``."""
+        np = self._np
+        ids, hashes = [], []
+        for photo_id, phash in rows:
+            ids.append(photo_id)
+            hashes.append(phash)
+        ids = np.array(ids, dtype=np.int64)
+        hashes = np.array(hashes, dtype=np.int64).view(np.uint64)
+        with self._lock:
+            self._ids, self._hashes, self._pending = ids, hashes, []
+            self.version, self.built_at = version, time.monotonic()
+
+    def add(self, photo_id, phash):
+        with self._lock:
+            self._pending.append((photo_id, phash))
+
+    def _arrays(self):
+        np = self._np
+        with self._lock:
+            if self._pending:
+                ids, hashes = zip(*self._pending)
+                self._ids = np.concatenate([self._ids, np.array(ids, dtype=np.int64)])
+                self._hashes = np.concatenate(
+                    [self._hashes, np.array(hashes, dtype=np.int64).view(np.uint64)])
+                self._pending = []
+            return self._ids, self._hashes
+
+    def nearest(self, phash, max_distance, limit=None, exclude=()):
+        """``[(distance, photo id)]`` within ``max_distance`` bits of ``phash``, closest first."""
+        np = self._np
+        ids, hashes = self._arrays()
+        target = np.array([phash], dtype=np.int64).view(np.uint64)
+        distances = np.bitwise_count(hashes ^ target)
+        matches = np.flatnonzero(distances <= max_distance)
+        # Stable, so equally distant photos come oldest first
+        matches = matches[np.argsort(distances[matches], kind='stable')]
+        result, skip = [], set(exclude)
+        for match in matches:
+            photo_id = int(ids[match])
+            # A photo added right after a rebuild may be in the arrays twice
+            if photo_id in skip:
+                continue
+            skip.add(photo_id)
+            result.append((int(distances[match]), photo_id))
+            if limit is not None and len(result) == limit:
+                break
+        return result
+
+
+def _version():
+    try:
+        return grid_cache().version()
+    except Exception:
+        return None
+
+
+def rebuild(app):
+    """Load every photo hash into the app's index."""
+    index = app.extensions['similar']
+    with app.app_context():
+        version = _version()
+        try:
+            rows = db.session.execute(select(Photo.id, Photo.phash)
+                                      .where(Photo.phash.is_not(None))
+                                      .order_by(Photo.id)).yield_per(10000)
+            index.build(rows, version)
+        except SQLAlchemyError:
+            logger.warning('Could not load photo hashes', exc_info=True)
+            return
+        finally:
+            db.session.remove()
+    logger.info('Loaded %d photo hashes', len(index))
+
+
+def hash_index():
+    """The current app's index, loaded on first use and refreshed when other processes add photos."""
+    app = current_app._get_current_object()
+    index = app.extensions.get('similar')
+    if index is None or index.built_at is None:
+        with app.extensions['similar_build_lock']:
+            index = app.extensions.setdefault('similar', HashIndex())
+            if index.built_at is None:
+                rebuild(app)
+    elif (_version() != index.version
+          and time.monotonic() - index.built_at >= app.config['SIMILAR_REFRESH_SECONDS']):
+        _rebuild_in_background(app)
+    return index
+
+
+def _rebuild_in_background(app):
+    lock = app.extensions['similar_build_lock']
+    if not lock.acquire(blocking=False):
+        return
+
+    def run():
+        try:
+            rebuild(app)
+        finally:
+            lock.release()
+    threading.Thread(target=run, daemon=True).start()
+
+
+def similar_photos(phash, max_distance, limit=24, exclude=()):
+    """Photos that look like ``phash``, closest first."""
+    if phash is None:
+        return []
+    matches = hash_index().nearest(phash, max_distance, limit=limit, exclude=exclude)
+    if not matches:
+        return []
+    photos = {photo.id: photo for photo in
+              db.session.scalars(select(Photo).where(Photo.id.in_([id for _, id in matches])))}
+    # Deleted photos are still in the index, and their ids may have been reused
+    return [photos[photo_id] for distance, photo_id in matches
+            if photo_id in photos and photos[photo_id].phash is not None
+            and hamming(photos[photo_id].phash, phash) == distance]
+
+
+def init_similar(app):
+    # The index itself is created on first use, so NumPy is not imported at startup
+    app.extensions['similar_build_lock'] = threading.Lock()
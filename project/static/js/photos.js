@@ -0,0 +1,92 @@
+// Infinite scrolling for the homepage feed.
+// The "Load more photos" link works without JavaScript; with it, the next page of tiles
+// is fetched as a fragment and appended to the grid when the link scrolls into view.
+(function () {
+    const grid = document.getElementById('images');
+
+    function loadMore(link) {
+        if (link.dataset.loading) {
+            return;
+        }
+        link.dataset.loading = 'true';
+        const container = link.closest('#load-more');
+        fetch(link.dataset.fragment, { headers: { 'Accept': 'text/html' } })
+            .then(function (response) { return response.text(); })
+            .then(function (html) {
+                const page = document.createElement('div');
+                page.innerHTML = html;
+                grid.append(...page.querySelector('#images').children);
+                const next = page.querySelector('#load-more');
+                if (next) {
+                    container.replaceWith(next);
+                    watch(next);
+                } else {
+                    container.remove();
+                }
+            });
+    }
+
+    function watch(container) {
+        const link = container.querySelector('a[data-fragment]');
+        link.addEventListener('click', function (event) {
+            event.preventDefault();
+            loadMore(link);
+        });
+        if ('IntersectionObserver' in window) {
+            const observer = new IntersectionObserver(function (entries) {
+                if (entries.some(function (entry) { return entry.isIntersecting; })) {
+                    observer.disconnect();
+                    loadMore(link);
+                }
+            }, { rootMargin: '400px' });
+            observer.observe(container);
+        }
+    }
+
+    const first = document.getElementById('load-more');
+    if (grid && first) {
+        watch(first);
+    }
+})();
+
+// Liking without a page reload.
+// Like buttons still post the shared #photo-actions form without JavaScript; with it, the same
+// form is sent with fetch() asking for JSON, and only the heart and the count are updated.
+// One listener on the form handles every tile, including those added by infinite scrolling.
+(function () {
+    const form = document.getElementById('photo-actions');
+    if (!form) {
+        return;
+    }
+
+    form.addEventListener('submit', function (event) {
+        const button = event.submitter;
+        if (!button || button.name !== 'like') {
+            return;
+        }
+        event.preventDefault();
+        const body = new FormData(form);
+        body.append(button.name, button.value);
+        fetch(form.action, {
+            method: 'POST',
+            body: body,
+            headers: { 'X-CSRFToken': form.elements.csrf_token.value, 'Accept': 'application/json' },
+        }).then(function (response) {
+            if (!response.ok) {
+                // Not logged in or another error: fall back to the normal form post and its flash message
+                const field = document.createElement('input');
+                field.type = 'hidden';
+                field.name = button.name;
+                field.value = button.value;
+                form.append(field);
+                form.submit();
+                return;
+            }
+            return response.json().then(function (state) {
+                const tile = button.closest('.image-box');
+                tile.classList.toggle('liked', state.liked);
+                tile.querySelector('.like-count').textContent = state.like_count;
+            });
+        });
+    });
+})();
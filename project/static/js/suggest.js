@@ -0,0 +1,41 @@
+// Search-as-you-type for the search bar.
+// Suggestions are fetched once the user stops typing for a moment, and answers that arrive
+// after a newer request was sent are dropped, so the list always matches what is in the box.
+(function () {
+    const input = document.getElementById('searchbar');
+    const list = document.getElementById(input.getAttribute('list'));
+    const DEBOUNCE_MS = 150;
+    let timer = null;
+    let latest = 0;
+
+    function show(suggestions) {
+        list.replaceChildren(...suggestions.map(function (suggestion) {
+            const option = document.createElement('option');
+            option.value = suggestion.text;
+            option.label = suggestion.kind;
+            return option;
+        }));
+    }
+
+    function fetchSuggestions() {
+        const query = input.value.trim();
+        const request = ++latest;
+        if (!query) {
+            show([]);
+            return;
+        }
+        fetch(input.dataset.suggest + '?q=' + encodeURIComponent(query))
+            .then(function (response) { return response.json(); })
+            .then(function (data) {
+                if (request === latest) {
+                    show(data.suggestions);
+                }
+            })
+            .catch(function () {});
+    }
+
+    input.addEventListener('input', function () {
+        clearTimeout(timer);
+        timer = setTimeout(fetchSuggestions, DEBOUNCE_MS);
+    });
+})();
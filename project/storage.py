@@ -0,0 +1,455 @@
+"""Content-addressed storage of uploaded files.
+
+Uploads are saved under the SHA-256 of their bytes, plus the extension of
+the image format Pillow detected in them, e.g. ``3f5a...c1.jpg``, rather
+than the name the client sent. A given URL therefore always refers to the
+same bytes and can be cached forever, two different files can never
+overwrite each other, and uploading the same file twice stores it once,
+whatever it was called. Files that are not images get no extension.
+
+Stored files are addressed by key: the upload's name, or
+``derived/<name>`` for resized copies. Where the bytes live is up to the
+backend chosen with ``STORAGE_BACKEND``:
+
+``local`` (default)
+    Files under ``UPLOAD_DIR`` in hash-sharded directories, two levels of
+    256 (``3f/5a/3f5a...c1.jpg``), so no directory grows past a few hundred
+    entries. Files still at their old flat location are found too, until
+    ``flask storage-migrate`` moves them.
+``s3``
+    An S3 or S3-compatible (MinIO, ...) bucket, with the same sharded keys
+    under ``S3_PREFIX``. Needs ``boto3``. Uploads are served by redirecting
+    to ``S3_PUBLIC_URL`` (e.g. a CDN), or to presigned URLs without it.
+
+Either way, files are first written to ``UPLOAD_DIR/.incoming`` on local
+disk, then handed to the backend with :meth:`save`.
+"""
+import hashlib
+import mimetypes
+import os
+import posixpath
+import re
+import shutil
+import tempfile
+from functools import lru_cache
+
+from flask import Request, current_app
+
+CHUNK_SIZE = 64 * 1024
+# Uploads are written here first and renamed into place once complete
+STAGING_DIR = '.incoming'
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+_CONTENT_NAME = re.compile(r'^[0-9a-f]{64}(\.[a-z0-9]{1,10})?$')
+_DIGEST_PREFIX = re.compile(r'^[0-9a-f]{64}')
+# Extension of the stored file for each image format Pillow detects, so it is served with the right type
+IMAGE_EXTENSIONS = {'JPEG': '.jpg', 'MPO': '.jpg', 'PNG': '.png', 'GIF': '.gif', 'WEBP': '.webp',
+                    'BMP': '.bmp', 'TIFF': '.tif', 'ICO': '.ico', 'AVIF': '.avif'}
+
+
+def content_name(digest, image_format=None):
+    """Storage name for a file with hex ``digest`` whose bytes are an ``image_format`` image."""
+    return digest + IMAGE_EXTENSIONS.get(image_format, '')
+
+
+def is_content_addressed(name):
+    """True for names produced by :func:`content_name`, whose bytes never change."""
+    return bool(_CONTENT_NAME.match(name))
+
+
+def content_digest(name):
+    return name.split('.', 1)[0]
+
+
+def shard_path(key):
+    """Relative path of ``key`` in the sharded layout.
+
+    Content-addressed names are sharded by their own hash, anything else by
+    the hash of its name: ``derived/3f5a...c1-320w.webp`` is stored at
+    ``derived/3f/5a/3f5a...c1-320w.webp``.
+    """
+    folder, name = posixpath.split(key)
+    match = _DIGEST_PREFIX.match(name)
+    digest = match.group() if match else hashlib.sha256(name.encode()).hexdigest()
+    return posixpath.join(folder, digest[:2], digest[2:4], name)
+
+
+def _unshard(relative):
+    """The key stored at sharded path ``relative``, or None if it isn't one."""
+    parts = relative.split('/')
+    if len(parts) < 3:
+        return None
+    key = '/'.join(parts[:-3] + parts[-1:])
+    return key if shard_path(key) == relative else None
+
+
+class HashingFile:
+    """Temporary file that hashes bytes as they are written to it.
+
+    Used as the stream for multipart file uploads (see :class:`UploadRequest`),
+    so the request body goes to disk in fixed-size chunks and the content
+    hash is ready the moment parsing finishes, without reading the file back.
+    The file lives in ``<UPLOAD_DIR>/.incoming`` so that it can be renamed into
+    place atomically, and is removed on close unless it was kept.
+    """
+
+    def __init__(self, upload_dir):
+        staging = os.path.join(upload_dir, STAGING_DIR)
+        os.makedirs(staging, exist_ok=True)
+        fd, self.name = tempfile.mkstemp(dir=staging)
+        self._file = os.fdopen(fd, 'w+b')
+        self._sha = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self._sha.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def hexdigest(self):
+        return self._sha.hexdigest()
+
+    def finish(self):
+        """Make the file durable and readable, ready to hand to a storage backend."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        # mkstemp creates owner-only files; uploads are public
+        os.chmod(self.name, 0o644)
+
+    def close(self):
+        self._file.close()
+        if self.name is not None:
+            try:
+                os.unlink(self.name)
+            except FileNotFoundError:
+                pass
+            self.name = None
+
+    def __getattr__(self, attr):
+        # read, seek, tell, readline, ... come straight from the temporary file
+        return getattr(self._file, attr)
+
+    @classmethod
+    def copy_from(cls, stream, upload_dir):
+        hashing = cls(upload_dir)
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+            hashing.write(chunk)
+        return hashing
+
+
+class UploadRequest(Request):
+    """Request that streams uploaded files into :class:`HashingFile` objects.
+
+    The overall body size is capped by ``MAX_CONTENT_LENGTH``, which Werkzeug
+    enforces before parsing (from ``Content-Length``) and while reading.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        if filename is None:
+            return super()._get_file_stream(total_content_length, content_type,
+                                            filename, content_length)
+        return HashingFile(current_app.config['UPLOAD_DIR'])
+
+
+def ingest_upload(file, storage, image_format=None):
+    """Move an uploaded ``FileStorage`` into ``storage`` under its content hash.
+
+    ``image_format`` is the format Pillow detected in the upload, if any.
+    Returns ``(name, is_new)``. If identical bytes are already stored, under
+    whatever name, the new copy is discarded and ``is_new`` is False, so the
+    caller can point the new photo at the existing file.
+    """
+    stream = file.stream
+    if not isinstance(stream, HashingFile):
+        stream = HashingFile.copy_from(stream, storage.scratch_dir)
+    try:
+        digest = stream.hexdigest()
+        existing = storage.find_content(digest)
+        # Touched rather than just checked: a cleanup job leaves recently modified files alone,
+        # so the file cannot be removed before the caller's photo row is committed
+        if existing is not None and storage.touch(existing):
+            return existing, False
+        name = content_name(digest, image_format)
+        stream.finish()
+        return name, storage.save(name, stream.name)
+    finally:
+        stream.close()
+
+
+class _Backend:
+    def __init__(self, scratch_dir):
+        self.scratch_dir = str(scratch_dir)
+
+    def temp_path(self, suffix=''):
+        """Path of a new empty file in the staging directory, to be passed to :meth:`save`."""
+        staging = os.path.join(self.scratch_dir, STAGING_DIR)
+        os.makedirs(staging, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=staging, suffix=suffix)
+        os.close(fd)
+        os.chmod(path, 0o644)
+        return path
+
+
+class LocalStorage(_Backend):
+    """Files in hash-sharded directories under ``root`` (``UPLOAD_DIR``)."""
+
+    def __init__(self, root):
+        super().__init__(root)
+        self.root = str(root)
+
+    def path(self, key):
+        return os.path.join(self.root, *shard_path(key).split('/'))
+
+    def locate(self, key):
+        """Path of the stored file, sharded or at its old flat location; None if missing."""
+        for path in (self.path(key), os.path.join(self.root, *key.split('/'))):
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def exists(self, key, include_legacy=True):
+        if not include_legacy:
+            return os.path.isfile(self.path(key))
+        return self.locate(key) is not None
+
+    def find_content(self, digest):
+        """Key of a stored upload whose bytes hash to ``digest``, with any extension; None if none."""
+        # Every such key is in the same shard directory
+        try:
+            with os.scandir(os.path.dirname(self.path(digest))) as entries:
+                for entry in entries:
+                    if entry.name.startswith(digest) and is_content_addressed(entry.name):
+                        return entry.name
+        except FileNotFoundError:
+            pass
+        return None
+
+    def save(self, key, source, overwrite=False):
+        """Store the local file ``source`` as ``key``, consuming ``source``.
+
+        Returns False (and deletes ``source``) if ``key`` already exists and
+        ``overwrite`` is not set.
+        """
+        if not overwrite and self.exists(key):
+            os.unlink(source)
+            return False
+        target = self.path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(source, target)
+        return True
+
+    def open(self, key):
+        path = self.locate(key)
+        if path is None:
+            raise FileNotFoundError(key)
+        return open(path, 'rb')
+
+    def delete(self, key):
+        for path in (self.path(key), os.path.join(self.root, *key.split('/'))):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def modified(self, key):
+        """When the stored file was last written, as a Unix time; None if missing."""
+        path = self.locate(key)
+        return os.path.getmtime(path) if path else None
+
+    def touch(self, key):
+        """Set the file's modification time to now; return False if it is missing."""
+        path = self.locate(key)
+        if path is None:
+            return False
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def url(self, key):
+        return None
+
+    def keys(self):
+        """Every stored key, sharded or not."""
+        for relative in self._files():
+            yield _unshard(relative) or relative
+
+    def legacy_files(self):
+        """``(key, path)`` of files not yet in the sharded layout."""
+        for relative in self._files():
+            if _unshard(relative) is None:
+                yield relative, os.path.join(self.root, *relative.split('/'))
+
+    def _files(self):
+        for directory, subdirs, files in os.walk(self.root):
+            subdirs[:] = [name for name in subdirs if not name.startswith('.')]
+            for name in files:
+                if not name.startswith('.') and not name.endswith('.tmp'):
+                    relative = os.path.relpath(os.path.join(directory, name), self.root)
+                    yield relative.replace(os.sep, '/')
+
+
+class S3Storage(_Backend):
+    """Files in an S3 or S3-compatible bucket, under sharded keys."""
+
+    def __init__(self, bucket, scratch_dir, prefix='', endpoint_url=None, region=None,
+                 public_url=None, url_expiry=3600):
+        try:
+            import boto3
+            from botocore.exceptions import ClientError
+        except ImportError:
+            raise RuntimeError("STORAGE_BACKEND=s3 needs the 'boto3' package "
+                               "(pip install boto3)")
+        super().__init__(scratch_dir)
+        self.bucket = bucket
+        self.prefix = prefix or ''
+        self.public_url = public_url.rstrip('/') if public_url else None
+        self.url_expiry = url_expiry
+        self._client_error = ClientError
+        self._s3 = boto3.client('s3', endpoint_url=endpoint_url, region_name=region)
+
+    def object_key(self, key):
+        return self.prefix + shard_path(key)
+
+    def exists(self, key, include_legacy=True):
+        try:
+            self._s3.head_object(Bucket=self.bucket, Key=self.object_key(key))
+            return True
+        except self._client_error as error:
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def find_content(self, digest):
+        """Key of a stored upload whose bytes hash to ``digest``, with any extension; None if none."""
+        listing = self._s3.list_objects_v2(Bucket=self.bucket, Prefix=self.object_key(digest))
+        for item in listing.get('Contents', ()):
+            name = posixpath.basename(item['Key'])
+            if is_content_addressed(name):
+                return name
+        return None
+
+    def save(self, key, source, overwrite=False):
+        """Upload the local file ``source`` as ``key`` and delete ``source``."""
+        try:
+            if not overwrite and self.exists(key):
+                return False
+            extra = {'ContentType': mimetypes.guess_type(key)[0] or 'application/octet-stream'}
+            if _DIGEST_PREFIX.match(posixpath.basename(key)):
+                extra['CacheControl'] = IMMUTABLE_CACHE_CONTROL
+            self._s3.upload_file(source, self.bucket, self.object_key(key), ExtraArgs=extra)
+            return True
+        finally:
+            os.unlink(source)
+
+    def open(self, key):
+        """A seekable local copy of the object, as Pillow needs one."""
+        try:
+            body = self._s3.get_object(Bucket=self.bucket, Key=self.object_key(key))['Body']
+        except self._client_error as error:
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                raise FileNotFoundError(key)
+            raise
+        copy = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+        shutil.copyfileobj(body, copy, CHUNK_SIZE)
+        copy.seek(0)
+        return copy
+
+    def delete(self, key):
+        self._s3.delete_object(Bucket=self.bucket, Key=self.object_key(key))
+
+    def modified(self, key):
+        try:
+            head = self._s3.head_object(Bucket=self.bucket, Key=self.object_key(key))
+        except self._client_error as error:
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        return head['LastModified'].timestamp()
+
+    def touch(self, key):
+        """Copy the object onto itself, which sets its LastModified; False if it is missing."""
+        try:
+            head = self._s3.head_object(Bucket=self.bucket, Key=self.object_key(key))
+        except self._client_error as error:
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        # A copy with unchanged metadata is refused, so the metadata is replaced by the same
+        extra = {name: head[name] for name in ('ContentType', 'CacheControl') if name in head}
+        self._s3.copy_object(Bucket=self.bucket, Key=self.object_key(key),
+                             CopySource={'Bucket': self.bucket, 'Key': self.object_key(key)},
+                             MetadataDirective='REPLACE', Metadata=head.get('Metadata', {}),
+                             **extra)
+        return True
+
+    def url(self, key):
+        if self.public_url:
+            return self.public_url + '/' + self.object_key(key)
+        return self._s3.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': self.object_key(key)},
+            ExpiresIn=self.url_expiry)
+
+    def keys(self):
+        paginator = self._s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for item in page.get('Contents', ()):
+                relative = item['Key'][len(self.prefix):]
+                yield _unshard(relative) or relative
+
+
+def migrate_uploads(source_dir, storage, keep=False, report=print):
+    """Copy files stored flat in ``source_dir`` into ``storage``, sharded.
+
+    Each source file is deleted once it is stored, unless ``keep`` is set.
+    Files already present in the new layout are not copied again, so an
+    interrupted migration can simply be re-run. Returns ``(copied, skipped)``.
+    """
+    copied = skipped = 0
+    for key, path in list(LocalStorage(source_dir).legacy_files()):
+        if storage.exists(key, include_legacy=False):
+            skipped += 1
+        else:
+            tmp = storage.temp_path()
+            shutil.copyfile(path, tmp)
+            storage.save(key, tmp, overwrite=True)
+            copied += 1
+        if not keep:
+            os.unlink(path)
+        if (copied + skipped) % 1000 == 0:
+            report(f'{copied + skipped} files migrated')
+    return copied, skipped
+
+
+# Settings that describe the storage backend, see make_storage()
+STORAGE_SETTINGS = ('STORAGE_BACKEND', 'UPLOAD_DIR', 'S3_BUCKET', 'S3_PREFIX', 'S3_ENDPOINT_URL',
+                    'S3_REGION', 'S3_PUBLIC_URL', 'S3_URL_EXPIRY')
+
+
+def storage_settings(config):
+    """The storage part of ``config`` as a plain (picklable) tuple of pairs."""
+    return tuple((name, str(config.get(name)) if name == 'UPLOAD_DIR' else config.get(name))
+                 for name in STORAGE_SETTINGS)
+
+
+@lru_cache(maxsize=None)
+def make_storage(settings):
+    """The backend described by ``settings`` (see :func:`storage_settings`), one per process."""
+    config = dict(settings)
+    backend = config['STORAGE_BACKEND'] or 'local'
+    if backend == 'local':
+        return LocalStorage(config['UPLOAD_DIR'])
+    if backend == 's3':
+        return S3Storage(config['S3_BUCKET'], config['UPLOAD_DIR'], prefix=config['S3_PREFIX'],
+                         endpoint_url=config['S3_ENDPOINT_URL'], region=config['S3_REGION'],
+                         public_url=config['S3_PUBLIC_URL'],
+                         url_expiry=config['S3_URL_EXPIRY'] or 3600)
+    raise ValueError('Unknown STORAGE_BACKEND %r' % backend)
+
+
+def get_storage(app=None):
+    """The storage backend of ``app`` (default: the current app)."""
+    app = app or current_app
+    return make_storage(storage_settings(app.config))
@@ -0,0 +1,244 @@
+"""Search-as-you-type suggestions from an in-process prefix index.
+
+Every caption, photographer name and description word is kept, normalised
+(case-folded, accents removed), in one sorted list. A lookup is a binary
+search for the prefix followed by a short scan of the matching run, so it
+takes microseconds and never touches the database.
+
+The index is built from ``photo`` in the background as each gunicorn
+worker starts (see ``gunicorn.conf.py``), or else on first use. Uploads,
+edits and deletes made through the ORM in this process update it
+incrementally when their transaction commits. Changes made by other
+processes (another worker, ``flask import-catalogue``) bump the shared
+catalogue version of the grid cache; the index is then rebuilt in the
+background, at most every ``SUGGEST_REFRESH_SECONDS``.
+
+Memory is bounded by ``SUGGEST_MAX_ENTRIES``: a full build keeps the most
+frequent entries, and new entries are ignored while the index is full.
+"""
+import bisect
+import heapq
+import logging
+import re
+import threading
+import time
+import unicodedata
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from . import db
+from .cache import grid_cache
+from .models import Photo
+
+logger = logging.getLogger(__name__)
+
+# Lower ranks win ties on frequency
+KINDS = {'caption': 0, 'name': 1, 'term': 2}
+MAX_TEXT = 80
+TERM_LENGTH = (3, 30)
+# Matches looked at per lookup; a one-letter prefix can match thousands of entries
+SCAN_LIMIT = 512
+
+
+def normalise(text):
+    text = unicodedata.normalize('NFKD', text.casefold())
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(text.split())
+
+
+def photo_entries(caption, name, description):
+    """The ``(kind, text)`` pairs one photo contributes to the index."""
+    entries = set()
+    for kind, text in (('caption', caption), ('name', name)):
+        text = ' '.join((text or '').split())[:MAX_TEXT]
+        if text:
+            entries.add((kind, text))
+    for word in re.findall(r'\w+', description or ''):
+        if TERM_LENGTH[0] <= len(word) <= TERM_LENGTH[1]:
+            entries.add(('term', word.lower()))
+    return entries
+
+
+class SuggestIndex:
+    def __init__(self, max_entries=100_000):
+        self.max_entries = max_entries
+        # Sorted (normalised text, kind rank) keys, and key -> [display text, photo count]
+        self._keys = []
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.version = None
+        self.built_at = None
+
+    def __len__(self):
+        return len(self._keys)
+
+    def build(self, rows, version=None):
+        """Replace the contents with the entries of ``rows`` of (caption, name, description)."""
+        entries = {}
+        for row in rows:
+            for kind, text in photo_entries(*row):
+                key = (normalise(text), KINDS[kind])
+                entry = entries.setdefault(key, [text, 0])
+                entry[1] += 1
+        if len(entries) > self.max_entries:
+            keep = heapq.nlargest(self.max_entries, entries.items(), key=lambda item: item[1][1])
+            entries = dict(keep)
+        keys = sorted(entries)
+        with self._lock:
+            self._keys, self._entries = keys, entries
+            self.version, self.built_at = version, time.monotonic()
+
+    def add(self, caption, name, description):
+        with self._lock:
+            for kind, text in photo_entries(caption, name, description):
+                key = (normalise(text), KINDS[kind])
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry[1] += 1
+                elif len(self._keys) < self.max_entries:
+                    self._entries[key] = [text, 1]
+                    bisect.insort(self._keys, key)
+
+    def remove(self, caption, name, description):
+        with self._lock:
+            for kind, text in photo_entries(caption, name, description):
+                key = (normalise(text), KINDS[kind])
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del self._entries[key]
+                    del self._keys[bisect.bisect_left(self._keys, key)]
+
+    def suggest(self, prefix, limit=8):
+        """The ``limit`` most frequent entries starting with ``prefix``."""
+        prefix = normalise(prefix)
+        if not prefix:
+            return []
+        with self._lock:
+            start = bisect.bisect_left(self._keys, (prefix,))
+            matches = []
+            for key in self._keys[start:start + SCAN_LIMIT]:
+                if not key[0].startswith(prefix):
+                    break
+                text, count = self._entries[key]
+                matches.append((-count, key[1], key[0], text))
+        kinds = list(KINDS)
+        return [{'text': text, 'kind': kinds[rank], 'count': -count}
+                for count, rank, _, text in heapq.nsmallest(limit, matches)]
+
+
+def _rows():
+    return db.session.execute(select(Photo.caption, Photo.name, Photo.description)).yield_per(5000)
+
+
+def _version():
+    try:
+        return grid_cache().version()
+    except Exception:
+        return None
+
+
+def rebuild(app):
+    """Build the app's index from the database."""
+    index = app.extensions['suggest']
+    with app.app_context():
+        version = _version()
+        try:
+            index.build(_rows(), version)
+        except SQLAlchemyError:
+            logger.warning('Could not build the suggestion index', exc_info=True)
+            return
+        finally:
+            db.session.remove()
+    logger.info('Suggestion index built with %d entries', len(index))
+
+
+def suggest_index():
+    """The current app's index, built on first use and refreshed when other processes change photos."""
+    app = current_app._get_current_object()
+    index = app.extensions['suggest']
+    if index.built_at is None:
+        with app.extensions['suggest_build_lock']:
+            if index.built_at is None:
+                rebuild(app)
+    elif (_version() != index.version
+          and time.monotonic() - index.built_at >= app.config['SUGGEST_REFRESH_SECONDS']):
+        build_in_background(app)
+    return index
+
+
+def build_in_background(app):
+    """Rebuild the index on a thread, unless a build is already running."""
+    lock = app.extensions['suggest_build_lock']
+    if not lock.acquire(blocking=False):
+        return
+
+    def run():
+        try:
+            rebuild(app)
+        finally:
+            lock.release()
+    threading.Thread(target=run, daemon=True).start()
+
+
+# Incremental updates: collect changed photos at flush, apply them once the transaction commits
+
+def _values(photo, history=False):
+    state = inspect(photo)
+    values = []
+    for attr in ('caption', 'name', 'description'):
+        if history:
+            changed = state.attrs[attr].history
+            values.append(changed.deleted[0] if changed.deleted else getattr(photo, attr))
+        else:
+            values.append(getattr(photo, attr))
+    return tuple(values)
+
+
+def _after_flush(session, flush_context):
+    if not has_app_context() or 'suggest' not in current_app.extensions:
+        return
+    pending = session.info.setdefault('suggest_pending', [])
+    for photo in session.new:
+        if isinstance(photo, Photo):
+            pending.append(('add', _values(photo)))
+    for photo in session.dirty:
+        if isinstance(photo, Photo) and session.is_modified(photo):
+            old = _values(photo, history=True)
+            new = _values(photo)
+            if old != new:
+                pending.append(('remove', old))
+                pending.append(('add', new))
+    for photo in session.deleted:
+        if isinstance(photo, Photo):
+            pending.append(('remove', _values(photo)))
+
+
+def _after_commit(session):
+    pending = session.info.pop('suggest_pending', None)
+    if not pending or not has_app_context() or 'suggest' not in current_app.extensions:
+        return
+    index = current_app.extensions['suggest']
+    if index.built_at is None:
+        return
+    for action, values in pending:
+        getattr(index, action)(*values)
+
+
+def _after_rollback(session):
+    session.info.pop('suggest_pending', None)
+
+
+event.listen(Session, 'after_flush', _after_flush)
+event.listen(Session, 'after_commit', _after_commit)
+event.listen(Session, 'after_soft_rollback', lambda session, previous: _after_rollback(session))
+
+
+def init_suggest(app):
+    app.extensions['suggest'] = SuggestIndex(app.config['SUGGEST_MAX_ENTRIES'])
+    app.extensions['suggest_build_lock'] = threading.Lock()
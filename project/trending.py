@@ -0,0 +1,98 @@
+"""Time-decayed scores for the trending feed.
+
+A like made at time ``t`` counts ``2 ** -((now - t) / half_life)`` towards a
+photo's trending score: a whole like when it is new, half a like one
+half-life later. Decaying every score as time passes would mean rewriting
+every row, but the decay factor is the same for all photos, so it never
+changes their order ("forward decay"). What is stored is therefore the
+undecayed sum relative to a fixed ``EPOCH``, as a base 2 logarithm so that
+it cannot overflow::
+
+    trend_score = log2(sum of 2 ** ((t - EPOCH) / half_life))
+
+``likes.toggle_like`` adds or removes one like's term in the same
+transaction as the like itself, and the trending feed is a keyset page over
+the ``(trend_score, id)`` index. Photos without likes score 0.
+
+Every score depends on ``TRENDING_HALF_LIFE_HOURS``; after changing it run
+``flask --app project trending-rebuild``.
+"""
+import math
+from datetime import datetime
+from itertools import groupby
+
+from flask import current_app
+from sqlalchemy import select, update
+
+from . import db
+from .models import Like, Photo
+
+EPOCH = datetime(2024, 1, 1)
+
+
+def like_weight(created_at, half_life_hours):
+    """log2 of the term one like adds to the score; likes without a time count as made at EPOCH."""
+    if created_at is None:
+        return 0.0
+    return (created_at - EPOCH).total_seconds() / 3600 / half_life_hours
+
+
+def log_add(a, b):
+    """log2(2**a + 2**b) without leaving log space."""
+    high, low = max(a, b), min(a, b)
+    return high + math.log1p(2 ** (low - high)) / math.log(2)
+
+
+def log_sub(a, b):
+    """log2(2**a - 2**b), or None if rounding leaves nothing to subtract from."""
+    if b >= a:
+        return None
+    return a + math.log1p(-2 ** (b - a)) / math.log(2)
+
+
+def score_of(weights):
+    score = None
+    for weight in weights:
+        score = weight if score is None else log_add(score, weight)
+    return score or 0.0
+
+
+def apply_like(photo_id, created_at, added, like_count):
+    """Add or remove one like's term from the photo's score; call after the like row changed."""
+    half_life = current_app.config['TRENDING_HALF_LIFE_HOURS']
+    # Locks the row on PostgreSQL; SQLite already holds the write lock after the like changed
+    score = db.session.execute(select(Photo.trend_score).where(Photo.id == photo_id)
+                               .with_for_update()).scalar_one()
+    weight = like_weight(created_at, half_life)
+    if added:
+        score = weight if like_count == 1 else log_add(score, weight)
+    elif like_count == 0:
+        score = 0.0
+    else:
+        score = log_sub(score, weight)
+        if score is None:
+            score = score_of(like_weight(time, half_life) for time in db.session.scalars(
+                select(Like.created_at).where(Like.photo_id == photo_id)))
+    db.session.execute(update(Photo).where(Photo.id == photo_id).values(trend_score=score)
+                       .execution_options(synchronize_session=False))
+
+
+def rebuild_scores(batch_size=1000):
+    """Recompute every photo's score from its likes; return the number of photos with likes."""
+    half_life = current_app.config['TRENDING_HALF_LIFE_HOURS']
+    db.session.execute(update(Photo).values(trend_score=0)
+                       .execution_options(synchronize_session=False))
+    rows = db.session.execute(select(Like.photo_id, Like.created_at)
+                              .order_by(Like.photo_id)).yield_per(10000)
+    scores, scored = [], 0
+    for photo_id, likes in groupby(rows, key=lambda row: row[0]):
+        scores.append({'id': photo_id,
+                       'trend_score': score_of(like_weight(time, half_life) for _, time in likes)})
+        if len(scores) == batch_size:
+            db.session.execute(update(Photo), scores)
+            scored, scores = scored + len(scores), []
+    if scores:
+        db.session.execute(update(Photo), scores)
+        scored += len(scores)
+    db.session.commit()
+    return scored
@@ -8,8 +8,10 @@
 #Unit testing - rerunning test after every changes in the code
 #implemented pytest for dynamic testing of the authentication feature
 
+import os
 import pytest
 from flask import session
+from sqlalchemy import text
 from project import create_app, db
 from project.models import Photo, User
 
@@ -107,3 +109,985 @@ def test_search_xss(client):
     assert response.status_code == 200
     assert b"&lt;script&gt;alert(&#39;xss&#39;);&lt;/script&gt;" in response.data
 
+
+# Full-text search index
+@pytest.fixture
+def isolated_app(tmp_path):
+    app = create_app({
+        'TESTING': True,
+        'SECRET_KEY': 'test',
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'test.db'),
+        'UPLOAD_DIR': tmp_path,
+        'GRID_CACHE_VERSION_FILE': str(tmp_path / 'grid.version'),
+        # Tests run queued jobs themselves, with run_jobs(), and files of deleted photos go at once
+        'JOB_WORKERS': 0,
+        'CLEANUP_GRACE_SECONDS': 0,
+    })
+    with app.app_context():
+        db.create_all()
+        yield app
+
+def test_search_index_ranks_by_relevance(isolated_app):
+    from project.searchindex import search_photos
+    db.session.add_all([
+        Photo(name='Penguin Fan', caption='Beach', description='Sand', file='a.jpg'),
+        Photo(name='Someone', caption='Penguins on ice', description='Cold', file='b.jpg'),
+    ])
+    db.session.commit()
+
+    photos, has_next = search_photos('penguin', per_page=1)
+    # A caption hit outranks a name hit, and the second result is on the next page
+    assert [p.file for p in photos] == ['b.jpg']
+    assert has_next
+    photos, has_next = search_photos('penguin', page=2, per_page=1)
+    assert [p.file for p in photos] == ['a.jpg']
+    assert not has_next
+
+def test_search_index_follows_edits_and_deletes(isolated_app):
+    from project.searchindex import search_photos
+    photo = Photo(name='Edgar', caption='Oporto', description='Train station', file='c.jpg')
+    db.session.add(photo)
+    db.session.commit()
+
+    photo.caption = 'Lisbon'
+    db.session.commit()
+    assert search_photos('oporto')[0] == []
+    assert search_photos('lisbon')[0] == [photo]
+
+    db.session.delete(photo)
+    db.session.commit()
+    assert search_photos('lisbon')[0] == []
+    # Operators and quotes in user input are treated as plain words
+    assert search_photos('"; DROP TABLE photo; -- OR NEAR(')[0] == []
+
+def test_suggestions_follow_the_catalogue(isolated_app):
+    db.session.add_all([
+        Photo(name='Zoë', caption='Penguins on ice', description='Emperor penguins', file='a.jpg'),
+        Photo(name='Pat', caption='Penguins on ice', description='Cold', file='b.jpg'),
+    ])
+    db.session.commit()
+    client = isolated_app.test_client()
+
+    response = client.get('/suggest?q=PEN')
+    assert response.headers['Cache-Control'] == 'public, max-age=60'
+    # The most frequent match comes first, and names match without their accents
+    assert response.json['suggestions'][:2] == [
+        {'text': 'Penguins on ice', 'kind': 'caption', 'count': 2},
+        {'text': 'penguins', 'kind': 'term', 'count': 1},
+    ]
+    assert client.get('/suggest?q=zoe').json['suggestions'][0]['text'] == 'Zoë'
+
+    # Edits, uploads and deletes are applied to the index when they commit
+    photo = db.session.get(Photo, 2)
+    photo.caption = 'Puffins'
+    db.session.add(Photo(name='Kim', caption='Puffin burrow', file='c.jpg'))
+    db.session.commit()
+    texts = [s['text'] for s in client.get('/suggest?q=pu').json['suggestions']]
+    assert texts == ['Puffin burrow', 'Puffins']
+    db.session.delete(db.session.get(Photo, 1))
+    db.session.commit()
+    assert client.get('/suggest?q=pen').json['suggestions'] == []
+
+def test_suggest_index_is_bounded():
+    from project.suggest import SuggestIndex
+    index = SuggestIndex(max_entries=3)
+    index.build([('Common', None, None)] * 5 + [('Rare %d' % i, None, None) for i in range(5)])
+    assert len(index) == 3 and index.suggest('c')[0]['count'] == 5
+    index.add('Another', None, None)
+    assert len(index) == 3 and index.suggest('another') == []
+
+# Keyset pagination of the homepage feed
+def test_homepage_keyset_pagination(isolated_app):
+    isolated_app.config['PHOTOS_PER_PAGE'] = 2
+    db.session.add_all([Photo(name='n', caption='c', file='%s.jpg' % letter)
+                        for letter in 'dcbae'])
+    db.session.commit()
+    client = isolated_app.test_client()
+
+    seen = []
+    response = client.get('/')
+    while True:
+        html = response.get_data(as_text=True)
+        seen += [letter for letter in 'abcde' if '/uploads/%s.jpg' % letter in html]
+        if 'data-fragment="' not in html:
+            break
+        cursor_url = html.split('data-fragment="')[1].split('"')[0].replace('&amp;', '&')
+        response = client.get(cursor_url)
+        assert response.status_code == 200
+    assert seen == list('abcde')
+
+    # A garbled cursor, or one whose values have the wrong types, falls back to the first page
+    from project.pagination import encode_cursor
+    cached = len(isolated_app.extensions['grid_cache']._entries)
+    junk = ['not-a-cursor'] + [encode_cursor(values) for values in
+                               (['a', {'k': 1}], [[1], 2], ['a', None], ['a', True], [1, 'x'])]
+    for cursor in junk:
+        for path in ('/', '/popular', '/photos', '/api/photos'):
+            response = client.get(path, query_string={'after': cursor})
+            assert response.status_code == 200
+        assert '/uploads/a.jpg' in client.get('/', query_string={'after': cursor}).get_data(as_text=True)
+    # and share the cache entries of the first pages (only /popular's is new)
+    assert len(isolated_app.extensions['grid_cache']._entries) == cached + 1
+
+# Popular and trending feeds
+def test_popular_and_trending_feeds(isolated_app):
+    from datetime import timedelta
+    from project import likes, trending
+    from project.models import Like, utcnow
+    isolated_app.config['PHOTOS_PER_PAGE'] = 2
+    db.session.add_all([Photo(name='n', caption='c', file='%d.jpg' % i) for i in range(1, 5)])
+    db.session.commit()
+    # Photo 1 has three likes from two days ago, photo 2 two fresh likes, photo 3 one fresh like
+    for user_id in (1, 2, 3):
+        likes.toggle_like(user_id, 1)
+    db.session.execute(text('UPDATE "like" SET created_at = :at'), {'at': utcnow() - timedelta(hours=48)})
+    db.session.commit()
+    assert trending.rebuild_scores() == 1
+    for user_id, photo_id in ((1, 2), (2, 2), (1, 3), (2, 3)):
+        likes.toggle_like(user_id, photo_id)
+    likes.toggle_like(2, 3)  # Unlike again
+
+    client = isolated_app.test_client()
+    def feed(path):
+        seen, response = [], client.get(path)
+        while True:
+            html = response.get_data(as_text=True)
+            seen += [int(part.split('"')[0]) for part in html.split('data-id="')[1:]]
+            if 'data-fragment="' not in html:
+                return seen
+            response = client.get(html.split('data-fragment="')[1].split('"')[0].replace('&amp;', '&'))
+    assert feed('/popular') == [1, 2, 3, 4]
+    # Three likes two half-lives old weigh 0.75, less than one fresh like
+    assert feed('/trending') == [2, 3, 1, 4]
+
+    # Incremental scores match a rebuild from the Like rows
+    incremental = [photo.trend_score for photo in Photo.query.order_by(Photo.id)]
+    trending.rebuild_scores()
+    assert [photo.trend_score for photo in Photo.query.order_by(Photo.id)] == pytest.approx(incremental)
+    assert Like.query.filter(Like.created_at.is_(None)).count() == 0
+    assert client.get('/photos?feed=unknown').status_code == 404
+
+# JSON API
+def test_json_api_pages_caches_and_exports(isolated_app):
+    import json
+    from sqlalchemy import event
+    from project import likes
+    db.session.add_all([User(google_id=str(i), email='%d@example.com' % i, name='User %d' % i)
+                        for i in (1, 2)])
+    db.session.add_all([Photo(name='n', caption='Penguin %d' % i, file='%d.jpg' % i, user_id=1 + i % 2)
+                        for i in range(1, 8)])
+    db.session.commit()
+    likes.toggle_like(1, 3)
+    client = isolated_app.test_client()
+
+    statements = []
+    event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+    with client.session_transaction() as sess:
+        sess['current_user_id'] = 1
+    ids, after = [], ''
+    while after is not None:
+        statements.clear()
+        page = client.get('/api/photos?feed=popular&limit=3&after=' + after).get_json()
+        # The page, its owners and the user's likes, however many photos are on it
+        assert len(statements) <= 3
+        ids += [photo['id'] for photo in page['photos']]
+        after = page['next']
+    assert ids == [3, 7, 6, 5, 4, 2, 1]
+    photo = client.get('/api/photos/3').get_json()
+    assert photo['liked'] and photo['like_count'] == 1 and photo['url'] == '/uploads/3.jpg'
+    assert photo['owner'] == {'id': 2, 'name': 'User 2', 'profile_pic': None}
+    assert client.get('/api/photos/99').status_code == 404
+
+    response = client.get('/api/users/2/photos')
+    assert [photo['id'] for photo in response.get_json()['photos']] == [7, 5, 3, 1]
+    # Unchanged answers are revalidated with their ETag
+    assert client.get('/api/users/2/photos',
+                      headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+    # A logged-in user's answers are kept out of shared caches
+    assert 'Cookie' in response.vary and response.cache_control.private
+    anonymous = isolated_app.test_client().get('/api/users/2/photos')
+    assert 'Cookie' in anonymous.vary and not anonymous.cache_control.private
+    assert anonymous.headers['ETag'] != response.headers['ETag']
+    # Compression makes the ETag weak, as the bytes differ, and it still revalidates
+    compressed = client.get('/api/users/2/photos?limit=50', headers={'Accept-Encoding': 'gzip'})
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert compressed.headers['ETag'].startswith('W/"')
+    assert compressed.headers['ETag'][2:] == client.get('/api/users/2/photos?limit=50').headers['ETag']
+    assert client.get('/api/users/2/photos?limit=50', headers={
+        'Accept-Encoding': 'gzip', 'If-None-Match': compressed.headers['ETag']}).status_code == 304
+    db.session.get(Photo, 1).caption = 'Edited'
+    db.session.commit()
+    assert client.get('/api/users/2/photos',
+                      headers={'If-None-Match': response.headers['ETag']}).status_code == 200
+
+    search = client.get('/api/search?q=penguin&limit=5').get_json()
+    assert len(search['photos']) == 5 and search['next_page'] == 2
+
+    export = client.get('/api/export.ndjson')
+    assert export.mimetype == 'application/x-ndjson' and export.is_streamed
+    rows = [json.loads(line) for line in export.get_data(as_text=True).splitlines()]
+    assert [row['id'] for row in rows] == list(range(1, 8))
+    assert 'email' not in json.dumps(rows)
+
+# Resized derivatives for the photo grid
+def test_derivatives_are_generated_and_served(isolated_app, tmp_path):
+    from PIL import Image
+    from project.derivatives import generate_derivatives, image_size
+    from project.storage import get_storage
+    Image.new('RGB', (800, 600), 'red').save(tmp_path / 'big.jpg')
+    assert image_size(tmp_path / 'big.jpg') == (800, 600)
+    # PNGs are measured from their header, without decoding the pixels; EXIF rotation still counts
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    Image.new('RGB', (800, 600)).save(tmp_path / 'turned.png', exif=exif)
+    assert image_size(tmp_path / 'turned.png') == (600, 800)
+    Image.new('RGB', (800, 600)).save(tmp_path / 'plain.png')
+    data = (tmp_path / 'plain.png').read_bytes()
+    (tmp_path / 'cut.png').write_bytes(data[:data.index(b'IDAT') + 10])
+    assert image_size(tmp_path / 'cut.png') == (800, 600)
+
+    db.session.add(Photo(name='n', caption='c', file='big.jpg', width=800, height=600))
+    db.session.commit()
+    client = isolated_app.test_client()
+    html = client.get('/').get_data(as_text=True)
+    assert '/uploads/big.jpg/w320 320w' in html and 'width="800"' in html
+
+    # Before the worker runs, the original is served in place of the derivative
+    assert client.get('/uploads/big.jpg/w320').mimetype == 'image/jpeg'
+    storage = get_storage()
+    assert generate_derivatives(storage, 'big.jpg') == [640, 320]
+    response = client.get('/uploads/big.jpg/w320')
+    assert response.mimetype == 'image/webp'
+    with Image.open(storage.path('derived/big-320w.webp')) as image:
+        assert image.size == (320, 240)
+
+    # The backfill works from the photo rows, and skips and lists those whose file is missing
+    from project.commands import derivatives_backfill_command
+    Image.new('RGB', (700, 500)).save(tmp_path / 'unsized.jpg')
+    db.session.add_all([Photo(name='n', caption='c', file='unsized.jpg'),
+                        Photo(name='n', caption='c', file='gone.jpg')])
+    db.session.commit()
+    result = isolated_app.test_cli_runner().invoke(derivatives_backfill_command)
+    assert result.exit_code == 0
+    assert 'Wrote 2 derivatives for 2 photos.' in result.output
+    assert 'Skipped 1 files that are missing from storage: gone.jpg' in result.output
+    assert Photo.query.filter_by(file='unsized.jpg').one().width == 700
+
+# Content-addressed uploads with long-lived caching
+def upload_photo(client, data, filename='photo.jpg'):
+    import io
+    with client.session_transaction() as sess:
+        sess['current_user_id'] = 1
+    return client.post('/upload/', data={
+        'fileToUpload': (io.BytesIO(data), filename),
+        'user': 'n', 'caption': 'c', 'description': 'd',
+    }, content_type='multipart/form-data')
+
+def test_uploads_are_content_addressed_and_cacheable(isolated_app, tmp_path):
+    import hashlib
+    isolated_app.config['WTF_CSRF_ENABLED'] = False
+    client = isolated_app.test_client()
+    upload_photo(client, b'first', 'same.jpg')
+    upload_photo(client, b'second', 'same.jpg')
+    names = sorted(photo.file for photo in Photo.query.all())
+    # Re-using a filename no longer overwrites the earlier upload. They are not images, so get no extension
+    assert names == sorted(hashlib.sha256(data).hexdigest() for data in (b'first', b'second'))
+
+    name = hashlib.sha256(b'first').hexdigest()
+    response = client.get('/uploads/' + name)
+    assert response.headers['ETag'] == '"%s"' % hashlib.sha256(b'first').hexdigest()
+    assert 'immutable' in response.headers['Cache-Control']
+    assert client.get('/uploads/' + name, headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+    partial = client.get('/uploads/' + name, headers={'Range': 'bytes=1-3'})
+    assert partial.status_code == 206 and partial.data == b'irs'
+
+    isolated_app.config['UPLOAD_ACCEL_PREFIX'] = '/protected/'
+    response = client.get('/uploads/' + name)
+    assert response.headers['X-Accel-Redirect'] == '/protected/%s/%s/%s' % (name[:2], name[2:4], name)
+    assert response.data == b''
+
+# Streaming, deduplicating upload ingest
+def test_duplicate_uploads_share_stored_bytes(isolated_app, tmp_path):
+    isolated_app.config['WTF_CSRF_ENABLED'] = False
+    client = isolated_app.test_client()
+    upload_photo(client, b'x' * 200000, 'one.jpg')
+    upload_photo(client, b'x' * 200000, 'two.jpg')
+    photos = Photo.query.all()
+    assert len(photos) == 2 and photos[0].file == photos[1].file
+    assert sorted(os.listdir(tmp_path / '.incoming')) == []
+    from project.storage import get_storage
+    from project.storage import is_content_addressed
+    assert [key for key in get_storage().keys() if is_content_addressed(key)] == [photos[0].file]
+
+def test_identical_images_are_stored_once_whatever_their_name(isolated_app, tmp_path):
+    import hashlib
+    import io
+    from PIL import Image
+    from project.storage import get_storage, is_content_addressed
+    isolated_app.config['WTF_CSRF_ENABLED'] = False
+    client = isolated_app.test_client()
+    image = io.BytesIO()
+    Image.new('RGB', (8, 8)).save(image, 'JPEG')
+    for filename in ('a.jpg', 'a.jpeg', 'A.JPG', 'renamed.png', 'no-extension'):
+        upload_photo(client, image.getvalue(), filename)
+    # The extension comes from the detected format, not from any of the names
+    name = hashlib.sha256(image.getvalue()).hexdigest() + '.jpg'
+    assert {photo.file for photo in Photo.query.all()} == {name}
+    assert [key for key in get_storage().keys() if is_content_addressed(key)] == [name]
+    assert client.get('/uploads/' + name).mimetype == 'image/jpeg'
+
+def test_oversized_upload_is_rejected(isolated_app, tmp_path):
+    isolated_app.config['WTF_CSRF_ENABLED'] = False
+    isolated_app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024
+    response = upload_photo(isolated_app.test_client(), b'x' * (2 * 1024 * 1024))
+    assert response.status_code == 302 and response.location.endswith('/upload/')
+    assert Photo.query.count() == 0
+
+def test_decompression_bomb_is_stored_as_a_plain_file(isolated_app, tmp_path):
+    import struct
+    import zlib
+    from project.models import Job
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    # A ~60 byte PNG whose header claims 20000x20000 pixels
+    bomb = (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', 20000, 20000, 8, 2, 0, 0, 0))
+            + chunk(b'IEND', b''))
+    isolated_app.config['WTF_CSRF_ENABLED'] = False
+    response = upload_photo(isolated_app.test_client(), bomb, 'bomb.png')
+    assert response.status_code == 302
+    photo = Photo.query.one()
+    assert (photo.width, photo.height, photo.phash) == (None, None, None)
+    assert Job.query.filter_by(kind='derivatives').count() == 0
+
+# Near-duplicate detection with perceptual hashes
+def test_near_duplicate_uploads_are_flagged(isolated_app, tmp_path):
+    import io
+    from PIL import Image, ImageDraw
+    from project.commands import phash_backfill_command
+    from project.similar import hamming, image_hash
+
+    def encode(image, format):
+        buffer = io.BytesIO()
+        image.save(buffer, format)
+        return buffer.getvalue()
+
+    original = Image.radial_gradient('L').resize((640, 480)).convert('RGB')
+    ImageDraw.Draw(original).rectangle((60, 60, 300, 200), fill='navy')
+    other = Image.linear_gradient('L').rotate(90).resize((640, 480)).convert('RGB')
+    # A smaller, re-encoded copy hashes (almost) the same; a different picture does not
+    copy = encode(original.resize((320, 240)), 'PNG')
+    assert hamming(image_hash(io.BytesIO(encode(original, 'JPEG'))), image_hash(io.BytesIO(copy))) <= 2
+    assert hamming(image_hash(io.BytesIO(encode(original, 'JPEG'))), image_hash(io.BytesIO(encode(other, 'JPEG')))) > 12
+
+    from project.jobs import run_jobs
+    isolated_app.config['WTF_CSRF_ENABLED'] = False
+    client = isolated_app.test_client()
+    upload_photo(client, encode(original, 'JPEG'))
+    upload_photo(client, encode(other, 'JPEG'))
+    run_jobs()
+    client.get('/')  # Clear the flashed messages
+    # The upload request only reads the image header; the hash is computed by the background job
+    upload_photo(client, copy, 'copy.png')
+    assert Photo.query.filter_by(id=3).one().phash is None
+    html = client.get('/').get_data(as_text=True)
+    assert 'flash-message warning' not in html
+    run_jobs()
+    html = client.get('/').get_data(as_text=True)
+    assert 'flash-message warning' in html and 'looks like &#34;c&#34;, already in the gallery' in html
+    assert 'flash-message warning' not in client.get('/').get_data(as_text=True)
+    # An identical re-upload reuses the stored hash and is flagged straight away
+    upload_photo(client, copy, 'again.png')
+    assert 'looks like' in client.get('/').get_data(as_text=True)
+
+    html = client.get('/photo/1/similar/').get_data(as_text=True)
+    assert 'data-id="3"' in html and 'data-id="2"' not in html and 'data-id="1"' not in html
+
+    # The backfill hashes photos stored before hashes were recorded
+    db.session.execute(text('UPDATE photo SET phash = NULL'))
+    db.session.commit()
+    result = isolated_app.test_cli_runner().invoke(phash_backfill_command)
+    assert 'Hashed 3 files.' in result.output
+    assert db.session.scalar(text('SELECT COUNT(*) FROM photo WHERE phash IS NULL')) == 0
+
+# Atomic like toggling
+def test_toggle_like_json_keeps_count_in_sync(isolated_app):
+    from project.models import Like
+    isolated_app.config['WTF_CSRF_ENABLED'] = False
+    db.session.add(Photo(name='n', caption='c', file='a.jpg'))
+    db.session.commit()
+    client = isolated_app.test_client()
+    assert client.post('/toggle_like/1/json').status_code == 401
+    with client.session_transaction() as sess:
+        sess['current_user_id'] = 7
+
+    assert client.post('/toggle_like/1/json').get_json() == {'photo_id': 1, 'liked': True, 'like_count': 1}
+    assert client.post('/toggle_like/1/json').get_json() == {'photo_id': 1, 'liked': False, 'like_count': 0}
+    assert client.post('/toggle_like/1/json').get_json()['like_count'] == 1
+    assert client.post('/toggle_like/99/json').status_code == 404
+
+    # The unique index rejects a duplicate like even if it bypasses the toggle
+    import sqlalchemy.exc
+    db.session.add(Like(user_id=7, photo_id=1))
+    with pytest.raises(sqlalchemy.exc.IntegrityError):
+        db.session.commit()
+    db.session.rollback()
+
+# Rendered grid cache
+def test_grid_cache_is_shared_and_invalidated(isolated_app):
+    isolated_app.config['WTF_CSRF_ENABLED'] = False
+    db.session.add(Photo(name='n', caption='Original caption', file='a.jpg', user_id=1))
+    db.session.commit()
+    client = isolated_app.test_client()
+    assert 'Original caption' in client.get('/').get_data(as_text=True)
+
+    # A change made behind the app's back is not seen while the page is cached...
+    db.session.execute(text("UPDATE photo SET caption = 'Sneaky'"))
+    db.session.commit()
+    assert 'Original caption' in client.get('/').get_data(as_text=True)
+
+    # ...but every change made through the app invalidates it
+    with client.session_transaction() as sess:
+        sess['current_user_id'] = 1
+    client.post('/photo/1/edit/', data={'user': 'n', 'caption': 'Edited', 'description': ''})
+    html = client.get('/').get_data(as_text=True)
+    assert 'Edited' in html and 'class="image-box" data-id="1"' in html
+
+    # The liked state and the like count are layered on per request, so a like keeps the cache
+    cache = isolated_app.extensions['grid_cache']
+    version, entries = cache.version(), dict(cache._entries)
+    client.post('/toggle_like/1/json')
+    html = client.get('/').get_data(as_text=True)
+    assert 'class="image-box liked" data-id="1"' in html
+    assert '<span class="like-count" title="Likes">1</span>' in html
+    assert cache.version() == version and dict(cache._entries) == entries
+    anonymous = isolated_app.test_client().get('/').get_data(as_text=True)
+    assert 'class="image-box" data-id="1"' in anonymous
+    assert '<span class="like-count" title="Likes">1</span>' in anonymous
+
+    # Cached pages of the ranked feeds keep their order for GRID_CACHE_RANKED_SECONDS
+    db.session.add(Photo(name='n', caption='c', file='b.jpg', user_id=1))
+    db.session.commit()
+    def popular():
+        html = client.get('/popular').get_data(as_text=True)
+        return [int(part.split('"')[0]) for part in html.split('data-id="')[1:]]
+    assert popular() == [1, 2]
+    client.post('/toggle_like/1/json')
+    client.post('/toggle_like/2/json')
+    assert popular() == [1, 2]
+    isolated_app.config['GRID_CACHE_RANKED_SECONDS'] = 0
+    assert popular() == [2, 1]
+
+# Lean grid markup and response compression
+def test_grid_actions_share_one_form(isolated_app):
+    isolated_app.config['WTF_CSRF_ENABLED'] = False
+    db.session.add_all([Photo(name='n', caption='c', file='a b.jpg', width=800, user_id=1),
+                        Photo(name='n', caption='c', file='b.jpg', user_id=1)])
+    db.session.commit()
+    client = isolated_app.test_client()
+    html = client.get('/').get_data(as_text=True)
+    assert html.count('csrf_token') == 1 and 'formaction' not in html
+    assert 'src="/uploads/a%20b.jpg/w320"' in html and 'href="/photo/2/edit/"' in html
+    assert '<button type="submit" form="photo-actions" name="like" value="2"' in html
+
+    with client.session_transaction() as sess:
+        sess['current_user_id'] = 1
+    response = client.post('/photo-actions', data={'like': '2'},
+                           headers={'Accept': 'application/json'})
+    assert response.get_json() == {'photo_id': 2, 'liked': True, 'like_count': 1}
+    assert client.post('/photo-actions', data={'like': '2'}).status_code == 302
+    assert db.session.get(Photo, 2).like_count == 0
+    client.post('/photo-actions', data={'delete': '2'})
+    assert db.session.get(Photo, 2) is None
+    assert client.post('/photo-actions', data={'share': '1'}).status_code == 400
+
+def test_text_responses_are_compressed(isolated_app):
+    import gzip
+    db.session.add_all([Photo(name='n', caption='c', file='%d.jpg' % i) for i in range(10)])
+    db.session.commit()
+    client = isolated_app.test_client()
+    plain = client.get('/')
+    assert 'Content-Encoding' not in plain.headers and 'Accept-Encoding' in plain.vary
+    response = client.get('/', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.data) == plain.data and len(response.data) < len(plain.data) / 4
+    # Small bodies are sent as they are
+    assert 'Content-Encoding' not in client.get('/healthz', headers={'Accept-Encoding': 'gzip'}).headers
+    brotli = pytest.importorskip('brotli')
+    response = client.get('/', headers={'Accept-Encoding': 'gzip, br'})
+    assert brotli.decompress(response.data) == plain.data
+
+def test_lru_cache_is_bounded(tmp_path):
+    from project.cache import LRUCache
+    cache = LRUCache(str(tmp_path / 'version'), max_entries=2, max_bytes=10)
+    cache.set('a', 'A', size=4)
+    cache.set('b', 'B', size=4)
+    cache.get('a')
+    cache.set('c', 'C', size=4)
+    # 'b' was least recently used and had to go to stay under 10 bytes
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == ('A', None, 'C')
+    version = cache.version()
+    cache.bump_version()
+    assert cache.version() > version and cache.get('a') is None
+
+# Engine configuration and migrations
+def test_sqlite_connections_use_wal(isolated_app):
+    with db.engine.connect() as conn:
+        assert conn.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+        assert conn.execute(text('PRAGMA busy_timeout')).scalar() == 5000
+        assert conn.execute(text('PRAGMA synchronous')).scalar() == 1  # NORMAL
+
+def test_migrations_upgrade_a_legacy_database(tmp_path):
+    import sqlite3
+    from sqlalchemy import inspect
+    from project import migrations
+    legacy = sqlite3.connect(tmp_path / 'legacy.db')
+    legacy.executescript('''
+        CREATE TABLE user (id INTEGER PRIMARY KEY, google_id VARCHAR(100), email VARCHAR(100),
+                           name VARCHAR(100), profile_pic VARCHAR(250));
+        CREATE TABLE photo (id INTEGER PRIMARY KEY, name VARCHAR(50), caption VARCHAR(250),
+                            file VARCHAR(250), description VARCHAR(600), user_id INTEGER);
+        CREATE TABLE "like" (id INTEGER PRIMARY KEY, user_id INTEGER, photo_id INTEGER);
+        INSERT INTO photo (name, caption, file) VALUES ('n', 'Gentoo penguin', 'a.jpg');
+        INSERT INTO "like" (user_id, photo_id) VALUES (1, 1), (1, 1), (2, 1);
+    ''')
+    legacy.commit()
+    legacy.close()
+
+    app = create_app({'SECRET_KEY': 'test',
+                      'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'legacy.db')})
+    with app.app_context():
+        assert [applied for _, applied in migrations.status()] == [False] * len(migrations.MIGRATIONS)
+        assert migrations.upgrade() == [migration_id for migration_id, _ in migrations.MIGRATIONS]
+        assert migrations.upgrade() == []
+
+        indexes = {index['name'] for table in ('photo', 'like')
+                   for index in inspect(db.engine).get_indexes(table)}
+        assert {'ix_photo_file', 'ix_photo_user_id', 'ix_like_photo_id', 'uq_like_user_photo'} <= indexes
+        # The duplicate like is gone and the count reflects the remaining ones
+        assert db.session.get(Photo, 1).like_count == 2
+        # Likes of unknown age count as made at trending.EPOCH: log2(1 + 1)
+        assert db.session.get(Photo, 1).trend_score == 1.0
+        from project.searchindex import search_photos
+        assert search_photos('penguin')[0][0].file == 'a.jpg'
+
+# Bulk catalogue import
+def test_import_catalogue_batches_and_resumes(isolated_app, tmp_path):
+    import json
+    from PIL import Image
+    from project import catalogue
+    images = tmp_path / 'images'
+    images.mkdir()
+    for i in range(5):
+        Image.new('RGB', (40 + i, 30), 'blue').save(images / ('%d.png' % i))
+    (images / 'notes.txt').write_text('not an image')
+    manifest = tmp_path / 'manifest.jsonl'
+    rows = [{'file': '%d.png' % i, 'name': 'n', 'caption': 'Photo %d' % i} for i in range(5)]
+    rows.insert(2, {'file': 'notes.txt', 'name': 'n', 'caption': 'Bad'})
+    manifest.write_text('\n'.join(json.dumps(row) for row in rows))
+
+    # Simulate a crash after the first committed batch
+    calls = []
+    def crash_on_second_batch(results):
+        calls.append(1)
+        if len(calls) == 2:
+            raise KeyboardInterrupt
+        return results
+    original_insert = catalogue.insert
+    catalogue.insert = lambda table: crash_on_second_batch(original_insert(table))
+    try:
+        with pytest.raises(KeyboardInterrupt):
+            catalogue.import_catalogue(str(manifest), str(images),
+                                       batch_size=2, workers=1, report=lambda line: None)
+    finally:
+        catalogue.insert = original_insert
+    db.session.rollback()
+    assert Photo.query.count() == 2
+
+    imported, skipped = catalogue.import_catalogue(str(manifest), str(images),
+                                                   batch_size=2, workers=1,
+                                                   report=lambda line: None)
+    assert (imported, skipped) == (3, 1)
+    photos = Photo.query.order_by(Photo.id).all()
+    assert [photo.caption for photo in photos] == ['Photo %d' % i for i in range(5)]
+    from project.storage import get_storage
+    assert photos[4].width == 44 and os.path.exists(get_storage().path(photos[4].file))
+
+# Instrumentation and /metrics
+def test_metrics_count_requests_queries_and_templates(isolated_app):
+    db.session.add(Photo(name='n', caption='c', file='a.jpg'))
+    db.session.commit()
+    client = isolated_app.test_client()
+    client.get('/')
+    body = client.get('/metrics').get_data(as_text=True)
+    assert 'photos_request_duration_seconds_count{endpoint="main.homepage",status="200"}' in body
+    assert 'photos_sql_statements_per_request_count{endpoint="main.homepage"}' in body
+    assert 'photos_template_render_duration_seconds_count{template="index.html"}' in body
+
+    isolated_app.config['METRICS_TOKEN'] = 'secret'
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer secret'}).status_code == 200
+
+def test_n_plus_one_queries_are_detected(isolated_app, caplog):
+    from project.metrics import N_PLUS_ONE
+    @isolated_app.route('/n-plus-one')
+    def n_plus_one():
+        for photo_id in range(10):
+            db.session.get(Photo, photo_id)
+        return 'ok'
+    before = N_PLUS_ONE._values[('n_plus_one',)]
+    isolated_app.test_client().get('/n-plus-one')
+    assert N_PLUS_ONE._values[('n_plus_one',)] == before + 1
+    assert 'Possible N+1 query in n_plus_one' in caplog.text
+
+def test_profiling_is_opt_in(isolated_app):
+    client = isolated_app.test_client()
+    assert b'cumulative' not in client.get('/', headers={'X-Profile': '1'}).data
+    isolated_app.config['PROFILING_ENABLED'] = True
+    assert b'cumulative' in client.get('/', headers={'X-Profile': '1'}).data
+
+def test_failing_requests_and_statements_leave_no_instrumentation_behind(isolated_app):
+    import sys
+    from sqlalchemy.exc import OperationalError
+    @isolated_app.route('/broken')
+    def broken():
+        db.session.execute(text('SELECT * FROM no_such_table'))
+    isolated_app.config['PROFILING_ENABLED'] = True
+    client = isolated_app.test_client()
+    with pytest.raises(OperationalError):
+        client.get('/broken', headers={'X-Profile': '1'})
+    # The profiler of the failed request is off again, and the next one can start
+    assert sys.getprofile() is None
+    assert b'cumulative' in client.get('/', headers={'X-Profile': '1'}).data
+    with db.engine.connect() as connection:
+        with pytest.raises(OperationalError):
+            connection.execute(text('SELECT * FROM no_such_table'))
+        assert not connection.info.get('query_start')
+
+# Google sign-in against a local stub identity provider
+@pytest.fixture
+def stub_idp():
+    import json
+    import threading
+    import time
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from joserfc import jwt
+    from joserfc.jwk import RSAKey
+
+    key = RSAKey.generate_key(2048, parameters={'kid': 'key-1'})
+    idp = {'hits': [], 'nonce': None, 'sub': 'stub-user', 'name': 'Stub User'}
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _json(self, body):
+            data = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            idp['hits'].append(self.path)
+            if self.path == '/.well-known/openid-configuration':
+                self._json({'issuer': idp['url'],
+                            'authorization_endpoint': idp['url'] + '/authorize',
+                            'token_endpoint': idp['url'] + '/token',
+                            'userinfo_endpoint': idp['url'] + '/userinfo',
+                            'jwks_uri': idp['url'] + '/jwks'})
+            elif self.path == '/jwks':
+                self._json({'keys': [key.as_dict(private=False)]})
+            else:
+                self.send_error(404)
+
+        def do_POST(self):
+            idp['hits'].append(self.path)
+            self.rfile.read(int(self.headers['Content-Length']))
+            now = int(time.time())
+            claims = {'iss': idp['url'], 'aud': 'client-id', 'sub': idp['sub'], 'iat': now,
+                      'exp': now + 300, 'nonce': idp['nonce'], 'email': 'stub@example.com',
+                      'name': idp['name']}
+            id_token = jwt.encode({'alg': 'RS256', 'kid': 'key-1'}, claims, key)
+            self._json({'access_token': 'access', 'token_type': 'Bearer', 'expires_in': 300,
+                        'id_token': id_token})
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    idp['url'] = 'http://127.0.0.1:%d' % server.server_port
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield idp
+    server.shutdown()
+
+def test_login_verifies_id_token_with_cached_provider_keys(stub_idp, tmp_path):
+    from urllib.parse import parse_qs, urlsplit
+    app = create_app({
+        'TESTING': True,
+        'SECRET_KEY': 'test',
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'test.db'),
+        'GOOGLE_CLIENT_ID': 'client-id',
+        'GOOGLE_CLIENT_SECRET': 'client-secret',
+        'OIDC_METADATA_URL': stub_idp['url'] + '/.well-known/openid-configuration',
+    })
+    with app.app_context():
+        db.create_all()
+    user_writes = []
+    from sqlalchemy import event
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute',
+                     lambda conn, cursor, statement, *args: user_writes.append(statement)
+                     if statement.startswith(('INSERT INTO user', 'UPDATE user')) else None)
+
+    def login(client):
+        response = client.get('/login')
+        query = parse_qs(urlsplit(response.headers['Location']).query)
+        stub_idp['nonce'] = query['nonce'][0]
+        return client.get('/login/authorized?code=abc&state=' + query['state'][0])
+
+    client = app.test_client()
+    for _ in range(2):
+        assert login(client).status_code == 302
+        with client.session_transaction() as sess:
+            assert sess['current_user_id'] == 1
+    hits = stub_idp['hits']
+    assert hits.count('/.well-known/openid-configuration') == 1
+    assert hits.count('/jwks') == 1
+    assert hits.count('/token') == 2 and '/userinfo' not in hits
+    # The repeat login with an unchanged profile wrote nothing
+    assert len(user_writes) == 1
+
+    stub_idp['name'] = 'Renamed'
+    login(client)
+    with app.app_context():
+        assert db.session.get(User, 1).name == 'Renamed'
+
+    # A token for another nonce is rejected
+    client = app.test_client()
+    response = client.get('/login')
+    state = parse_qs(urlsplit(response.headers['Location']).query)['state'][0]
+    stub_idp['nonce'] = 'wrong'
+    client.get('/login/authorized?code=abc&state=' + state)
+    with client.session_transaction() as sess:
+        assert 'current_user_id' not in sess
+
+# Startup
+def test_startup_defers_heavy_integrations():
+    import subprocess
+    import sys
+    from benchmarks.startup import LAZY_MODULES
+    probe = 'import sys, wsgi; print(" ".join(sorted(sys.modules)))'
+    env = dict(os.environ, SECRET_KEY='test', DATABASE_URL='sqlite://')
+    modules = subprocess.run([sys.executable, '-c', probe], env=env, capture_output=True,
+                             text=True, check=True).stdout.split()
+    assert 'wsgi' in modules
+    assert not [name for name in LAZY_MODULES if name in modules]
+
+# Health checks
+def test_health_and_readiness(isolated_app, tmp_path):
+    client = isolated_app.test_client()
+    assert client.get('/healthz').json == {'status': 'ok'}
+    response = client.get('/readyz')
+    assert response.status_code == 200
+    assert response.json['checks'] == {'database': 'ok', 'uploads': 'ok'}
+
+    isolated_app.config['UPLOAD_DIR'] = tmp_path / 'missing'
+    response = client.get('/readyz')
+    assert response.status_code == 503 and response.json['checks']['uploads'] == 'failed'
+
+# Storage backends
+def test_uploads_are_sharded_and_flat_files_migrate(isolated_app, tmp_path):
+    import hashlib
+    from project.storage import get_storage
+    uploads = tmp_path / 'uploads'
+    uploads.mkdir()
+    isolated_app.config['UPLOAD_DIR'] = uploads
+    isolated_app.config['WTF_CSRF_ENABLED'] = False
+    client = isolated_app.test_client()
+    upload_photo(client, b'sharded', 'a.jpg')
+    name = hashlib.sha256(b'sharded').hexdigest()
+    assert os.path.isfile(uploads / name[:2] / name[2:4] / name)
+
+    # A file left over from the flat layout is still served, and moved by storage-migrate
+    (uploads / 'old.jpg').write_bytes(b'old')
+    db.session.add(Photo(name='n', caption='c', file='old.jpg', user_id=1))
+    db.session.commit()
+    assert client.get('/uploads/old.jpg').data == b'old'
+    result = isolated_app.test_cli_runner().invoke(args=['storage-migrate'])
+    assert '1 files migrated' in result.output
+    assert not (uploads / 'old.jpg').exists()
+    assert os.path.isfile(get_storage().path('old.jpg'))
+    assert client.get('/uploads/old.jpg').data == b'old'
+
+    from project.jobs import run_jobs
+    photo_id = Photo.query.filter_by(file=name).one().id
+    client.post('/photo/%d/delete/' % photo_id)
+    assert get_storage().exists(name)
+    run_jobs()
+    assert not get_storage().exists(name)
+
+def test_s3_storage_backend(tmp_path):
+    moto = pytest.importorskip('moto')
+    import boto3
+    import hashlib
+    with moto.mock_aws():
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='photos')
+        app = create_app({
+            'TESTING': True,
+            'SECRET_KEY': 'test',
+            'WTF_CSRF_ENABLED': False,
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'test.db'),
+            'UPLOAD_DIR': tmp_path,
+            'GRID_CACHE_VERSION_FILE': str(tmp_path / 'grid.version'),
+            'STORAGE_BACKEND': 's3',
+            'S3_BUCKET': 'photos',
+            'S3_PREFIX': 'uploads/',
+            'S3_REGION': 'us-east-1',
+            'S3_PUBLIC_URL': 'https://cdn.example.com',
+            'JOB_WORKERS': 0,
+            'CLEANUP_GRACE_SECONDS': 0,
+        })
+        with app.app_context():
+            from project.storage import get_storage
+            db.create_all()
+            client = app.test_client()
+            upload_photo(client, b'in the bucket', 'a.jpg')
+            name = hashlib.sha256(b'in the bucket').hexdigest()
+            key = 'uploads/%s/%s/%s' % (name[:2], name[2:4], name)
+            s3 = boto3.client('s3', region_name='us-east-1')
+            stored = s3.get_object(Bucket='photos', Key=key)
+            assert stored['Body'].read() == b'in the bucket'
+            assert 'immutable' in stored['CacheControl']
+            assert list(get_storage().keys()) == [name]
+            assert os.listdir(tmp_path / '.incoming') == []
+
+            response = client.get('/uploads/' + name)
+            assert response.status_code == 302
+            assert response.location == 'https://cdn.example.com/' + key
+
+            from project.jobs import run_jobs
+            client.post('/photo/%d/delete/' % Photo.query.one().id)
+            run_jobs()
+            assert s3.list_objects_v2(Bucket='photos').get('KeyCount') == 0
+
+# Background jobs
+def test_deletes_queue_file_cleanup_and_jobs_retry(isolated_app, tmp_path):
+    import hashlib
+    import time
+    from project import jobs
+    from project.models import Job, utcnow
+    from project.storage import get_storage
+    isolated_app.config['WTF_CSRF_ENABLED'] = False
+    client = isolated_app.test_client()
+    upload_photo(client, b'shared', 'one.jpg')
+    upload_photo(client, b'shared', 'two.jpg')
+    name = hashlib.sha256(b'shared').hexdigest()
+    storage = get_storage()
+    first, second = (photo.id for photo in Photo.query.order_by(Photo.id))
+
+    # The request only deletes rows; the file goes once no photo uses it
+    client.post('/photo/%d/delete/' % first)
+    assert db.session.get(Photo, first) is None and storage.exists(name)
+    client.post('/photo/%d/delete/' % second)
+    # Queueing the same cleanup twice leaves one job
+    assert [job.key for job in Job.query.all()] == ['delete-upload:' + name]
+    assert jobs.run_jobs() == 1
+    assert not storage.exists(name) and Job.query.count() == 0
+
+    # An identical upload re-using the file while its delete job is pending keeps it: the job
+    # may run after the file was found in storage but before the new photo is committed
+    import io
+    from werkzeug.datastructures import FileStorage
+    from project.storage import ingest_upload
+    isolated_app.config['CLEANUP_GRACE_SECONDS'] = 60
+    upload_photo(client, b'again', 'a.jpg')
+    photo = Photo.query.one()
+    name = photo.file
+    old = time.time() - 3600
+    os.utime(storage.path(name), (old, old))
+    client.post('/photo/%d/delete/' % photo.id)
+    assert ingest_upload(FileStorage(io.BytesIO(b'again'), 'b.jpg'), storage) == (name, False)
+    assert jobs.run_jobs() == 1 and storage.exists(name)
+    db.session.add(Photo(name='n', caption='c', file=name, user_id=1))
+    # The job put itself back for after the grace period, and then sees the new photo
+    db.session.execute(text("UPDATE job SET run_at = '2000-01-01'"))
+    db.session.commit()
+    assert jobs.run_jobs() == 1 and storage.exists(name) and Job.query.count() == 0
+
+    # Polling an empty queue only reads, so idle workers never take SQLite's write lock
+    from sqlalchemy import event
+    statements = []
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        assert jobs.run_jobs() == 0
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+    assert statements and all(statement.lstrip().startswith('SELECT') for statement in statements)
+
+    # Failing jobs are retried with backoff, then kept as failed
+    attempts = []
+    jobs.handler('flaky')(lambda **payload: attempts.append(payload) or 1 / 0)
+    try:
+        isolated_app.config['JOB_RETRY_SECONDS'] = 0
+        jobs.enqueue('flaky', {'n': 1}, max_attempts=3)
+        db.session.commit()
+        assert jobs.run_jobs() == 3 and attempts == [{'n': 1}] * 3
+        job = Job.query.one()
+        assert job.status == 'failed' and 'ZeroDivisionError' in job.last_error
+        assert 'failed   1' in isolated_app.test_cli_runner().invoke(args=['jobs-status']).output
+
+        # A job whose worker died is run again once its lease has run out
+        job.status, job.locked_until, job.max_attempts = 'running', utcnow(), 4
+        db.session.commit()
+        assert jobs.run_jobs() == 1 and len(attempts) == 4
+    finally:
+        del jobs.HANDLERS['flaky']
+
+def test_worker_pool_runs_jobs_and_reconciler_cleans_up(isolated_app, tmp_path):
+    import time
+    from PIL import Image
+    from project.cleanup import reconcile_uploads
+    from project.jobs import WorkerPool, job_counts
+    from project.models import Job, Like
+    from project.storage import get_storage
+    isolated_app.config['WTF_CSRF_ENABLED'] = False
+    storage = get_storage()
+    # Resized copies of an upload are made by a worker thread once the photo is committed
+    pool = WorkerPool(isolated_app, 2, 0.05)
+    isolated_app.extensions['jobs'] = pool
+    isolated_app.config['JOB_WORKERS'] = 2
+    image = tmp_path / 'big.png'
+    Image.new('RGB', (800, 600), 'red').save(image)
+    upload_photo(isolated_app.test_client(), image.read_bytes(), 'big.png')
+    name = Photo.query.one().file
+    # Once it is done, only the reconciler, which keeps itself scheduled, is left in the queue
+    deadline = time.monotonic() + 10
+    while job_counts() != {'queued': 1} and time.monotonic() < deadline:
+        time.sleep(0.05)
+    pool.stop()
+    assert Job.query.one().kind == 'reconcile-uploads'
+    assert storage.exists('derived/%s-640w.webp' % name[:-4])
+
+    # Orphans: an upload without a photo, resized copies of a deleted one, a stale staging
+    # file and a like of a deleted photo. A recent orphan is kept for the grace period.
+    old = time.time() - 2 * 3600
+    for key, data in [('a' * 64 + '.jpg', b'orphan'), ('derived/' + 'b' * 64 + '-320w.webp', b'd'),
+                      ('c' * 64 + '.jpg', b'recent'), ('notes.txt', b'not an upload')]:
+        tmp = storage.temp_path()
+        with open(tmp, 'wb') as file:
+            file.write(data)
+        storage.save(key, tmp)
+        if data != b'recent':
+            os.utime(storage.path(key), (old, old))
+    staging = storage.temp_path()
+    os.utime(staging, (old, old))
+    db.session.add_all([Like(user_id=1, photo_id=999),
+                        Photo(name='n', caption='c', file='d' * 64 + '.jpg')])
+    db.session.commit()
+    result = reconcile_uploads()
+    assert result == (2, 1, 1, 1)
+    assert not storage.exists('a' * 64 + '.jpg') and storage.exists('c' * 64 + '.jpg')
+    assert storage.exists('notes.txt') and storage.exists(name) and not os.path.exists(staging)
+    assert Like.query.count() == 0
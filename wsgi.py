@@ -0,0 +1,26 @@
+"""WSGI entry point for production servers.
+
+    gunicorn --preload --workers 4 wsgi:app
+
+The app is created once at import, so with ``--preload`` the master process
+pays the import cost and every forked worker starts from a warm copy.
+authlib and requests (for Google sign-in) are only imported on the first
+login, and no database connection is opened at import; a forked worker
+discards any pooled connection it inherited.
+
+Use ``run.py`` for the development server.
+"""
+import os
+
+from project import create_app, db
+
+app = create_app()
+
+
+def _after_fork():
+  # Connections must not be shared between processes; close=False leaves the parent's alone
+  with app.app_context():
+    db.engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=_after_fork)